@@ -2,9 +2,11 @@
 
 from django.core import serializers
 from django.db import models, transaction
+from django.db.models import Q
 from django.utils.translation import ugettext_noop as _
 from treebeard.exceptions import InvalidMoveToDescendant, NodeAlreadySaved
-from treebeard.models import Node
+from treebeard.models import Node, NodeQuerySet
+from treebeard.instrumentation import instrumented
 
 
 def get_result_class(cls):
@@ -31,6 +33,10 @@ def get_result_class(cls):
         return base_class
 
 
+class AL_NodeQuerySet(NodeQuerySet):
+    """Custom queryset for the tree node manager."""
+
+
 class AL_NodeManager(models.Manager):
     """Custom manager for nodes in an Adjacency List tree."""
     def get_queryset(self):
@@ -39,7 +45,8 @@ class AL_NodeManager(models.Manager):
             order_by = ['parent'] + list(self.model.node_order_by)
         else:
             order_by = ['parent', 'sib_order']
-        return super(AL_NodeManager, self).get_queryset().order_by(*order_by)
+        return AL_NodeQuerySet(self.model, using=self._db,
+                               hints=self._hints).order_by(*order_by)
 
 
 class AL_Node(Node):
@@ -49,6 +56,7 @@ class AL_Node(Node):
     node_order_by = None
 
     @classmethod
+    @instrumented('add_root')
     def add_root(cls, **kwargs):
         """Adds a root node to the tree."""
 
@@ -97,13 +105,104 @@ class AL_Node(Node):
         except AttributeError:
             pass
 
-        depth = 0
-        node = self
-        while node:
-            node = node.parent
-            depth += 1
-        self._cached_depth = depth
-        return depth
+        self.__class__.annotate_depth([self])
+        return self._cached_depth
+
+    @classmethod
+    def annotate_depth(cls, nodes):
+        """
+        Caches the depth of many nodes at once, so :meth:`get_depth` won't
+        need to query the database for any of them.
+
+        In databases with support for recursive queries (PostgreSQL,
+        SQLite 3.8.3+ and MySQL 8+) all the depths are calculated with a
+        single query, otherwise one query per tree level is needed.
+
+        :param nodes: An iterable of (saved) nodes.
+
+        :returns: A list with the nodes.
+        """
+        nodes = list(nodes)
+        pending = []
+        for node in nodes:
+            if node.parent_id is None:
+                node._cached_depth = 1
+            else:
+                pending.append(node)
+        if not pending:
+            return nodes
+
+        cls = get_result_class(cls)
+        pks = list(set(node.pk for node in pending))
+        depths = {}
+        if cls._can_use_recursive_queries():
+            cursor = cls._get_database_cursor('read')
+            to_python = cls._meta.pk.to_python
+            for start in range(0, len(pks), cls.bulk_batch_size):
+                sql, vals = cls._get_sql_ancestors_cte(
+                    pks[start:start + cls.bulk_batch_size])
+                sql += ('SELECT node_id, MAX(distance)'
+                        ' FROM treebeard_ancestors'
+                        ' GROUP BY node_id')
+                cursor.execute(sql, vals)
+                for pk, depth in cursor.fetchall():
+                    depths[to_python(pk)] = depth
+        else:
+            # load the ancestors one level at a time
+            parents = dict((node.pk, node.parent_id) for node in pending)
+            missing = set(parents.values())
+            while missing:
+                missing = list(missing)
+                for start in range(0, len(missing), cls.bulk_batch_size):
+                    parents.update(cls.objects.filter(
+                        pk__in=missing[start:start + cls.bulk_batch_size]
+                    ).values_list('pk', 'parent_id'))
+                missing = set(
+                    parent_id for parent_id in parents.values()
+                    if parent_id is not None and parent_id not in parents)
+            for pk in pks:
+                chain = []
+                while pk is not None and pk not in depths:
+                    chain.append(pk)
+                    pk = parents[pk]
+                depth = 0 if pk is None else depths[pk]
+                for pk in reversed(chain):
+                    depth += 1
+                    depths[pk] = depth
+
+        for node in pending:
+            node._cached_depth = depths[node.pk]
+        return nodes
+
+    @classmethod
+    def _get_sql_ancestors_cte(cls, pks):
+        """
+        :returns: The sql and values of a recursive common table expression
+            named ``treebeard_ancestors``, with a row for every ancestor of
+            the nodes with the given primary keys: the ``node_id``, the
+            ``id`` of the ancestor and the ``distance`` to it. The last row
+            of every node has a ``NULL`` ancestor and a ``distance`` equal to
+            the depth of the node.
+        """
+        cls = get_result_class(cls)
+        qn = cls._get_database_connection('read').ops.quote_name
+        sql = ('WITH RECURSIVE treebeard_ancestors(node_id, id, distance)'
+               ' AS ('
+               ' SELECT T.%(pk)s, T.%(parent)s, 1'
+               '  FROM %(table)s AS T'
+               '  WHERE T.%(pk)s IN (%(pks)s)'
+               ' UNION ALL'
+               ' SELECT treebeard_ancestors.node_id, T.%(parent)s,'
+               '  treebeard_ancestors.distance + 1'
+               '  FROM %(table)s AS T'
+               '  INNER JOIN treebeard_ancestors'
+               '  ON T.%(pk)s = treebeard_ancestors.id'
+               ') ') % {
+                   'pk': qn(cls._meta.pk.column),
+                   'parent': qn(cls._meta.get_field('parent').column),
+                   'table': qn(cls._meta.db_table),
+                   'pks': ', '.join(['%s'] * len(pks))}
+        return sql, list(pks)
 
     def get_children(self):
         """:returns: A queryset of all the node's children"""
@@ -118,16 +217,68 @@ class AL_Node(Node):
             # following the 'parent' relation
             if self.parent_id is None:
                 return None
-            else:
-                return self.__class__.objects.get(pk=self.parent_id)
+            cached = getattr(self, '_cached_parent_obj', None)
+            if update or cached is None or cached.pk != self.parent_id:
+                self._cached_parent_obj = self.__class__.objects.get(
+                    pk=self.parent_id)
+            return self._cached_parent_obj
         else:
             return self.parent
 
+    @classmethod
+    def annotate_parents(cls, nodes):
+        """
+        Caches the parents of many nodes at once, so :meth:`get_parent`
+        won't need to query the database for any of them. The parents are
+        fetched by their primary keys, in batches of :attr:`bulk_batch_size`
+        keys.
+
+        :param nodes: An iterable of (saved) nodes.
+
+        :returns: A list with the nodes.
+        """
+        nodes = list(nodes)
+        pks = list(set(node.parent_id for node in nodes
+                       if node.parent_id is not None))
+        parents = {}
+        result_class = get_result_class(cls)
+        for start in range(0, len(pks), cls.bulk_batch_size):
+            parents.update(result_class.objects.in_bulk(
+                pks[start:start + cls.bulk_batch_size]))
+        for node in nodes:
+            if node.parent_id in parents:
+                if node._meta.proxy_for_model:
+                    node._cached_parent_obj = parents[node.parent_id]
+                else:
+                    node.parent = parents[node.parent_id]
+        return nodes
+
     def get_ancestors(self):
         """
         :returns: A *list* containing the current node object's ancestors,
             starting by the root node and descending to the parent.
         """
+        if self.parent_id is None:
+            return []
+
+        if self.__class__._can_use_recursive_queries():
+            # the current node may be a proxy model; our result set
+            # should use the same proxy model
+            cls = get_result_class(self.__class__)
+            qn = cls._get_database_connection('read').ops.quote_name
+            sql, vals = cls._get_sql_ancestors_cte([self.pk])
+            sql += ('SELECT T.* FROM %(table)s AS T'
+                    ' INNER JOIN treebeard_ancestors'
+                    ' ON T.%(pk)s = treebeard_ancestors.id'
+                    ' ORDER BY treebeard_ancestors.distance DESC') % {
+                        'pk': qn(cls._meta.pk.column),
+                        'table': qn(cls._meta.db_table)}
+            ancestors = list(cls.objects.raw(sql, vals))
+            for depth, node in enumerate(ancestors, 1):
+                node._cached_depth = depth
+            self._cached_depth = len(ancestors) + 1
+            return ancestors
+
         ancestors = []
         if self._meta.proxy_for_model:
             # the current node is a proxy model; our result set
@@ -158,7 +309,28 @@ class AL_Node(Node):
         :returns: ``True`` if the node if a descendant of another node given
             as an argument, else, returns ``False``
         """
-        return self.pk in [obj.pk for obj in node.get_descendants()]
+        if self.parent_id is None or self.pk == node.pk:
+            return False
+        if self.parent_id == node.pk:
+            return True
+
+        cls = get_result_class(self.__class__)
+        if cls._can_use_recursive_queries():
+            sql, vals = cls._get_sql_ancestors_cte([self.pk])
+            sql += ('SELECT COUNT(*) FROM treebeard_ancestors'
+                    ' WHERE treebeard_ancestors.id = %s')
+            cursor = cls._get_database_cursor('read')
+            cursor.execute(sql, vals + [node.pk])
+            return cursor.fetchone()[0] > 0
+
+        # walk up the tree, reading only the ids of the ancestors
+        parent_id = self.parent_id
+        while parent_id is not None:
+            if parent_id == node.pk:
+                return True
+            parent_id = cls.objects.filter(pk=parent_id).values_list(
+                'parent_id', flat=True)[0]
+        return False
 
     @classmethod
     def dump_bulk(cls, parent=None, keep_ids=True):
@@ -203,6 +375,144 @@ class AL_Node(Node):
             lnk[node.pk] = newobj
         return ret
 
+    @classmethod
+    @instrumented('load_bulk')
+    def load_bulk(cls, bulk_data, parent=None, keep_ids=False):
+        """
+        Loads a list/dictionary structure to the tree.
+
+        The nodes are written one tree level at a time: the ``sib_order``
+        values are calculated in memory and every level is written in
+        batches of :attr:`bulk_batch_size` nodes with ``bulk_create``, so the
+        number of queries grows with the depth of the structure, not with
+        the number of nodes.
+
+        .. note::
+
+           Since the nodes are written with ``bulk_create``, the ``save()``
+           method of the model isn't called and no ``pre_save``/``post_save``
+           signals are sent. Models using multi-table inheritance (or proxy
+           models, in Django 1.8) are loaded node by node.
+
+           When the database can't return the ids of the new rows (every
+           database but PostgreSQL, with Django 1.10 or later), they are
+           looked up by ``parent`` and ``sib_order``. Models with
+           ``node_order_by`` don't have that key, so outside of SQLite their
+           nodes are saved one by one, which is as slow as the node by node
+           insertion.
+        """
+        if not cls._can_bulk_create():
+            return super(AL_Node, cls).load_bulk(bulk_data, parent, keep_ids)
+
+        connection = cls._get_database_connection('write')
+        with transaction.atomic(using=connection.alias):
+            first_sib_order = 1
+            if not cls.node_order_by:
+                if parent:
+                    siblings = get_result_class(cls).objects.filter(
+                        parent=parent)
+                else:
+                    siblings = cls.get_root_nodes()
+                try:
+                    first_sib_order += siblings.order_by(
+                        'sib_order').reverse()[0].sib_order
+                except IndexError:
+                    pass
+
+            foreign_keys = cls.get_foreign_keys()
+            foreign_objects = cls._get_foreign_objects(foreign_keys,
+                                                       bulk_data)
+            roots, children = [], {}
+            # every element is a tuple of (parent node, node structure,
+            # sib_order, list of siblings to append the new node object to)
+            level = [(parent, node_struct, first_sib_order + pos, roots)
+                     for pos, node_struct in enumerate(bulk_data)]
+            while level:
+                newobjs = []
+                for parentobj, node_struct, sib_order, added_to in level:
+                    newobj = cls._get_bulk_node_obj(
+                        foreign_keys, foreign_objects, node_struct,
+                        keep_ids)
+                    if not cls.node_order_by:
+                        newobj.sib_order = sib_order
+                    newobj.parent = parentobj
+                    added_to.append(newobj)
+                    newobjs.append((newobj, node_struct))
+                cls._bulk_create_with_ids([obj for obj, _ in newobjs])
+                level = []
+                for newobj, node_struct in newobjs:
+                    children[newobj.pk] = []
+                    level.extend([
+                        (newobj, child, pos + 1, children[newobj.pk])
+                        for pos, child in enumerate(
+                            node_struct.get('children', []))
+                    ])
+
+        # the ids are returned in the same (DFS) order the node by node
+        # insertion would use
+        added = []
+        stack = roots[::-1]
+        while stack:
+            node = stack.pop()
+            added.append(node.pk)
+            stack.extend(children[node.pk][::-1])
+        return added
+
+    @classmethod
+    def _bulk_create_with_ids(cls, objs):
+        """
+        Writes the nodes with ``bulk_create`` and makes sure that they have
+        their primary key set, since the children that will be written
+        next need it.
+        """
+        connection = cls._get_database_connection('write')
+        # only available (and True in postgresql) since django 1.10
+        can_return_ids = getattr(connection.features,
+                                 'can_return_ids_from_bulk_insert', False)
+        if can_return_ids or all(obj.pk is not None for obj in objs):
+            for start in range(0, len(objs), cls.bulk_batch_size):
+                cls.objects.bulk_create(
+                    objs[start:start + cls.bulk_batch_size])
+        elif not cls.node_order_by:
+            # the siblings that already existed have a lower sib_order, so
+            # the parent and sib_order of a new node identify its row
+            for start in range(0, len(objs), cls.bulk_batch_size):
+                chunk = objs[start:start + cls.bulk_batch_size]
+                cls.objects.bulk_create(chunk)
+                nodes = dict(((obj.parent_id, obj.sib_order), obj)
+                             for obj in chunk)
+                parent_ids = set(obj.parent_id for obj in chunk)
+                query = Q(parent_id__in=parent_ids - set([None]))
+                if None in parent_ids:
+                    query |= Q(parent__isnull=True)
+                sib_orders = [obj.sib_order for obj in chunk]
+                for pk, parent_id, sib_order in cls.objects.filter(
+                        query,
+                        sib_order__gte=min(sib_orders),
+                        sib_order__lte=max(sib_orders)
+                ).values_list('pk', 'parent_id', 'sib_order'):
+                    if (parent_id, sib_order) in nodes:
+                        nodes[parent_id, sib_order].pk = pk
+        elif (
+                connection.vendor == 'sqlite' and
+                isinstance(cls._meta.pk, models.AutoField)
+        ):
+            # sqlite locks the whole database while writing, so inside the
+            # transaction the rows we just inserted are the ones with the
+            # highest ids
+            for start in range(0, len(objs), cls.bulk_batch_size):
+                chunk = objs[start:start + cls.bulk_batch_size]
+                cls.objects.bulk_create(chunk)
+                ids = cls.objects.order_by('-pk').values_list(
+                    'pk', flat=True)[:len(chunk)]
+                for obj, pk in zip(chunk, reversed(ids)):
+                    obj.pk = pk
+        else:
+            # no safe way to know the ids of the new rows
+            for obj in objs:
+                obj.save()
+
+    @instrumented('add_child')
     def add_child(self, **kwargs):
         """Adds a child to the node."""
         cls = get_result_class(self.__class__)
@@ -242,11 +552,122 @@ class AL_Node(Node):
             results.append(node)
             cls._get_tree_recursively(results, node, depth + 1)
 
+    @classmethod
+    def _can_use_recursive_queries(cls):
+        """
+        :returns: ``True`` if the database supports recursive common table
+            expressions (``WITH RECURSIVE``).
+        """
+        connection = cls._get_database_connection('read')
+        if connection.vendor == 'postgresql':
+            return True
+        if connection.vendor == 'sqlite':
+            return connection.Database.sqlite_version_info >= (3, 8, 3)
+        if connection.vendor == 'mysql':
+            # MariaDB reports its own version numbers, and added recursive
+            # queries in 10.2.2
+            connection.ensure_connection()
+            if 'mariadb' in connection.connection.get_server_info().lower():
+                return connection.mysql_version >= (10, 2, 2)
+            return connection.mysql_version >= (8, 0)
+        return False
+
+    @classmethod
+    def _get_sql_descendants_cte(cls, parent, depth):
+        """
+        :returns: The sql and values of a recursive common table expression
+            named ``treebeard_tree``, with the ``id`` and ``depth`` of all
+            the descendants of ``parent`` (or of all the nodes in the tree if
+            ``parent`` is ``None``). ``depth`` is the depth of the
+            shallowest nodes.
+        """
+        cls = get_result_class(cls)
+        qn = cls._get_database_connection('read').ops.quote_name
+        if parent is None:
+            where, vals = 'IS NULL', [depth]
+        else:
+            where, vals = '= %s', [depth, parent.pk]
+        sql = ('WITH RECURSIVE treebeard_tree(id, depth) AS ('
+               ' SELECT T.%(pk)s, %%s'
+               '  FROM %(table)s AS T'
+               '  WHERE T.%(parent)s %(where)s'
+               ' UNION ALL'
+               ' SELECT T.%(pk)s, treebeard_tree.depth + 1'
+               '  FROM %(table)s AS T'
+               '  INNER JOIN treebeard_tree'
+               '  ON T.%(parent)s = treebeard_tree.id'
+               ') ') % {
+                   'pk': qn(cls._meta.pk.column),
+                   'parent': qn(cls._meta.get_field('parent').column),
+                   'table': qn(cls._meta.db_table),
+                   'where': where}
+        return sql, vals
+
+    @classmethod
+    def _get_tree_with_cte(cls, parent, depth):
+        """
+        :returns: A list of the descendants of ``parent`` ordered as DFS,
+            retrieved with a single recursive query.
+        """
+        cls = get_result_class(cls)
+        qn = cls._get_database_connection('read').ops.quote_name
+        sql, vals = cls._get_sql_descendants_cte(parent, depth)
+        sql += ('SELECT T.*, treebeard_tree.depth AS _cached_depth'
+                ' FROM %(table)s AS T'
+                ' INNER JOIN treebeard_tree'
+                ' ON T.%(pk)s = treebeard_tree.id'
+                ' ORDER BY %(order_by)s') % {
+                    'pk': qn(cls._meta.pk.column),
+                    'table': qn(cls._meta.db_table),
+                    'order_by': cls._get_sql_siblings_order_by()}
+        return cls._sort_nodes_dfs(cls.objects.raw(sql, vals), parent)
+
+    @classmethod
+    def _get_sql_siblings_order_by(cls):
+        """
+        :returns: The sql ``ORDER BY`` expression (for a table aliased as
+            ``T``) that sorts the nodes like their siblings are sorted.
+        """
+        cls = get_result_class(cls)
+        qn = cls._get_database_connection('read').ops.quote_name
+        order_by = []
+        for field_name in cls.node_order_by or ['sib_order']:
+            if field_name.startswith('-'):
+                field_name, direction = field_name[1:], ' DESC'
+            else:
+                direction = ''
+            order_by.append('T.%s%s' % (
+                qn(cls._meta.get_field(field_name).column), direction))
+        return ', '.join(order_by)
+
+    @classmethod
+    def _sort_nodes_dfs(cls, nodes, parent):
+        """
+        :param nodes: An iterable with all the descendants of ``parent``,
+            where siblings are already sorted.
+
+        :returns: A list of the nodes ordered as DFS.
+        """
+        children = {}
+        for node in nodes:
+            children.setdefault(node.parent_id, []).append(node)
+        results = []
+        stack = children.get(parent.pk if parent else None, [])[::-1]
+        while stack:
+            node = stack.pop()
+            results.append(node)
+            stack.extend(children.get(node.pk, [])[::-1])
+        return results
+
     @classmethod
     def get_tree(cls, parent=None):
         """
         :returns: A list of nodes ordered as DFS, including the parent. If
                   no parent is given, the entire tree is returned.
+
+        In databases with support for recursive queries (PostgreSQL,
+        SQLite 3.8.3+ and MySQL 8+) the nodes are retrieved with a single
+        query.
         """
         if parent:
             depth = parent.get_depth() + 1
@@ -254,7 +675,10 @@ class AL_Node(Node):
         else:
             depth = 1
             results = []
-        cls._get_tree_recursively(results, parent, depth)
+        if cls._can_use_recursive_queries():
+            results.extend(cls._get_tree_with_cte(parent, depth))
+        else:
+            cls._get_tree_recursively(results, parent, depth)
         return results
 
     def get_descendants(self):
@@ -266,7 +690,26 @@ class AL_Node(Node):
 
     def get_descendant_count(self):
         """:returns: the number of descendants of a nodee"""
-        return len(self.get_descendants())
+        cls = get_result_class(self.__class__)
+        if cls._can_use_recursive_queries():
+            sql, vals = cls._get_sql_descendants_cte(self, 1)
+            sql += 'SELECT COUNT(*) FROM treebeard_tree'
+            cursor = cls._get_database_cursor('read')
+            cursor.execute(sql, vals)
+            return cursor.fetchone()[0]
+
+        # count one tree level at a time, reading only the ids of the nodes
+        count = 0
+        level = [self.pk]
+        while level:
+            children = []
+            for start in range(0, len(level), cls.bulk_batch_size):
+                children.extend(cls.objects.filter(
+                    parent__in=level[start:start + cls.bulk_batch_size]
+                ).values_list('pk', flat=True))
+            count += len(children)
+            level = children
+        return count
 
     def get_siblings(self):
         """
@@ -278,6 +721,7 @@ class AL_Node(Node):
                 parent=self.parent)
         return self.__class__.get_root_nodes()
 
+    @instrumented('add_sibling')
     def add_sibling(self, pos=None, **kwargs):
         """Adds a new node as a sibling to the current node object."""
         pos = self._prepare_pos_var_for_add_sibling(pos)
@@ -342,6 +786,7 @@ class AL_Node(Node):
             sib_order = cls._make_hole_and_get_sibling_order(pos, target_node)
         return sib_order
 
+    @instrumented('move')
     def move(self, target, pos=None):
         """
         Moves the current node and all it's descendants to a new position
@@ -0,0 +1,329 @@
+"""Closure Table"""
+
+from django.db import models, transaction
+from django.db.models import Count
+
+from treebeard.al_tree import AL_Node, get_result_class
+from treebeard.instrumentation import instrumented
+
+
+class CT_NodeClosure(models.Model):
+    """
+    Abstract model to create the closure table of your own
+    :class:`CT_Node` trees.
+    """
+
+    depth = models.PositiveIntegerField()
+
+    class Meta:
+        """Abstract model."""
+        abstract = True
+        unique_together = ('ancestor', 'descendant')
+
+
+class CT_Node(AL_Node):
+    """Abstract model to create your own Closure Table Trees."""
+
+    @classmethod
+    def _get_closure_model(cls):
+        """:returns: The model of the closure table of the tree."""
+        return get_result_class(cls)._meta.get_field(
+            'ancestor_closures').related_model
+
+    @classmethod
+    def _get_closure_columns(cls):
+        """
+        :returns: A dictionary with the quoted names of the closure table and
+            its columns, to be used in raw sql.
+        """
+        closure_model = cls._get_closure_model()
+        qn = cls._get_database_connection('write').ops.quote_name
+        return {
+            'closure': qn(closure_model._meta.db_table),
+            'ancestor': qn(closure_model._meta.get_field('ancestor').column),
+            'descendant': qn(
+                closure_model._meta.get_field('descendant').column),
+            'depth': qn(closure_model._meta.get_field('depth').column)}
+
+    @classmethod
+    def _add_closures(cls, node):
+        """Adds the closure rows of a new leaf node."""
+        closure_model = cls._get_closure_model()
+        closure_model.objects.create(ancestor_id=node.pk,
+                                     descendant_id=node.pk, depth=0)
+        if node.parent_id is not None:
+            sql = ('INSERT INTO %(closure)s'
+                   ' (%(ancestor)s, %(descendant)s, %(depth)s)'
+                   ' SELECT %(ancestor)s, %%s, %(depth)s + 1'
+                   ' FROM %(closure)s'
+                   ' WHERE %(descendant)s = %%s') % cls._get_closure_columns()
+            cursor = cls._get_database_cursor('write')
+            cursor.execute(sql, [node.pk, node.parent_id])
+
+    def _move_closures(self):
+        """
+        Updates the closure rows of the branch of the node, after the node
+        was moved to another parent.
+        """
+        cls = self.__class__
+        cursor = cls._get_database_cursor('write')
+        columns = cls._get_closure_columns()
+
+        # unlink the branch from its old ancestors (the derived tables are
+        # needed by mysql, that can't read the table it's deleting from)
+        sql = ('DELETE FROM %(closure)s'
+               ' WHERE %(descendant)s IN ('
+               '  SELECT descendant_id FROM ('
+               '   SELECT %(descendant)s AS descendant_id'
+               '   FROM %(closure)s'
+               '   WHERE %(ancestor)s = %%s) AS branch)'
+               ' AND %(ancestor)s IN ('
+               '  SELECT ancestor_id FROM ('
+               '   SELECT %(ancestor)s AS ancestor_id'
+               '   FROM %(closure)s'
+               '   WHERE %(descendant)s = %%s'
+               '   AND %(ancestor)s <> %%s) AS ancestors)') % columns
+        cursor.execute(sql, [self.pk, self.pk, self.pk])
+
+        if self.parent_id is not None:
+            # and link it to the new ones
+            sql = ('INSERT INTO %(closure)s'
+                   ' (%(ancestor)s, %(descendant)s, %(depth)s)'
+                   ' SELECT ancestors.%(ancestor)s,'
+                   '  branch.%(descendant)s,'
+                   '  ancestors.%(depth)s + branch.%(depth)s + 1'
+                   ' FROM %(closure)s AS ancestors, %(closure)s AS branch'
+                   ' WHERE ancestors.%(descendant)s = %%s'
+                   ' AND branch.%(ancestor)s = %%s') % columns
+            cursor.execute(sql, [self.parent_id, self.pk])
+
+    @classmethod
+    def _bulk_create_closures(cls, parents, ancestors=None):
+        """
+        Writes the closure rows of many nodes, in batches of
+        :attr:`bulk_batch_size` rows.
+
+        :param parents: A dictionary with the primary keys of the nodes and
+            the primary keys of their parents.
+        :param ancestors: A dictionary with the primary keys of the nodes
+            that are not in ``parents`` but are parents of some of them, and
+            the list of their ancestors, starting by the root node and
+            ending with the node itself.
+        """
+        closure_model = cls._get_closure_model()
+        chains = dict(ancestors or {})
+
+        def get_chain(pk):
+            # the list of ancestors of a node, including itself
+            pending = []
+            while pk is not None and pk not in chains:
+                pending.append(pk)
+                pk = parents[pk]
+            chain = chains[pk] if pk is not None else []
+            for pk in reversed(pending):
+                chain = chain + [pk]
+                chains[pk] = chain
+            return chain
+
+        batch = []
+        for pk in parents:
+            chain = get_chain(pk)
+            for depth, ancestor_id in enumerate(reversed(chain)):
+                batch.append(closure_model(ancestor_id=ancestor_id,
+                                           descendant_id=pk, depth=depth))
+            if len(batch) >= cls.bulk_batch_size:
+                closure_model.objects.bulk_create(batch)
+                batch = []
+        if batch:
+            closure_model.objects.bulk_create(batch)
+
+    @classmethod
+    @instrumented('add_root')
+    def add_root(cls, **kwargs):
+        """Adds a root node to the tree."""
+        newobj = super(CT_Node, cls).add_root(**kwargs)
+        cls._add_closures(newobj)
+        return newobj
+
+    @instrumented('add_child')
+    def add_child(self, **kwargs):
+        """Adds a child to the node."""
+        newobj = super(CT_Node, self).add_child(**kwargs)
+        newobj.__class__._add_closures(newobj)
+        return newobj
+
+    @instrumented('add_sibling')
+    def add_sibling(self, pos=None, **kwargs):
+        """Adds a new node as a sibling to the current node object."""
+        newobj = super(CT_Node, self).add_sibling(pos, **kwargs)
+        newobj.__class__._add_closures(newobj)
+        return newobj
+
+    @instrumented('move')
+    def move(self, target, pos=None):
+        """
+        Moves the current node and all it's descendants to a new position
+        relative to another node.
+        """
+        old_parent_id = self.parent_id
+        super(CT_Node, self).move(target, pos)
+        if self.parent_id != old_parent_id:
+            self._move_closures()
+
+    @classmethod
+    @instrumented('load_bulk')
+    def load_bulk(cls, bulk_data, parent=None, keep_ids=False):
+        """
+        Loads a list/dictionary structure to the tree.
+
+        The nodes are written like in :meth:`AL_Node.load_bulk`, and then
+        their closure rows are written in batches of :attr:`bulk_batch_size`
+        rows.
+        """
+        if not cls._can_bulk_create():
+            # the nodes are added one by one, with their closure rows
+            return super(CT_Node, cls).load_bulk(bulk_data, parent, keep_ids)
+
+        connection = cls._get_database_connection('write')
+        with transaction.atomic(using=connection.alias):
+            added = super(CT_Node, cls).load_bulk(bulk_data, parent,
+                                                  keep_ids)
+            result_class = get_result_class(cls)
+            parents = {}
+            for start in range(0, len(added), cls.bulk_batch_size):
+                parents.update(result_class.objects.filter(
+                    pk__in=added[start:start + cls.bulk_batch_size]
+                ).values_list('pk', 'parent_id'))
+            ancestors = {}
+            if parent:
+                ancestors[parent.pk] = list(
+                    cls._get_closure_model().objects.filter(
+                        descendant_id=parent.pk
+                    ).order_by('-depth').values_list('ancestor_id',
+                                                     flat=True))
+            cls._bulk_create_closures(parents, ancestors)
+        return added
+
+    @classmethod
+    @instrumented('fix_tree')
+    def fix_tree(cls):
+        """
+        Rebuilds the closure table of the tree, using the ``parent`` of
+        every node.
+        """
+        connection = cls._get_database_connection('write')
+        with transaction.atomic(using=connection.alias):
+            cls._get_closure_model().objects.all().delete()
+            cls._bulk_create_closures(dict(
+                get_result_class(cls).objects.values_list('pk',
+                                                          'parent_id')))
+
+    @classmethod
+    def annotate_depth(cls, nodes):
+        """
+        Caches the depth of many nodes at once, so :meth:`get_depth` won't
+        need to query the database for any of them.
+
+        :param nodes: An iterable of (saved) nodes.
+
+        :returns: A list with the nodes.
+        """
+        nodes = list(nodes)
+        pending = []
+        for node in nodes:
+            if node.parent_id is None:
+                node._cached_depth = 1
+            else:
+                pending.append(node)
+
+        pks = list(set(node.pk for node in pending))
+        depths = {}
+        closure_model = cls._get_closure_model()
+        for start in range(0, len(pks), cls.bulk_batch_size):
+            depths.update(closure_model.objects.filter(
+                descendant_id__in=pks[start:start + cls.bulk_batch_size]
+            ).order_by().values_list('descendant').annotate(Count('pk')))
+        for node in pending:
+            node._cached_depth = depths[node.pk]
+        return nodes
+
+    def get_ancestors(self):
+        """
+        :returns: A *list* containing the current node object's ancestors,
+            starting by the root node and descending to the parent.
+        """
+        if self.parent_id is None:
+            return []
+
+        ancestors = list(get_result_class(self.__class__).objects.filter(
+            descendant_closures__descendant=self.pk,
+            descendant_closures__depth__gt=0
+        ).order_by('-descendant_closures__depth'))
+        for depth, node in enumerate(ancestors, 1):
+            node._cached_depth = depth
+        self._cached_depth = len(ancestors) + 1
+        return ancestors
+
+    def get_root(self):
+        """:returns: the root node for the current node object."""
+        if self.parent_id is None:
+            return self
+        return get_result_class(self.__class__).objects.get(
+            descendant_closures__descendant=self.pk, parent__isnull=True)
+
+    def is_descendant_of(self, node):
+        """
+        :returns: ``True`` if the node if a descendant of another node given
+            as an argument, else, returns ``False``
+        """
+        return self._get_closure_model().objects.filter(
+            ancestor_id=node.pk, descendant_id=self.pk, depth__gt=0
+        ).exists()
+
+    def get_descendant_count(self):
+        """:returns: the number of descendants of a node"""
+        return self._get_closure_model().objects.filter(
+            ancestor_id=self.pk, depth__gt=0).count()
+
+    @classmethod
+    def get_tree(cls, parent=None):
+        """
+        :returns: A list of nodes ordered as DFS, including the parent. If
+                  no parent is given, the entire tree is returned.
+        """
+        cls = get_result_class(cls)
+        qn = cls._get_database_connection('read').ops.quote_name
+        columns = cls._get_closure_columns()
+        columns.update({
+            'pk': qn(cls._meta.pk.column),
+            'parent': qn(cls._meta.get_field('parent').column),
+            'table': qn(cls._meta.db_table),
+            'order_by': cls._get_sql_siblings_order_by()})
+        if parent:
+            results = [parent]
+            sql = ('SELECT T.*, C.%(depth)s + %%s AS _cached_depth'
+                   ' FROM %(table)s AS T'
+                   ' INNER JOIN %(closure)s AS C'
+                   ' ON C.%(descendant)s = T.%(pk)s'
+                   ' WHERE C.%(ancestor)s = %%s'
+                   ' AND C.%(depth)s > 0'
+                   ' ORDER BY %(order_by)s') % columns
+            vals = [parent.get_depth(), parent.pk]
+        else:
+            results = []
+            sql = ('SELECT T.*, C.%(depth)s + 1 AS _cached_depth'
+                   ' FROM %(table)s AS T'
+                   ' INNER JOIN %(closure)s AS C'
+                   ' ON C.%(descendant)s = T.%(pk)s'
+                   ' INNER JOIN %(table)s AS R'
+                   ' ON R.%(pk)s = C.%(ancestor)s'
+                   ' WHERE R.%(parent)s IS NULL'
+                   ' ORDER BY %(order_by)s') % columns
+            vals = []
+        results.extend(cls._sort_nodes_dfs(cls.objects.raw(sql, vals),
+                                           parent))
+        return results
+
+    class Meta:
+        """Abstract model."""
+        abstract = True
@@ -222,6 +222,10 @@ def _get_exclude_for_model(model, exclude):
         _exclude += ('sib_order', 'parent')
     elif issubclass(model, MP_Node):
         _exclude += ('depth', 'numchild', 'path')
+        if model._has_numdescendants():
+            _exclude += ('numdescendants', )
     elif issubclass(model, NS_Node):
         _exclude += ('depth', 'lft', 'rgt', 'tree_id')
+        if model._has_parent():
+            _exclude += ('parent', )
     return _exclude
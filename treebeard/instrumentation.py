@@ -0,0 +1,106 @@
+"""Instrumentation of the tree operations"""
+
+import functools
+import threading
+import timeit
+
+from django.db import connections, router
+from django.db.backends.utils import CursorDebugWrapper
+from django.db.models.query import QuerySet
+from django.dispatch import Signal
+
+
+#: Sent after every tree operation, only if it has receivers.
+tree_operation = Signal(providing_args=['operation', 'duration',
+                                        'statements'])
+
+_local = threading.local()
+
+
+class RecordingCursorWrapper(CursorDebugWrapper):
+    """
+    Cursor wrapper that records the sql statements executed while a tree
+    operation is instrumented.
+    """
+
+    def __init__(self, cursor, db, statements):
+        super(RecordingCursorWrapper, self).__init__(cursor, db)
+        self.statements = statements
+
+    def _record(self, method, sql, params):
+        start = timeit.default_timer()
+        try:
+            return method(sql, params)
+        finally:
+            self.statements.append({
+                'sql': sql,
+                'params': params,
+                'duration': timeit.default_timer() - start,
+                'rowcount': self.cursor.rowcount,
+            })
+
+    def execute(self, sql, params=None):
+        return self._record(
+            super(RecordingCursorWrapper, self).execute, sql, params)
+
+    def executemany(self, sql, param_list):
+        return self._record(
+            super(RecordingCursorWrapper, self).executemany, sql, param_list)
+
+
+def _get_sender(obj):
+    """:returns: The model class of a model, node object or queryset."""
+    if isinstance(obj, type):
+        return obj
+    if isinstance(obj, QuerySet):
+        return obj.model
+    return obj.__class__
+
+
+def instrumented(operation):
+    """
+    Decorator for the methods of the tree operations. When the
+    :data:`tree_operation` signal has receivers, the sql statements executed
+    by the operation are recorded and sent with the signal.
+
+    Operations called by other operations (like ``load_bulk`` adding nodes
+    with ``add_child``) are recorded as part of the outermost one.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(obj, *args, **kwargs):
+            sender = _get_sender(obj)
+            if (
+                    getattr(_local, 'operation', None) is not None or
+                    not tree_operation.has_listeners(sender)
+            ):
+                return func(obj, *args, **kwargs)
+
+            statements = []
+            dbs = set(connections[alias] for alias in (
+                router.db_for_read(sender), router.db_for_write(sender)))
+            previous = []
+            for db in dbs:
+                previous.append((db, db.force_debug_cursor,
+                                 db.__dict__.get('make_debug_cursor')))
+                db.force_debug_cursor = True
+                db.make_debug_cursor = functools.partial(
+                    RecordingCursorWrapper, db=db, statements=statements)
+            _local.operation = operation
+            try:
+                start = timeit.default_timer()
+                result = func(obj, *args, **kwargs)
+                duration = timeit.default_timer() - start
+            finally:
+                _local.operation = None
+                for db, force_debug_cursor, make_debug_cursor in previous:
+                    db.force_debug_cursor = force_debug_cursor
+                    if make_debug_cursor is None:
+                        del db.make_debug_cursor
+                    else:
+                        db.make_debug_cursor = make_debug_cursor
+            tree_operation.send(sender=sender, operation=operation,
+                                duration=duration, statements=statements)
+            return result
+        return wrapper
+    return decorator
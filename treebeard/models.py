@@ -6,10 +6,47 @@ import operator
 if sys.version_info >= (3, 0):
     from functools import reduce
 
+import django
 from django.db.models import Q
 from django.db import models, transaction, router, connections
 
 from treebeard.exceptions import InvalidPosition, MissingNodeOrderBy
+from treebeard.instrumentation import instrumented
+
+
+class NodeQuerySet(models.query.QuerySet):
+    """
+    Base queryset for the tree node managers.
+
+    Adds :meth:`with_parents`, to resolve the parents of all the nodes of the
+    queryset at once.
+    """
+
+    _with_parents = False
+
+    def with_parents(self):
+        """
+        :returns: A copy of the queryset that, when evaluated, fetches the
+            parents of all its nodes with :meth:`Node.annotate_parents`, so
+            :meth:`Node.get_parent` won't need to query the database for any
+            of them.
+        """
+        clone = self._clone()
+        clone._with_parents = True
+        return clone
+
+    def _clone(self, *args, **kwargs):
+        clone = super(NodeQuerySet, self)._clone(*args, **kwargs)
+        clone._with_parents = self._with_parents
+        return clone
+
+    def _fetch_all(self):
+        fetched = self._result_cache is None
+        super(NodeQuerySet, self)._fetch_all()
+        if fetched and self._with_parents:
+            # values() and values_list() querysets don't return nodes
+            self.model.annotate_parents([
+                obj for obj in self._result_cache if isinstance(obj, Node)])
 
 
 class Node(models.Model):
@@ -17,6 +54,9 @@ class Node(models.Model):
 
     _db_connection = None
 
+    # number of nodes written per INSERT/UPDATE by the bulk operations
+    bulk_batch_size = 500
+
     @classmethod
     def add_root(cls, **kwargs):  # pragma: no cover
         """
@@ -53,17 +93,110 @@ class Node(models.Model):
         return foreign_keys
 
     @classmethod
-    def _process_foreign_keys(cls, foreign_keys, node_data):
+    def _process_foreign_keys(cls, foreign_keys, node_data,
+                              foreign_objects=None):
         """For each foreign key try to load the actual object so load_bulk
         doesn't fail trying to load an int where django expects a
         model instance
+
+        :param foreign_objects: The related objects already loaded by
+            :meth:`_get_foreign_objects`. If not given, every related object
+            is loaded with its own query.
         """
         for key in foreign_keys.keys():
             if key in node_data:
-                node_data[key] = foreign_keys[key].objects.get(
-                    pk=node_data[key])
+                model = foreign_keys[key]
+                if foreign_objects is None:
+                    node_data[key] = model.objects.get(pk=node_data[key])
+                elif not isinstance(node_data[key], model):
+                    node_data[key] = foreign_objects[model][
+                        model._meta.pk.to_python(node_data[key])]
+
+    @classmethod
+    def _get_foreign_objects(cls, foreign_keys, bulk_data):
+        """
+        Loads all the objects referenced by the foreign keys of the nodes in
+        a :meth:`load_bulk` structure, with one ``in_bulk`` query per related
+        model (and batch of :attr:`bulk_batch_size` keys).
+
+        :returns: A dictionary of related models, with a dictionary of
+            primary keys and objects as values.
+
+        :raise DoesNotExist: when a referenced object doesn't exist
+        """
+        keys = dict((model, set()) for model in foreign_keys.values())
+        stack = list(bulk_data)
+        while stack:
+            node_struct = stack.pop()
+            node_data = node_struct['data']
+            for key, model in foreign_keys.items():
+                if key in node_data and not isinstance(node_data[key],
+                                                       model):
+                    keys[model].add(
+                        model._meta.pk.to_python(node_data[key]))
+            stack.extend(node_struct.get('children', []))
+
+        foreign_objects = {}
+        for model, pks in keys.items():
+            pks = list(pks)
+            foreign_objects[model] = {}
+            for start in range(0, len(pks), cls.bulk_batch_size):
+                foreign_objects[model].update(model.objects.in_bulk(
+                    pks[start:start + cls.bulk_batch_size]))
+            missing = set(pks) - set(foreign_objects[model])
+            if missing:
+                raise model.DoesNotExist(
+                    '%s matching query does not exist: %s' % (
+                        model._meta.object_name,
+                        ', '.join(str(pk) for pk in sorted(missing))))
+        return foreign_objects
 
     @classmethod
+    def _get_batch_size(cls, connection, params, objs):
+        """
+        :param connection: The database connection that will run the
+            queries.
+        :param params: The number of query parameters used by every object.
+        :param objs: The list of objects that will be written or read.
+
+        :returns: The number of objects to handle per query, up to
+            :attr:`bulk_batch_size` and never less than 1 (``range`` can't
+            step by 0, even if ``objs`` is empty).
+        """
+        return max(1, min(cls.bulk_batch_size, connection.ops.bulk_batch_size(
+            [None] * params, objs)))
+
+    @classmethod
+    def _can_bulk_create(cls):
+        """
+        :returns: ``True`` if the nodes of this model can be written with
+            ``bulk_create`` (that is: the model doesn't use multi-table
+            inheritance, and it isn't a proxy model in Django 1.8).
+        """
+        if django.VERSION < (1, 9) and cls._meta.parents:
+            return False
+        concrete_model = cls._meta.concrete_model
+        for parent in cls._meta.get_parent_list():
+            if parent._meta.concrete_model is not concrete_model:
+                return False
+        return True
+
+    @classmethod
+    def _get_bulk_node_obj(cls, foreign_keys, foreign_objects, node_struct,
+                           keep_ids):
+        """
+        :returns: An unsaved node object built from an element of the
+            structure passed to :meth:`load_bulk`
+        """
+        # shallow copy of the data strucure so it doesn't persist...
+        node_data = node_struct['data'].copy()
+        cls._process_foreign_keys(foreign_keys, node_data, foreign_objects)
+        if keep_ids:
+            node_data['id'] = node_struct['id']
+        return cls(**node_data)
+
+    @classmethod
+    @instrumented('load_bulk')
     def load_bulk(cls, bulk_data, parent=None, keep_ids=False):
         """
         Loads a list/dictionary structure to the tree.
@@ -103,12 +236,14 @@ class Node(models.Model):
         # stack of nodes to analize
         stack = [(parent, node) for node in bulk_data[::-1]]
         foreign_keys = cls.get_foreign_keys()
+        foreign_objects = cls._get_foreign_objects(foreign_keys, bulk_data)
 
         while stack:
             parent, node_struct = stack.pop()
             # shallow copy of the data strucure so it doesn't persist...
             node_data = node_struct['data'].copy()
-            cls._process_foreign_keys(foreign_keys, node_data)
+            cls._process_foreign_keys(foreign_keys, node_data,
+                                      foreign_objects)
             if keep_ids:
                 node_data['id'] = node_struct['id']
             if parent:
@@ -449,6 +584,21 @@ class Node(models.Model):
         """
         raise NotImplementedError
 
+    @classmethod
+    def annotate_parents(cls, nodes):
+        """
+        Caches the parents of many nodes at once, so :meth:`get_parent`
+        won't need to query the database for any of them.
+
+        :param nodes: An iterable of (saved) nodes.
+
+        :returns: A list with the nodes.
+        """
+        nodes = list(nodes)
+        for node in nodes:
+            node.get_parent()
+        return nodes
+
     def move(self, target, pos=None):  # pragma: no cover
         """
         Moves the current node and all it's descendants to a new position
@@ -501,6 +651,7 @@ class Node(models.Model):
         """
         raise NotImplementedError
 
+    @instrumented('delete')
     def delete(self):
         """Removes a node and all it's descendants."""
         self.__class__.objects.filter(pk=self.pk).delete()
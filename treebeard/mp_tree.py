@@ -7,12 +7,14 @@ if sys.version_info >= (3, 0):
     from functools import reduce
 
 from django.core import serializers
+from django.core.exceptions import FieldDoesNotExist
 from django.db import models, transaction, connection
-from django.db.models import F, Q
+from django.db.models import Case, F, Q, Value, When
 from django.utils.translation import ugettext_noop as _
 
 from treebeard.numconv import NumConv
-from treebeard.models import Node
+from treebeard.models import Node, NodeQuerySet
+from treebeard.instrumentation import instrumented
 from treebeard.exceptions import InvalidMoveToDescendant, PathOverflow,\
     NodeAlreadySaved
 
@@ -41,13 +43,14 @@ def get_result_class(cls):
         return base_class
 
 
-class MP_NodeQuerySet(models.query.QuerySet):
+class MP_NodeQuerySet(NodeQuerySet):
     """
     Custom queryset for the tree node manager.
 
     Needed only for the custom delete method.
     """
 
+    @instrumented('delete')
     def delete(self):
         """
         Custom delete method, will remove all descendant nodes to ensure a
@@ -55,47 +58,66 @@ class MP_NodeQuerySet(models.query.QuerySet):
 
         :returns: ``None``
         """
+        model = get_result_class(self.model)
+
         # we'll have to manually run through all the nodes that are going
         # to be deleted and remove nodes from the list if an ancestor is
         # already getting removed, since that would be redundant
+        has_numdescendants = model._has_numdescendants()
+        fields = ['path', 'numchild']
+        if has_numdescendants:
+            fields.append('numdescendants')
         removed = {}
-        for node in self.order_by('depth', 'path'):
+        for values in self.order_by('depth', 'path').values_list(*fields):
+            path = values[0]
             found = False
-            for depth in range(1, int(len(node.path) / node.steplen)):
-                path = node._get_basepath(node.path, depth)
-                if path in removed:
+            for depth in range(1, int(len(path) / model.steplen)):
+                if model._get_basepath(path, depth) in removed:
                     # we are already removing a parent of this node
                     # skip
                     found = True
                     break
             if not found:
-                removed[node.path] = node
+                removed[path] = values[1:]
+        if not removed:
+            return
 
         # ok, got the minimal list of nodes to remove...
         # we must also remove their children
-        # and update every parent node's numchild attribute
-        # LOTS OF FUN HERE!
-        parents = {}
-        toremove = []
-        for path, node in removed.items():
-            parentpath = node._get_basepath(node.path, node.depth - 1)
+        # and update every parent node's numchild attribute (and the
+        # numdescendants attribute of every ancestor)
+        parents, ancestors = {}, {}
+        for path, values in removed.items():
+            parentpath = model._get_parent_path_from_path(path)
             if parentpath:
-                if parentpath not in parents:
-                    parents[parentpath] = node.get_parent(True)
-                parent = parents[parentpath]
-                if parent and parent.numchild > 0:
-                    parent.numchild -= 1
-                    parent.save()
-            if node.is_leaf():
-                toremove.append(Q(path=node.path))
-            else:
-                toremove.append(Q(path__startswith=node.path))
-
-        # Django will handle this as a SELECT and then a DELETE of
-        # ids, and will deal with removing related objects
-        if toremove:
-            qset = get_result_class(self.model).objects.filter(reduce(operator.or_, toremove))
-            super(MP_NodeQuerySet, qset).delete()
+                parents[parentpath] = parents.get(parentpath, 0) + 1
+                if has_numdescendants:
+                    for ancestorpath in model._get_path_and_ancestors(
+                            parentpath):
+                        ancestors[ancestorpath] = (
+                            ancestors.get(ancestorpath, 0) + values[1] + 1)
+
+        connection = model._get_database_connection('write')
+        with transaction.atomic(using=connection.alias):
+            model._decrease_numchild(parents, ancestors)
+
+            paths = sorted(removed)
+            # every branch uses up to two query parameters
+            batch_size = model._get_batch_size(connection, 2, paths)
+            for start in range(0, len(paths), batch_size):
+                toremove, leaves = [], []
+                for path in paths[start:start + batch_size]:
+                    if removed[path][0]:
+                        toremove.append(model._get_branch_filter(path))
+                    else:
+                        leaves.append(path)
+                if leaves:
+                    toremove.append(Q(path__in=leaves))
+
+                # Django will handle this as a SELECT and then a DELETE of
+                # ids, and will deal with removing related objects
+                qset = model.objects.filter(reduce(operator.or_, toremove))
+                super(MP_NodeQuerySet, qset).delete()
 
 
 class MP_NodeManager(models.Manager):
@@ -118,14 +140,32 @@ class MP_ComplexAddMoveHandler(MP_AddHandler):
         for sql, vals in self.stmts:
             cursor.execute(sql, vals)
 
-    def get_sql_update_numchild(self, path, incdec='inc'):
-        """:returns: The sql needed the numchild value of a node"""
-        sql = "UPDATE %s SET numchild=numchild%s1"\
-              " WHERE path=%%s" % (
+    def get_sql_update_numchild(self, path, incdec='inc', numdescendants=1):
+        """
+        :returns: The sql needed the numchild value of a node (and, if the
+            model has a ``numdescendants`` field, to update it in the node
+            and its ancestors by ``numdescendants``)
+        """
+        if not self.node_cls._has_numdescendants():
+            sql = "UPDATE %s SET numchild=numchild%s1"\
+                  " WHERE path=%%s" % (
+                      connection.ops.quote_name(
+                          get_result_class(self.node_cls)._meta.db_table),
+                      {'inc': '+', 'dec': '-'}[incdec])
+            vals = [path]
+            return sql, vals
+
+        paths = self.node_cls._get_path_and_ancestors(path)
+        sql = "UPDATE %s SET numchild=CASE WHEN path=%%s"\
+              " THEN numchild%s1 ELSE numchild END,"\
+              " numdescendants=numdescendants%s%%s"\
+              " WHERE path IN (%s)" % (
                   connection.ops.quote_name(
                       get_result_class(self.node_cls)._meta.db_table),
-                  {'inc': '+', 'dec': '-'}[incdec])
-        vals = [path]
+                  {'inc': '+', 'dec': '-'}[incdec],
+                  {'inc': '+', 'dec': '-'}[incdec],
+                  ', '.join(['%s'] * len(paths)))
+        vals = [path, numdescendants] + paths
         return sql, vals
 
     def reorder_nodes_before_add_or_move(self, pos, newpos, newdepth, target,
@@ -143,7 +183,7 @@ class MP_ComplexAddMoveHandler(MP_AddHandler):
         ):
             # easy, the last node
             last = target.get_last_sibling()
-            newpath = last._inc_path()
+            newpath = last._get_next_sibling_path()
             if movebranch:
                 self.stmts.append(
                     self.get_sql_newpath_in_branches(oldpath, newpath))
@@ -160,6 +200,13 @@ class MP_ComplexAddMoveHandler(MP_AddHandler):
                           'left': basenum,
                           'right': basenum + 1}[pos]
 
+            if self.node_cls.gap > 1:
+                # if there is a hole where the node goes, the siblings
+                # don't need to be moved
+                holepos = self.get_pos_in_hole(newpos, newdepth, target)
+                if holepos is not None:
+                    newpos, siblings = holepos, []
+
             newpath = self.node_cls._get_path(target.path, newdepth, newpos)
 
             # If the move is amongst siblings and is to the left and there
@@ -202,12 +249,18 @@ class MP_ComplexAddMoveHandler(MP_AddHandler):
                 priorpath = node._inc_path()
             movesiblings.reverse()
 
+            # long runs of siblings are shifted with a couple of statements
+            shiftstmts = None
+            if len(movesiblings) > 2:
+                shiftstmts = self.get_sql_shift_siblings(movesiblings)
+
             for node in movesiblings:
                 # moving the siblings (and their branches) at the right of the
                 # related position one step to the right
                 sql, vals = self.get_sql_newpath_in_branches(
                     node.path, node._inc_path())
-                self.stmts.append((sql, vals))
+                if shiftstmts is None:
+                    self.stmts.append((sql, vals))
 
                 if movebranch:
                     if oldpath.startswith(node.path):
@@ -219,6 +272,8 @@ class MP_ComplexAddMoveHandler(MP_AddHandler):
                         # django made for us, since the update won't do it
                         # maybe useful in loops
                         target.path = vals[0] + target.path[len(vals[0]):]
+            if shiftstmts is not None:
+                self.stmts.extend(shiftstmts)
             if movebranch:
                 # node to move
                 if tempnewpath:
@@ -231,6 +286,113 @@ class MP_ComplexAddMoveHandler(MP_AddHandler):
                             oldpath, newpath))
         return oldpath, newpath
 
+    def get_pos_in_hole(self, newpos, newdepth, target):
+        """
+        :returns: The step in the middle of the hole between the siblings
+            next to ``newpos`` (the siblings of ``target``), or ``None`` if
+            there is no hole.
+        """
+        cls = get_result_class(self.node_cls)
+        newpath = cls._get_path(target.path, newdepth, newpos)
+        siblings = cls.objects.filter(
+            depth=newdepth,
+            path__range=cls._get_children_path_interval(
+                cls._get_basepath(target.path, newdepth - 1))
+        ).values_list('path', flat=True)
+        nextpath = siblings.filter(path__gte=newpath).order_by('path').first()
+        if nextpath is None:
+            return None
+        prevpath = siblings.filter(path__lt=newpath).order_by('-path').first()
+        nextstep = cls._str2int(nextpath[-cls.steplen:])
+        prevstep = cls._str2int(prevpath[-cls.steplen:]) if prevpath else 0
+        if nextstep - prevstep < 2:
+            return None
+        return prevstep + (nextstep - prevstep) // 2
+
+    def get_sql_shift_siblings(self, movesiblings):
+        """
+        :param movesiblings: A run of consecutive siblings, sorted from right
+            to left.
+
+        :returns: The sql statements needed to move the siblings (and their
+            branches) one step to the right, or ``None`` if there is no room
+            to do it with set based updates.
+
+        The siblings are moved first after the last sibling (leaving room
+        for a temporary position of a moved node), and then to their final
+        positions, so the paths are unique after every statement.
+        """
+        cls = self.node_cls
+        laststep = movesiblings[0].get_last_sibling()._get_lastpos_in_path()
+        firststep = movesiblings[-1]._get_lastpos_in_path()
+        runsteps = movesiblings[0]._get_lastpos_in_path() - firststep + 1
+        tempstep = laststep + 3
+        if tempstep + runsteps > len(cls.alphabet) ** cls.steplen:
+            return None
+        parentpath = movesiblings[0].path[:-cls.steplen]
+        return [
+            self.get_sql_shift_steps(parentpath, firststep, runsteps,
+                                     tempstep - firststep),
+            self.get_sql_shift_steps(parentpath, tempstep, runsteps,
+                                     firststep + 1 - tempstep)]
+
+    def get_sql_shift_steps(self, parentpath, firststep, numsteps, offset):
+        """
+        :returns: The sql needed to add ``offset`` to the last step of the
+            path of ``numsteps`` consecutive children of ``parentpath``
+            (starting at ``firststep``), and to their branches.
+        """
+        cls = self.node_cls
+        vendor = cls.get_database_vendor('write')
+        base = len(cls.alphabet)
+        start = len(parentpath) + 1
+
+        # the integer value of the step, decoded in sql
+        digits, digitvals = [], []
+        for pos in range(cls.steplen):
+            char = 'SUBSTR(path, %d, 1)' % (start + pos, )
+            if vendor == 'postgresql':
+                index = 'STRPOS(%%s, %s)' % (char, )
+            elif vendor == 'mysql':
+                # mysql only compares strings case sensitive if one of them
+                # is binary
+                index = 'LOCATE(BINARY %s, %%s)' % (char, )
+            else:
+                index = 'INSTR(%%s, %s)' % (char, )
+            digits.append('(%s - 1) * %d' % (
+                index, base ** (cls.steplen - pos - 1)))
+            digitvals.append(cls.alphabet)
+        step = '(%s)' % (' + '.join(digits), )
+        newstep = '(%s + (%d))' % (step, offset)
+
+        # and the new step, encoded in sql
+        div = ' DIV ' if vendor == 'mysql' else ' / '
+        pathparts, pathvals = ['%s'], [parentpath]
+        for pos in range(cls.steplen):
+            pathparts.append('SUBSTR(%%s, (%s%s%d) %%%% %d + 1, 1)' % (
+                newstep, div, base ** (cls.steplen - pos - 1), base))
+            pathvals.append(cls.alphabet)
+            pathvals.extend(digitvals)
+        if vendor == 'sqlite':
+            pathparts.append('SUBSTR(path, %d, LENGTH(path))' % (
+                start + cls.steplen, ))
+        else:
+            pathparts.append('SUBSTR(path, %d)' % (start + cls.steplen, ))
+        if vendor == 'mysql':
+            newpath = 'CONCAT(%s)' % (', '.join(pathparts), )
+        else:
+            newpath = '||'.join(pathparts)
+
+        sql = 'UPDATE %s SET path=%s WHERE %s BETWEEN %%s AND %%s' % (
+            connection.ops.quote_name(get_result_class(cls)._meta.db_table),
+            newpath, step)
+        vals = pathvals + digitvals + [firststep, firststep + numsteps - 1]
+        if parentpath:
+            branch_sql, branch_vals = cls._get_sql_branch_filter(parentpath)
+            sql += ' AND ' + branch_sql
+            vals.extend(branch_vals)
+        return sql, vals
+
     def get_sql_newpath_in_branches(self, oldpath, newpath):
         """
         :returns: The sql needed to move a branch to another position.
@@ -272,8 +434,10 @@ class MP_ComplexAddMoveHandler(MP_AddHandler):
             # TODO: FIND OUT WHY?!?? right now I'm just blaming mysql
             sql2.append("depth=LENGTH(%s)/%%s" % (sqlpath, ))
             vals.extend([newpath, len(oldpath) + 1, self.node_cls.steplen])
-        sql3 = "WHERE path LIKE %s"
-        vals.extend([oldpath + '%'])
+        branch_sql, branch_vals = self.node_cls._get_sql_branch_filter(
+            oldpath)
+        sql3 = "WHERE %s" % (branch_sql, )
+        vals.extend(branch_vals)
         sql = '%s %s %s' % (sql1, ', '.join(sql2), sql3)
         return sql, vals
 
@@ -296,10 +460,10 @@ class MP_AddRootHandler(MP_AddHandler):
 
         if last_root:
             # adding the new root node as the last one
-            newpath = last_root._inc_path()
+            newpath = last_root._get_next_sibling_path()
         else:
             # adding the first root node
-            newpath = self.cls._get_path(None, 1, 1)
+            newpath = self.cls._get_path(None, 1, self.cls._get_next_step(0))
 
         if len(self.kwargs) == 1 and 'instance' in self.kwargs:
             # adding the passed (unsaved) instance to the tree
@@ -330,6 +494,8 @@ class MP_AddChildHandler(MP_AddHandler):
             # there are child nodes and node_order_by has been set
             # delegate sorted insertion to add_sibling
             self.node.numchild += 1
+            if self.node_cls._has_numdescendants():
+                self.node.numdescendants += 1
             return self.node.get_last_child().add_sibling(
                 'sorted-sibling', **self.kwargs)
 
@@ -347,7 +513,7 @@ class MP_AddChildHandler(MP_AddHandler):
         if self.node.is_leaf():
             # the node had no children, adding the first child
             newobj.path = self.node_cls._get_path(
-                self.node.path, newobj.depth, 1)
+                self.node.path, newobj.depth, self.node_cls._get_next_step(0))
             max_length = self.node_cls._meta.get_field('path').max_length
             if len(newobj.path) > max_length:
                 raise PathOverflow(
@@ -356,19 +522,127 @@ class MP_AddChildHandler(MP_AddHandler):
                       ' and UPDATE your database'))
         else:
             # adding the new child as the last one
-            newobj.path = self.node.get_last_child()._inc_path()
+            newobj.path = self.node.get_last_child()._get_next_sibling_path()
         # saving the instance before returning it
         newobj.save()
         newobj._cached_parent_obj = self.node
 
-        get_result_class(self.node_cls).objects.filter(
-            path=self.node.path).update(numchild=F('numchild')+1)
+        self.node_cls._increase_numchild(self.node.path, 1, 1)
 
         # we increase the numchild value of the object in memory
         self.node.numchild += 1
+        if self.node_cls._has_numdescendants():
+            self.node.numdescendants += 1
         return newobj
 
 
+class MP_LoadBulkHandler(MP_AddHandler):
+    def __init__(self, cls, bulk_data, parent=None, keep_ids=False):
+        super(MP_LoadBulkHandler, self).__init__()
+        self.cls = cls
+        self.bulk_data = bulk_data
+        self.parent = parent
+        self.keep_ids = keep_ids
+
+    def process(self):
+        """
+        Calculates the path, depth and numchild values of every node in the
+        structure in memory, and writes the nodes with ``bulk_create``.
+
+        :returns: A list of the added node ids.
+        """
+        cls = self.cls
+        max_length = cls._meta.get_field('path').max_length
+
+        if self.parent:
+            parentpath = self.parent.path
+            last = self.parent.get_last_child()
+        else:
+            parentpath = ''
+            last = cls.get_last_root_node()
+        if last:
+            laststep = last._get_lastpos_in_path()
+        else:
+            laststep = 0
+
+        def get_steps(laststep, node_structs):
+            # the steps of the new siblings, in reverse order
+            steps = []
+            for node_struct in node_structs:
+                laststep = cls._get_next_step(laststep)
+                steps.append((laststep, node_struct))
+            steps.reverse()
+            return steps
+
+        # tree, iterative preorder, so the nodes are written (and their ids
+        # returned) in the same order the node by node insertion would use
+        newobjs = []
+        stack = [(parentpath, pos, node_struct)
+                 for pos, node_struct in get_steps(laststep, self.bulk_data)]
+        foreign_keys = cls.get_foreign_keys()
+        foreign_objects = cls._get_foreign_objects(foreign_keys,
+                                                   self.bulk_data)
+        while stack:
+            parentpath, pos, node_struct = stack.pop()
+            newobj = cls._get_bulk_node_obj(foreign_keys, foreign_objects,
+                                            node_struct, self.keep_ids)
+            key = cls._int2str(pos)
+            if len(key) > cls.steplen:
+                raise PathOverflow(
+                    _("Path Overflow from: '%s'" % (parentpath, )))
+            newobj.path = '{0}{1}{2}'.format(
+                parentpath, cls.alphabet[0] * (cls.steplen - len(key)), key)
+            if len(newobj.path) > max_length:
+                raise PathOverflow(
+                    _('The new node is too deep in the tree, try'
+                      ' increasing the path.max_length property'
+                      ' and UPDATE your database'))
+            newobj.depth = int(len(newobj.path) / cls.steplen)
+            children = node_struct.get('children', [])
+            newobj.numchild = len(children)
+            newobjs.append(newobj)
+            stack.extend([
+                (newobj.path, childpos, child_struct)
+                for childpos, child_struct in get_steps(0, children)
+            ])
+
+        if cls._has_numdescendants():
+            # the nodes are in preorder, so the descendants of a node are
+            # the nodes after it, until a node outside of its branch
+            opened = []
+            for pos, newobj in enumerate(newobjs):
+                while opened and not newobj.path.startswith(
+                        opened[-1][1].path):
+                    openpos, openobj = opened.pop()
+                    openobj.numdescendants = pos - openpos - 1
+                opened.append((pos, newobj))
+            for openpos, openobj in opened:
+                openobj.numdescendants = len(newobjs) - openpos - 1
+
+        added = []
+        for start in range(0, len(newobjs), cls.bulk_batch_size):
+            chunk = newobjs[start:start + cls.bulk_batch_size]
+            cls.objects.bulk_create(chunk)
+            if chunk[0].pk is None:
+                # the database backend doesn't return the ids of the
+                # inserted rows, the unique paths will tell us
+                ids = dict(cls.objects.filter(
+                    path__in=[obj.path for obj in chunk]
+                ).values_list('path', 'pk'))
+                for obj in chunk:
+                    obj.pk = ids[obj.path]
+            added.extend([obj.pk for obj in chunk])
+
+        if self.parent and self.bulk_data:
+            cls._increase_numchild(self.parent.path, len(self.bulk_data),
+                                   len(newobjs))
+            # we increase the numchild value of the object in memory
+            self.parent.numchild += len(self.bulk_data)
+            if cls._has_numdescendants():
+                self.parent.numdescendants += len(newobjs)
+        return added
+
+
 class MP_AddSiblingHandler(MP_ComplexAddMoveHandler):
     def __init__(self, node, pos, **kwargs):
         super(MP_AddSiblingHandler, self).__init__()
@@ -472,6 +746,13 @@ class MP_MoveHandler(MP_ComplexAddMoveHandler):
             if newpos is None:
                 self.pos = 'last-sibling'
 
+        if self.node_cls._has_numdescendants():
+            # read from the database before the nodes are reordered, since
+            # the moved node may be stale
+            self.numdescendants = get_result_class(
+                self.node_cls).objects.filter(path=oldpath).values_list(
+                'numdescendants', flat=True).get()
+
         # generate the sql that will do the actual moving of nodes
         oldpath, newpath = self.reorder_nodes_before_add_or_move(
             self.pos, newpos, newdepth, self.target, siblings, oldpath, True)
@@ -498,6 +779,11 @@ class MP_MoveHandler(MP_ComplexAddMoveHandler):
 
         oldparentpath = self.node_cls._get_parent_path_from_path(oldpath)
         newparentpath = self.node_cls._get_parent_path_from_path(newpath)
+        if self.node_cls._has_numdescendants():
+            # the size of the moved branch
+            numdescendants = self.numdescendants + 1
+        else:
+            numdescendants = 1
         if (
                 (not oldparentpath and newparentpath) or
                 (oldparentpath and not newparentpath) or
@@ -505,11 +791,11 @@ class MP_MoveHandler(MP_ComplexAddMoveHandler):
         ):
             # node changed parent, updating count
             if oldparentpath:
-                self.stmts.append(
-                    self.get_sql_update_numchild(oldparentpath, 'dec'))
+                self.stmts.append(self.get_sql_update_numchild(
+                    oldparentpath, 'dec', numdescendants))
             if newparentpath:
-                self.stmts.append(
-                    self.get_sql_update_numchild(newparentpath, 'inc'))
+                self.stmts.append(self.get_sql_update_numchild(
+                    newparentpath, 'inc', numdescendants))
 
     def update_move_to_child_vars(self):
         """Update preliminar vars in :meth:`move` when moving to a child"""
@@ -522,7 +808,7 @@ class MP_MoveHandler(MP_ComplexAddMoveHandler):
             newdepth += 1
             if self.target.is_leaf():
                 # moving as a target's first child
-                newpos = 1
+                newpos = self.node_cls._get_next_step(0)
                 self.pos = 'first-sibling'
                 siblings = get_result_class(self.node_cls).objects.none()
             else:
@@ -544,10 +830,11 @@ class MP_MoveHandler(MP_ComplexAddMoveHandler):
         :returns: The sql needed to update the depth of all the nodes in a
                   branch.
         """
-        sql = "UPDATE %s SET depth=LENGTH(path)/%%s WHERE path LIKE %%s" % (
+        branch_sql, branch_vals = self.node_cls._get_sql_branch_filter(path)
+        sql = "UPDATE %s SET depth=LENGTH(path)/%%s WHERE %s" % (
             connection.ops.quote_name(
-                get_result_class(self.node_cls)._meta.db_table), )
-        vals = [self.node_cls.steplen, path + '%']
+                get_result_class(self.node_cls)._meta.db_table), branch_sql)
+        vals = [self.node_cls.steplen] + branch_vals
         return sql, vals
 
 
@@ -581,6 +868,7 @@ class MP_Node(Node):
         return cls.numconv_obj_
 
     @classmethod
+    @instrumented('add_root')
     def add_root(cls, **kwargs):
         """
         Adds a root node to the tree.
@@ -595,6 +883,32 @@ class MP_Node(Node):
         """
         return MP_AddRootHandler(cls, **kwargs).process()
 
+    @classmethod
+    @instrumented('load_bulk')
+    def load_bulk(cls, bulk_data, parent=None, keep_ids=False):
+        """
+        Loads a list/dictionary structure to the tree.
+
+        The :attr:`path`, :attr:`depth` and :attr:`numchild` values of the
+        new nodes are calculated in memory and the nodes are written in
+        batches of :attr:`bulk_batch_size` nodes with ``bulk_create``, so
+        the number of queries doesn't grow with the number of nodes.
+
+        .. note::
+
+           Since the nodes are written with ``bulk_create``, the ``save()``
+           method of the model isn't called and no ``pre_save``/``post_save``
+           signals are sent. Models with :attr:`node_order_by` or using
+           multi-table inheritance (or proxy models, in Django 1.8) are
+           loaded node by node.
+
+        :raise PathOverflow: when the structure doesn't fit in the
+           :attr:`path` of the model
+        """
+        if cls.node_order_by or not cls._can_bulk_create():
+            return super(MP_Node, cls).load_bulk(bulk_data, parent, keep_ids)
+        return MP_LoadBulkHandler(cls, bulk_data, parent, keep_ids).process()
+
     @classmethod
     def dump_bulk(cls, parent=None, keep_ids=True):
         """Dumps a tree branch to a python data structure."""
@@ -606,7 +920,7 @@ class MP_Node(Node):
         # so no helper methods are used
         qset = cls._get_serializable_model().objects.all()
         if parent:
-            qset = qset.filter(path__startswith=parent.path)
+            qset = qset.filter(cls._get_branch_filter(parent.path))
         ret, lnk = [], {}
         for pyobj in serializers.serialize('python', qset):
             # django's serializer stores the attributes in 'fields'
@@ -617,6 +931,7 @@ class MP_Node(Node):
             del fields['depth']
             del fields['path']
             del fields['numchild']
+            fields.pop('numdescendants', None)
             if 'id' in fields:
                 # this happens immediately after a load_bulk
                 del fields['id']
@@ -658,46 +973,132 @@ class MP_Node(Node):
                   4. a list of ids of nodes with the wrong depth value for
                      their path
                   5. a list of ids nodes that report a wrong number of children
+
+        The checks are done with a single query in PostgreSQL, MySQL and
+        SQLite, and reading the nodes with a single query in other databases.
         """
         cls = get_result_class(cls)
+        if cls.get_database_vendor('read') in ('postgresql', 'mysql',
+                                               'sqlite'):
+            return cls._find_problems_with_sql()
+        return cls._find_problems_streaming()
+
+    @classmethod
+    def _find_problems_with_sql(cls):
+        """
+        :returns: The same lists as :meth:`find_problems`, found with a
+            single query that classifies every node.
+        """
+        qn = cls._get_database_connection('read').ops.quote_name
+        vendor = cls.get_database_vendor('read')
+        # paths with characters not found in the alphabet
+        if vendor == 'postgresql':
+            unknown_chars = "LENGTH(TRANSLATE(N.path, %s, '')) > 0"
+            vals = [cls.alphabet]
+        elif vendor == 'sqlite':
+            # in a GLOB set, ] must be the first character and - the last
+            chars = sorted(set(cls.alphabet),
+                           key=lambda char: {']': 0, '-': 2}.get(char, 1))
+            unknown_chars = 'N.path GLOB %s'
+            vals = ['*[^%s]*' % (''.join(chars), )]
+        else:
+            unknown_chars, vals = 'N.path', []
+            for char in cls.alphabet:
+                unknown_chars = "REPLACE(%s, %%s, '')" % (unknown_chars, )
+                vals.append(char)
+            unknown_chars = 'LENGTH(%s) > 0' % (unknown_chars, )
+        sql = ('SELECT id, problem FROM ('
+               ' SELECT N.%(pk)s AS id, N.path AS path, CASE'
+               '  WHEN %(unknown_chars)s THEN 0'
+               '  WHEN LENGTH(N.path) %%%% %(steplen)d <> 0 THEN 1'
+               '  WHEN LENGTH(N.path) > %(steplen)d AND NOT EXISTS ('
+               '   SELECT 1 FROM %(table)s AS P'
+               '   WHERE P.path = SUBSTR(N.path, 1,'
+               '                         LENGTH(N.path) - %(steplen)d))'
+               '  THEN 2'
+               '  WHEN N.depth <> LENGTH(N.path) / %(steplen)d THEN 3'
+               '  WHEN N.numchild <> COALESCE(C.numchild, 0) THEN 4'
+               '  END AS problem'
+               ' FROM %(table)s AS N'
+               ' LEFT JOIN ('
+               '  SELECT SUBSTR(path, 1, LENGTH(path) - %(steplen)d)'
+               '   AS parentpath, COUNT(1) AS numchild'
+               '  FROM %(table)s'
+               '  WHERE LENGTH(path) > %(steplen)d'
+               '   AND SUBSTR(path, LENGTH(path) - %(steplen)d + 1)'
+               '    BETWEEN %%s AND %%s'
+               '  GROUP BY SUBSTR(path, 1, LENGTH(path) - %(steplen)d)'
+               ' ) AS C ON C.parentpath = N.path'
+               ') AS problems'
+               ' WHERE problem IS NOT NULL'
+               ' ORDER BY path') % {
+                   'pk': qn(cls._meta.pk.column),
+                   'table': qn(cls._meta.db_table),
+                   'steplen': cls.steplen,
+                   'unknown_chars': unknown_chars}
+        # only the steps in _get_children_path_interval count as children
+        vals.extend([cls.alphabet[0] * cls.steplen,
+                     cls.alphabet[-1] * cls.steplen])
+        cursor = cls._get_database_cursor('read')
+        cursor.execute(sql, vals)
+        problems = ([], [], [], [], [])
+        for pk, problem in cursor.fetchall():
+            problems[problem].append(pk)
+        return problems
 
+    @classmethod
+    def _find_problems_streaming(cls):
+        """
+        :returns: The same lists as :meth:`find_problems`, found reading the
+            nodes with a single query and keeping only the number of
+            children of every path in memory.
+        """
         evil_chars, bad_steplen, orphans = [], [], []
         wrong_depth, wrong_numchild = [], []
-        for node in cls.objects.all():
-            found_error = False
-            for char in node.path:
-                if char not in cls.alphabet:
-                    evil_chars.append(node.pk)
-                    found_error = True
-                    break
-            if found_error:
+        alphabet = set(cls.alphabet)
+        firststep = cls.alphabet[0] * cls.steplen
+        laststep = cls.alphabet[-1] * cls.steplen
+        # [pk, numchild or None if not checked, real numchild] of every path
+        numchild = {}
+        paths = []
+        for pk, path, depth, node_numchild in cls.objects.order_by(
+                'path').values_list('pk', 'path', 'depth',
+                                    'numchild').iterator():
+            parentpath = path[:-cls.steplen]
+            if (
+                    parentpath in numchild and
+                    firststep <= path[-cls.steplen:] <= laststep
+            ):
+                # a node with characters not found in the alphabet is still
+                # a child if its step is in _get_children_path_interval
+                numchild[parentpath][2] += 1
+            if not alphabet.issuperset(path):
+                evil_chars.append(pk)
                 continue
-            if len(node.path) % cls.steplen:
-                bad_steplen.append(node.pk)
+            if len(path) % cls.steplen:
+                bad_steplen.append(pk)
                 continue
-            try:
-                node.get_parent(True)
-            except cls.DoesNotExist:
-                orphans.append(node.pk)
+            # orphans are kept too, so their children are not orphans
+            numchild[path] = [pk, None, 0]
+            if parentpath and parentpath not in numchild:
+                orphans.append(pk)
                 continue
-
-            if node.depth != int(len(node.path) / cls.steplen):
-                wrong_depth.append(node.pk)
+            if depth != int(len(path) / cls.steplen):
+                wrong_depth.append(pk)
                 continue
+            numchild[path][1] = node_numchild
+            paths.append(path)
 
-            real_numchild = cls.objects.filter(
-                path__range=cls._get_children_path_interval(node.path)
-            ).extra(
-                where=['LENGTH(path)/%d=%d' % (cls.steplen, node.depth + 1)]
-            ).count()
-            if real_numchild != node.numchild:
-                wrong_numchild.append(node.pk)
-                continue
+        for path in paths:
+            pk, node_numchild, real_numchild = numchild[path]
+            if node_numchild is not None and node_numchild != real_numchild:
+                wrong_numchild.append(pk)
 
         return evil_chars, bad_steplen, orphans, wrong_depth, wrong_numchild
 
     @classmethod
-    def fix_tree(cls, destructive=False):
+    @instrumented('fix_tree')
+    def fix_tree(cls, destructive=False, parent=None):
         """
         Solves some problems that can appear when transactions are not used and
         a piece of code breaks, leaving the tree in an inconsistent state.
@@ -721,25 +1122,22 @@ class MP_Node(Node):
             ``numchild`` nodes, it won't fix the tree holes or broken path
             ordering.
 
-            .. warning::
-
-               Currently what the ``destructive`` method does is:
+            The ``destructive`` method calculates compact and correctly
+            ordered paths for all the nodes, and updates the nodes with wrong
+            values in place (in batches of :attr:`bulk_batch_size` nodes), so
+            the primary keys of the nodes and the foreign keys pointing to
+            them are preserved.
 
-               1. Backup the tree with :meth:`dump_data`
-               2. Remove all nodes in the tree.
-               3. Restore the tree with :meth:`load_data`
+        :param parent:
 
-               So, even when the primary keys of your nodes will be preserved,
-               this method isn't foreign-key friendly. That needs complex
-               in-place tree reordering, not available at the moment (hint:
-               patches are welcome).
+            A node. If given (and ``destructive`` is True), only the
+            descendants of the node are fixed, so big trees can be fixed one
+            branch at a time in short transactions.
         """
         cls = get_result_class(cls)
 
         if destructive:
-            dump = cls.dump_bulk(None, True)
-            cls.objects.all().delete()
-            cls.load_bulk(dump, None, True)
+            cls._compact_paths(parent)
         else:
             cursor = cls._get_database_cursor('write')
 
@@ -753,37 +1151,327 @@ class MP_Node(Node):
             cursor.execute(sql, vals)
 
             # fix the numchild field
-            vals = ['_' * cls.steplen]
-            # the cake and sql portability are a lie
-            if cls.get_database_vendor('read') == 'mysql':
-                sql = "SELECT tbn1.path, tbn1.numchild, ("\
-                      "SELECT COUNT(1) "\
-                      "FROM %(table)s AS tbn2 "\
-                      "WHERE tbn2.path LIKE "\
-                      "CONCAT(tbn1.path, %%s)) AS real_numchild "\
-                      "FROM %(table)s AS tbn1 "\
-                      "HAVING tbn1.numchild != real_numchild" % {
-                          'table': connection.ops.quote_name(
-                              cls._meta.db_table)}
-            else:
-                subquery = "(SELECT COUNT(1) FROM %(table)s AS tbn2"\
-                           " WHERE tbn2.path LIKE tbn1.path||%%s)"
-                sql = ("SELECT tbn1.path, tbn1.numchild, " + subquery +
-                       " FROM %(table)s AS tbn1 WHERE tbn1.numchild != " +
-                       subquery)
-                sql = sql % {
-                    'table': connection.ops.quote_name(cls._meta.db_table)}
-                # we include the subquery twice
-                vals *= 2
-            cursor.execute(sql, vals)
-            sql = "UPDATE %(table)s "\
-                  "SET numchild=%%s "\
-                  "WHERE path=%%s" % {
-                      'table': connection.ops.quote_name(cls._meta.db_table)}
-            for node_data in cursor.fetchall():
-                vals = [node_data[2], node_data[0]]
+            for sql, vals in cls._get_sql_fix_numchild():
                 cursor.execute(sql, vals)
 
+            if cls._has_numdescendants():
+                # and the numdescendants field
+                for sql, vals in cls._get_sql_fix_numdescendants():
+                    cursor.execute(sql, vals)
+
+    @classmethod
+    def _get_sql_fix_numchild(cls):
+        """
+        :returns: A list of the (sql, values) statements needed to fix the
+            numchild value of all the nodes, counting the children of every
+            path with a single grouped subquery.
+        """
+        vendor = cls.get_database_vendor('write')
+        sqlvars = {
+            'table': connection.ops.quote_name(cls._meta.db_table),
+            'pk': connection.ops.quote_name(cls._meta.pk.column),
+            'steplen': cls.steplen}
+        sqlvars['counts'] = (
+            '(SELECT SUBSTR(path, 1, LENGTH(path) - %(steplen)d)'
+            '  AS parentpath, COUNT(1) AS numchild'
+            ' FROM %(table)s'
+            ' WHERE LENGTH(path) > %(steplen)d'
+            ' GROUP BY SUBSTR(path, 1, LENGTH(path) - %(steplen)d))'
+        ) % sqlvars
+        if vendor == 'postgresql':
+            sql = ('UPDATE %(table)s AS N'
+                   ' SET numchild = COALESCE(C.numchild, 0)'
+                   ' FROM %(table)s AS N2'
+                   ' LEFT JOIN %(counts)s AS C ON C.parentpath = N2.path'
+                   ' WHERE N2.%(pk)s = N.%(pk)s'
+                   ' AND N.numchild <> COALESCE(C.numchild, 0)')
+        elif vendor == 'mysql':
+            sql = ('UPDATE %(table)s AS N'
+                   ' LEFT JOIN %(counts)s AS C ON C.parentpath = N.path'
+                   ' SET N.numchild = COALESCE(C.numchild, 0)'
+                   ' WHERE N.numchild <> COALESCE(C.numchild, 0)')
+        elif vendor == 'sqlite':
+            # sqlite can't join in an UPDATE: the counts are stored in a
+            # temporary table once, and looked up by its primary key
+            sqlvars['temp'] = 'treebeard_fix_numchild'
+            return [(sql % sqlvars, []) for sql in (
+                'DROP TABLE IF EXISTS temp.%(temp)s',
+                'CREATE TEMP TABLE %(temp)s'
+                ' (parentpath TEXT PRIMARY KEY, numchild INTEGER)',
+                'INSERT INTO %(temp)s SELECT * FROM %(counts)s',
+                'UPDATE %(table)s'
+                ' SET numchild = COALESCE((SELECT C.numchild'
+                '  FROM %(temp)s AS C'
+                '  WHERE C.parentpath = %(table)s.path), 0)'
+                ' WHERE %(pk)s IN (SELECT N.%(pk)s FROM %(table)s AS N'
+                '  LEFT JOIN %(temp)s AS C ON C.parentpath = N.path'
+                '  WHERE N.numchild <> COALESCE(C.numchild, 0))',
+                'DROP TABLE temp.%(temp)s')]
+        else:
+            count = ('COALESCE((SELECT C.numchild FROM %(counts)s AS C'
+                     ' WHERE C.parentpath = %(table)s.path), 0)')
+            sql = ('UPDATE %(table)s'
+                   ' SET numchild = ' + count +
+                   ' WHERE numchild <> ' + count)
+        return [(sql % sqlvars, [])]
+
+    @classmethod
+    def _get_sql_fix_numdescendants(cls):
+        """
+        :returns: A list of the (sql, values) statements needed to fix the
+            numdescendants value of all the nodes, counting the descendants
+            of every path with a single grouped subquery.
+        """
+        vendor = cls.get_database_vendor('write')
+        sqlvars = {
+            'table': connection.ops.quote_name(cls._meta.db_table),
+            'pk': connection.ops.quote_name(cls._meta.pk.column)}
+        # the descendants of a path are a range of paths, up to the path
+        # followed by the last digit of the alphabet, as many times as
+        # needed to fill the path field
+        if vendor == 'mysql':
+            sqlvars['last'] = 'CONCAT(A.path, %s)'
+        else:
+            sqlvars['last'] = 'A.path||%s'
+        sqlvars['counts'] = (
+            '(SELECT A.path AS path, COUNT(D.path) AS numdescendants'
+            ' FROM %(table)s AS A'
+            ' LEFT JOIN %(table)s AS D'
+            ' ON D.path > A.path AND D.path <= %(last)s'
+            ' GROUP BY A.path)'
+        ) % sqlvars
+        padding = cls.alphabet[-1] * cls._meta.get_field('path').max_length
+        if vendor == 'postgresql':
+            sql = ('UPDATE %(table)s AS N'
+                   ' SET numdescendants = C.numdescendants'
+                   ' FROM %(counts)s AS C'
+                   ' WHERE C.path = N.path'
+                   ' AND N.numdescendants <> C.numdescendants')
+            vals = [padding]
+        elif vendor == 'mysql':
+            sql = ('UPDATE %(table)s AS N'
+                   ' INNER JOIN %(counts)s AS C ON C.path = N.path'
+                   ' SET N.numdescendants = C.numdescendants'
+                   ' WHERE N.numdescendants <> C.numdescendants')
+            vals = [padding]
+        elif vendor == 'sqlite':
+            # sqlite can't join in an UPDATE: the counts are stored in a
+            # temporary table once, and looked up by its primary key
+            sqlvars['temp'] = 'treebeard_fix_numdescendants'
+            return [(sql % sqlvars, vals) for sql, vals in (
+                ('DROP TABLE IF EXISTS temp.%(temp)s', []),
+                ('CREATE TEMP TABLE %(temp)s'
+                 ' (path TEXT PRIMARY KEY, numdescendants INTEGER)', []),
+                ('INSERT INTO %(temp)s SELECT * FROM %(counts)s', [padding]),
+                ('UPDATE %(table)s'
+                 ' SET numdescendants = (SELECT C.numdescendants'
+                 '  FROM %(temp)s AS C WHERE C.path = %(table)s.path)'
+                 ' WHERE %(pk)s IN (SELECT N.%(pk)s FROM %(table)s AS N'
+                 '  INNER JOIN %(temp)s AS C ON C.path = N.path'
+                 '  WHERE N.numdescendants <> C.numdescendants)', []),
+                ('DROP TABLE temp.%(temp)s', []))]
+        else:
+            count = ('(SELECT C.numdescendants FROM %(counts)s AS C'
+                     ' WHERE C.path = %(table)s.path)')
+            sql = ('UPDATE %(table)s'
+                   ' SET numdescendants = ' + count +
+                   ' WHERE numdescendants <> ' + count)
+            # we include the subquery twice
+            vals = [padding] * 2
+        return [(sql % sqlvars, vals)]
+
+    @classmethod
+    def _compact_paths(cls, parent=None):
+        """
+        Recalculates the paths (and the depth, numchild and numdescendants
+        values) of all the nodes of the tree, or of the descendants of
+        ``parent``, and updates the nodes with wrong values.
+
+        Nodes with a missing parent are added to their closest ancestor.
+        """
+        cls = get_result_class(cls)
+        max_length = cls._meta.get_field('path').max_length
+        if parent:
+            rootpath = parent.path
+            nodes = cls.objects.filter(
+                cls._get_branch_filter(rootpath)).exclude(pk=parent.pk)
+        else:
+            rootpath = ''
+            nodes = cls.objects.all()
+        nodes = nodes.order_by(*(list(cls.node_order_by) + ['path']))
+        fields = ['path', 'depth', 'numchild']
+        if cls._has_numdescendants():
+            fields.append('numdescendants')
+
+        connection = cls._get_database_connection('write')
+        with transaction.atomic(using=connection.alias):
+            oldvalues, paths, children = {}, [], {}
+            for values in nodes.values_list('pk', *fields).iterator():
+                oldvalues[values[1]] = (values[0], list(values[1:]))
+                paths.append(values[1])
+            for path in paths:
+                parentpath = path[:-cls.steplen]
+                while (
+                        len(parentpath) > len(rootpath) and
+                        parentpath not in oldvalues
+                ):
+                    parentpath = parentpath[:-cls.steplen]
+                if parentpath not in oldvalues:
+                    parentpath = rootpath
+                children.setdefault(parentpath, []).append(path)
+
+            # the new values of every node, in DFS order
+            newvalues = []
+            stack = [(rootpath, rootpath)]
+            while stack:
+                oldpath, newpath = stack.pop()
+                step = 0
+                childpaths = []
+                for childpath in children.get(oldpath, []):
+                    step = cls._get_next_step(step)
+                    key = cls._int2str(step)
+                    if len(key) > cls.steplen:
+                        raise PathOverflow(
+                            _("Path Overflow from: '%s'" % (newpath, )))
+                    newchildpath = '{0}{1}{2}'.format(
+                        newpath, cls.alphabet[0] * (cls.steplen - len(key)),
+                        key)
+                    if len(newchildpath) > max_length:
+                        raise PathOverflow(
+                            _('The new node is too deep in the tree, try'
+                              ' increasing the path.max_length property'
+                              ' and UPDATE your database'))
+                    newvalues.append((childpath, [
+                        newchildpath,
+                        int(len(newchildpath) / cls.steplen),
+                        len(children.get(childpath, []))]))
+                    childpaths.append((childpath, newchildpath))
+                stack.extend(reversed(childpaths))
+
+            if 'numdescendants' in fields:
+                # the nodes are in DFS order, so the children of a node are
+                # counted before the node
+                numdescendants = {}
+                for oldpath, values in reversed(newvalues):
+                    values.append(sum(
+                        numdescendants[childpath] + 1
+                        for childpath in children.get(oldpath, [])))
+                    numdescendants[oldpath] = values[-1]
+
+            if parent:
+                numchild = len(children.get(rootpath, []))
+                cls.objects.filter(pk=parent.pk).exclude(
+                    numchild=numchild).update(numchild=numchild)
+                parent.numchild = numchild
+                if 'numdescendants' in fields:
+                    difference = len(paths) - parent.numdescendants
+                    if difference:
+                        cls.objects.filter(
+                            path__in=cls._get_path_and_ancestors(rootpath)
+                        ).update(numdescendants=F('numdescendants') +
+                                 difference)
+                        parent.numdescendants = len(paths)
+
+            # the paths are unique, so the nodes with a new path are moved to
+            # a temporary (unused) path first
+            moved = [(oldvalues[oldpath][0], values[0])
+                     for oldpath, values in newvalues
+                     if oldpath != values[0]]
+            usedpaths = set(oldvalues)
+            usedpaths.update(newpath for _pk, newpath in moved)
+            temppaths = cls._get_unused_paths(rootpath, usedpaths)
+            cls._update_nodes(
+                [(pk, [next(temppaths)]) for pk, _newpath in moved], ['path'])
+            cls._update_nodes(
+                [(oldvalues[oldpath][0], values)
+                 for oldpath, values in newvalues
+                 if values != oldvalues[oldpath][1]],
+                fields)
+
+    @classmethod
+    def _get_unused_paths(cls, path, usedpaths):
+        """
+        :returns: A generator of paths starting with ``path`` that are not in
+            ``usedpaths``, as long as the ``path`` field allows (so they
+            are hardly ever used by any node).
+        """
+        max_length = cls._meta.get_field('path').max_length
+        length = int((max_length - len(path)) / cls.steplen) * cls.steplen
+        num = len(cls.alphabet) ** length
+        while num:
+            num -= 1
+            key = cls._int2str(num)
+            newpath = '{0}{1}{2}'.format(
+                path, cls.alphabet[0] * (length - len(key)), key)
+            if newpath not in usedpaths:
+                yield newpath
+        raise PathOverflow(_("Path Overflow from: '%s'" % (path, )))
+
+    @classmethod
+    def _update_nodes(cls, updates, fields):
+        """
+        Updates the values of some fields of many nodes, with an ``UPDATE``
+        statement per batch of :attr:`bulk_batch_size` nodes.
+
+        :param updates: A list of tuples with the primary key of a node and
+            the list of new values of ``fields``.
+        :param fields: A list of field names.
+        """
+        if not updates:
+            return
+        connection = cls._get_database_connection('write')
+        # every node uses two query parameters per field and its primary key
+        batch_size = cls._get_batch_size(connection, len(fields) * 2 + 1,
+                                         updates)
+        for start in range(0, len(updates), batch_size):
+            batch = updates[start:start + batch_size]
+            values = {}
+            for pos, name in enumerate(fields):
+                values[name] = Case(
+                    *[When(pk=pk, then=Value(newvalues[pos]))
+                      for pk, newvalues in batch],
+                    output_field=cls._meta.get_field(name))
+            cls.objects.filter(
+                pk__in=[pk for pk, _newvalues in batch]).update(**values)
+
+    @classmethod
+    def _decrease_numchild(cls, counts, descendants=None):
+        """
+        Decreases the numchild (and numdescendants) values of many nodes,
+        with an ``UPDATE`` statement per batch of :attr:`bulk_batch_size`
+        nodes.
+
+        :param counts: A dictionary with the paths of the nodes and the
+            number of children removed from every node.
+        :param descendants: A dictionary with the paths of the nodes and the
+            number of descendants removed from every node.
+        """
+        descendants = descendants or {}
+        fields = [(name, values) for name, values in (
+            ('numchild', counts), ('numdescendants', descendants)) if values]
+        if not fields:
+            return
+        paths = sorted(set(counts) | set(descendants))
+        connection = cls._get_database_connection('write')
+        # every node uses up to four query parameters per field, and its path
+        batch_size = cls._get_batch_size(connection, len(fields) * 4 + 1,
+                                         paths)
+        for start in range(0, len(paths), batch_size):
+            batch = paths[start:start + batch_size]
+            updates = {}
+            for name, values in fields:
+                decreased = [path for path in batch if path in values]
+                if not decreased:
+                    continue
+                whens = [When(then=F(name) - Value(values[path]),
+                              **{'path': path, name + '__gt': values[path]})
+                         for path in decreased]
+                # the values never go below zero
+                whens.append(When(path__in=decreased, then=Value(0)))
+                updates[name] = Case(
+                    *whens, default=F(name),
+                    output_field=cls._meta.get_field(name))
+            cls.objects.filter(path__in=batch).update(**updates)
 
     @classmethod
     def get_tree(cls, parent=None):
@@ -800,7 +1488,7 @@ class MP_Node(Node):
             return cls.objects.all()
         if parent.is_leaf():
             return cls.objects.filter(pk=parent.pk)
-        return cls.objects.filter(path__startswith=parent.path,
+        return cls.objects.filter(cls._get_branch_filter(parent.path),
                                   depth__gte=parent.depth)
 
     @classmethod
@@ -916,6 +1604,15 @@ class MP_Node(Node):
         """
         return self.__class__.get_tree(self).exclude(pk=self.pk)
 
+    def get_descendant_count(self):
+        """
+        :returns: the number of descendants of a node, without querying the
+            database if the model has a ``numdescendants`` field.
+        """
+        if self._has_numdescendants():
+            return self.numdescendants
+        return super(MP_Node, self).get_descendant_count()
+
     def get_prev_sibling(self):
         """
         :returns: The previous node's sibling, or None if it was the leftmost
@@ -961,6 +1658,7 @@ class MP_Node(Node):
         """
         return self.path.startswith(node.path) and self.depth > node.depth
 
+    @instrumented('add_child')
     def add_child(self, **kwargs):
         """
         Adds a child to the node.
@@ -975,6 +1673,7 @@ class MP_Node(Node):
         """
         return MP_AddChildHandler(self, **kwargs).process()
 
+    @instrumented('add_sibling')
     def add_sibling(self, pos=None, **kwargs):
         """
         Adds a new node as a sibling to the current node object.
@@ -1035,6 +1734,34 @@ class MP_Node(Node):
             self.__class__).objects.get(path=parentpath)
         return self._cached_parent_obj
 
+    @classmethod
+    def annotate_parents(cls, nodes):
+        """
+        Caches the parents of many nodes at once, so :meth:`get_parent`
+        won't need to query the database for any of them. The parents are
+        fetched by their paths, in batches of :attr:`bulk_batch_size` paths.
+
+        :param nodes: An iterable of (saved) nodes.
+
+        :returns: A list with the nodes.
+        """
+        nodes = list(nodes)
+        parentpaths = list(set(
+            cls._get_parent_path_from_path(node.path)
+            for node in nodes if len(node.path) > cls.steplen))
+        parents = {}
+        result_class = get_result_class(cls)
+        for start in range(0, len(parentpaths), cls.bulk_batch_size):
+            for parent in result_class.objects.filter(
+                    path__in=parentpaths[start:start + cls.bulk_batch_size]):
+                parents[parent.path] = parent
+        for node in nodes:
+            parentpath = cls._get_parent_path_from_path(node.path)
+            if parentpath in parents:
+                node._cached_parent_obj = parents[parentpath]
+        return nodes
+
+    @instrumented('move')
     def move(self, target, pos=None):
         """
         Moves the current node and all it's descendants to a new position
@@ -1081,6 +1808,25 @@ class MP_Node(Node):
             key
         )
 
+    @classmethod
+    def _get_next_step(cls, step):
+        """
+        :returns: The step of a node added after a sibling with the given
+            step (``0`` if there are no siblings), leaving a hole of
+            :attr:`gap` - 1 steps if there is room for it.
+        """
+        if step + cls.gap < len(cls.alphabet) ** cls.steplen:
+            return step + cls.gap
+        return step + 1
+
+    def _get_next_sibling_path(self):
+        """:returns: The path of a new node added after the node."""
+        newpos = self._get_next_step(self._get_lastpos_in_path())
+        if newpos == self._get_lastpos_in_path() + 1:
+            return self._inc_path()
+        return self._get_path(self.path, len(self.path) // self.steplen,
+                              newpos)
+
     def _get_lastpos_in_path(self):
         """:returns: The integer value of the last step in a path."""
         return self._str2int(self.path[-self.steplen:])
@@ -1098,6 +1844,80 @@ class MP_Node(Node):
         return (path + cls.alphabet[0] * cls.steplen,
                 path + cls.alphabet[-1] * cls.steplen)
 
+    @classmethod
+    def _get_branch_path_interval(cls, path):
+        """
+        :returns: A half-open interval of all the paths in the branch of a
+            path: the path itself and the first path after the branch, or
+            ``None`` if no path can come after the branch.
+        """
+        # the successor of the branch: the last digit that isn't the last
+        # one of the alphabet is increased, and the digits after it removed
+        prefix = path.rstrip(cls.alphabet[-1])
+        if not prefix:
+            return path, None
+        return path, prefix[:-1] + cls.alphabet[
+            cls.alphabet.index(prefix[-1]) + 1]
+
+    @classmethod
+    def _get_branch_filter(cls, path):
+        """
+        :returns: A ``Q`` object for the nodes in the branch of a path.
+
+        The branch is filtered as a range of paths instead of a prefix
+        (``LIKE``), since a prefix can't use the index of ``path`` in
+        sqlite or in postgresql with a non-C collation.
+        """
+        first, successor = cls._get_branch_path_interval(path)
+        if successor is None:
+            return Q(path__gte=first)
+        return Q(path__gte=first, path__lt=successor)
+
+    @classmethod
+    def _get_sql_branch_filter(cls, path):
+        """
+        :returns: The sql condition (and its values) for the nodes in the
+            branch of a path, like :meth:`_get_branch_filter`.
+        """
+        first, successor = cls._get_branch_path_interval(path)
+        if successor is None:
+            return 'path >= %s', [first]
+        return 'path >= %s AND path < %s', [first, successor]
+
+    @classmethod
+    def _get_path_and_ancestors(cls, path):
+        """:returns: A list with a path and the paths of its ancestors."""
+        return [path[:pos]
+                for pos in range(cls.steplen, len(path) + 1, cls.steplen)]
+
+    @classmethod
+    def _has_numdescendants(cls):
+        """:returns: ``True`` if the model has a ``numdescendants`` field."""
+        try:
+            cls._meta.get_field('numdescendants')
+        except FieldDoesNotExist:
+            return False
+        return True
+
+    @classmethod
+    def _increase_numchild(cls, path, numchild, numdescendants):
+        """
+        Increases the numchild value of a node and, if the model has a
+        ``numdescendants`` field, the numdescendants value of the node and
+        its ancestors, with a single ``UPDATE``.
+        """
+        nodes = get_result_class(cls).objects
+        if not cls._has_numdescendants():
+            nodes.filter(path=path).update(
+                numchild=F('numchild') + numchild)
+            return
+        nodes.filter(path__in=cls._get_path_and_ancestors(path)).update(
+            numchild=Case(
+                When(path=path, then=F('numchild') + numchild),
+                default=F('numchild'),
+                output_field=cls._meta.get_field('numchild')),
+            numdescendants=F('numdescendants') + numdescendants)
+
     class Meta:
         """Abstract model."""
         abstract = True
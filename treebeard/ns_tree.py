@@ -1,5 +1,6 @@
 """Nested Sets"""
 
+import bisect
 import sys
 import operator
 
@@ -7,12 +8,14 @@ if sys.version_info >= (3, 0):
     from functools import reduce
 
 from django.core import serializers
+from django.core.exceptions import FieldDoesNotExist
 from django.db import connection, models, transaction
-from django.db.models import Q
+from django.db.models import Case, F, Max, Min, Q, Value, When
 from django.utils.translation import ugettext_noop as _
 
 from treebeard.exceptions import InvalidMoveToDescendant, NodeAlreadySaved
-from treebeard.models import Node
+from treebeard.models import Node, NodeQuerySet
+from treebeard.instrumentation import instrumented
 
 
 def get_result_class(cls):
@@ -39,13 +42,14 @@ def get_result_class(cls):
         return base_class
 
 
-class NS_NodeQuerySet(models.query.QuerySet):
+class NS_NodeQuerySet(NodeQuerySet):
     """
     Custom queryset for the tree node manager.
 
     Needed only for the customized delete method.
     """
 
+    @instrumented('delete')
     def delete(self, removed_ranges=None):
         """
         Custom delete method, will remove all descendant nodes to ensure a
@@ -59,46 +63,42 @@ class NS_NodeQuerySet(models.query.QuerySet):
             # delete method and let it handle the removal of the user's
             # foreign keys...
             super(NS_NodeQuerySet, self).delete()
-            cursor = model._get_database_cursor('write')
-
-            # Now closing the gap (Celko's trees book, page 62)
-            # We do this for every gap that was left in the tree when the nodes
-            # were removed.  If many nodes were removed, we're going to update
-            # the same nodes over and over again. This would be probably
-            # cheaper precalculating the gapsize per intervals, or just do a
-            # complete reordering of the tree (uses COUNT)...
-            for tree_id, drop_lft, drop_rgt in sorted(removed_ranges,
-                                                      reverse=True):
-                sql, params = model._get_close_gap_sql(drop_lft, drop_rgt,
-                                                            tree_id)
-                cursor.execute(sql, params)
+            # Now closing the gaps (Celko's trees book, page 62)
+            model._close_gaps(removed_ranges)
         else:
             # we'll have to manually run through all the nodes that are going
             # to be deleted and remove nodes from the list if an ancestor is
-            # already getting removed, since that would be redundant
-            removed = {}
-            for node in self.order_by('tree_id', 'lft'):
-                found = False
-                for rid, rnode in removed.items():
-                    if node.is_descendant_of(rnode):
-                        found = True
-                        break
-                if not found:
-                    removed[node.pk] = node
+            # already getting removed, since that would be redundant.
+            # The nodes are sorted like in the tree, so a node is a
+            # descendant of an already removed node only if it's inside the
+            # range of the last one.
+            ranges = []
+            for tree_id, lft, rgt in self.order_by(
+                    'tree_id', 'lft').values_list('tree_id', 'lft', 'rgt'):
+                if (
+                        ranges and
+                        ranges[-1][0] == tree_id and
+                        lft < ranges[-1][2]
+                ):
+                    continue
+                ranges.append((tree_id, lft, rgt))
 
             # ok, got the minimal list of nodes to remove...
             # we must also remove their descendants
-            toremove = []
-            ranges = []
-            for id, node in removed.items():
-                toremove.append(Q(lft__range=(node.lft, node.rgt)) &
-                                Q(tree_id=node.tree_id))
-                ranges.append((node.tree_id, node.lft, node.rgt))
-            if toremove:
-                model.objects.filter(
-                    reduce(operator.or_,
-                           toremove)
-                ).delete(removed_ranges=ranges)
+            if ranges:
+                connection = model._get_database_connection('write')
+                # every range uses three query parameters
+                batch_size = model._get_batch_size(connection, 3, ranges)
+                with transaction.atomic(using=connection.alias):
+                    for start in range(0, len(ranges), batch_size):
+                        toremove = [
+                            Q(lft__range=(lft, rgt)) & Q(tree_id=tree_id)
+                            for tree_id, lft, rgt in ranges[
+                                start:start + batch_size]]
+                        qset = model.objects.filter(
+                            reduce(operator.or_, toremove))
+                        super(NS_NodeQuerySet, qset).delete()
+                    model._close_gaps(ranges)
 
 
 class NS_NodeManager(models.Manager):
@@ -117,10 +117,13 @@ class NS_Node(Node):
     rgt = models.PositiveIntegerField(db_index=True)
     tree_id = models.PositiveIntegerField(db_index=True)
     depth = models.PositiveIntegerField(db_index=True)
+    gap = 1
+    tree_id_gap = 1
 
     objects = NS_NodeManager()
 
     @classmethod
+    @instrumented('add_root')
     def add_root(cls, **kwargs):
         """Adds a root node to the tree."""
 
@@ -134,10 +137,10 @@ class NS_Node(Node):
 
         if last_root:
             # adding the new root node as the last one
-            newtree_id = last_root.tree_id + 1
+            newtree_id = last_root.tree_id + cls.tree_id_gap
         else:
             # adding the first root node
-            newtree_id = 1
+            newtree_id = cls.tree_id_gap
 
         if len(kwargs) == 1 and 'instance' in kwargs:
             # adding the passed (unsaved) instance to the tree
@@ -152,7 +155,9 @@ class NS_Node(Node):
         newobj.depth = 1
         newobj.tree_id = newtree_id
         newobj.lft = 1
-        newobj.rgt = 2
+        newobj.rgt = 1 + cls.gap
+        if cls._has_parent():
+            newobj.parent_id = None
         # saving the instance before returning it
         newobj.save()
         return newobj
@@ -190,6 +195,211 @@ class NS_Node(Node):
                   'tree_id': tree_id}
         return sql, []
 
+    @classmethod
+    def _get_new_tree_id(cls, target, pos):
+        """
+        :returns: The ``tree_id`` of a new tree at a position
+            (``first-sibling``, ``left`` or ``right``) relative to the root
+            node ``target``, and the sql (and its params) needed to make room
+            for it, or ``None`` if the new tree fits in a hole between the
+            ``tree_id`` values of the existing trees.
+        """
+        if cls.tree_id_gap == 1:
+            newtree_id = {'first-sibling': 1,
+                          'left': target.tree_id,
+                          'right': target.tree_id + 1}[pos]
+            sql, params = cls._move_tree_right(newtree_id)
+            return newtree_id, sql, params
+
+        roots = get_result_class(cls).get_root_nodes()
+        if pos == 'first-sibling':
+            prev_id = 0
+            next_id = roots.aggregate(Min('tree_id'))['tree_id__min']
+        elif pos == 'left':
+            prev_id = roots.filter(tree_id__lt=target.tree_id).aggregate(
+                Max('tree_id'))['tree_id__max'] or 0
+            next_id = target.tree_id
+        else:
+            prev_id = target.tree_id
+            next_id = roots.filter(tree_id__gt=target.tree_id).aggregate(
+                Min('tree_id'))['tree_id__min']
+            if next_id is None:
+                return prev_id + cls.tree_id_gap, None, None
+
+        if next_id - prev_id > 1:
+            # there is a hole, the trees don't need to be moved
+            return (prev_id + next_id) // 2, None, None
+
+        # only the trees with consecutive ids (up to the next hole) are
+        # moved, see renumber_tree_ids() to make room for many new trees
+        last_id = next_id
+        for tree_id in roots.filter(tree_id__gt=next_id).order_by(
+                'tree_id').values_list('tree_id', flat=True).iterator():
+            if tree_id != last_id + 1:
+                break
+            last_id = tree_id
+        sql = 'UPDATE %(table)s '\
+              ' SET tree_id = tree_id+1 '\
+              ' WHERE tree_id BETWEEN %(first)d AND %(last)d' % {
+                  'table': connection.ops.quote_name(
+                      get_result_class(cls)._meta.db_table),
+                  'first': next_id,
+                  'last': last_id}
+        return next_id, sql, []
+
+    @classmethod
+    @instrumented('renumber_tree_ids')
+    def renumber_tree_ids(cls):
+        """
+        Renumbers the ``tree_id`` of all the trees, keeping their order and
+        leaving a hole of :attr:`tree_id_gap` - 1 ids between every two
+        trees, so new trees can be added (or moved) between them without
+        moving other trees.
+        """
+        cls = get_result_class(cls)
+        connection = cls._get_database_connection('write')
+        tree_ids = list(cls.get_root_nodes().order_by(
+            'tree_id').values_list('tree_id', flat=True))
+        if not tree_ids:
+            return
+        # the trees are moved out of the way first, so the new ids never
+        # clash with the ids of the trees that are still being renumbered
+        offset = max(tree_ids[-1], len(tree_ids) * cls.tree_id_gap)
+        with transaction.atomic(using=connection.alias):
+            cls.objects.update(tree_id=F('tree_id') + offset)
+            # every tree uses two query parameters and its tree_id
+            batch_size = cls._get_batch_size(connection, 3, tree_ids)
+            for start in range(0, len(tree_ids), batch_size):
+                batch = [
+                    (tree_id + offset, (pos + 1) * cls.tree_id_gap)
+                    for pos, tree_id in enumerate(
+                        tree_ids[start:start + batch_size], start)]
+                cls.objects.filter(
+                    tree_id__in=[old_id for old_id, _new_id in batch]
+                ).update(tree_id=Case(
+                    *[When(tree_id=old_id, then=Value(new_id))
+                      for old_id, new_id in batch],
+                    output_field=cls._meta.get_field('tree_id')))
+
+    @classmethod
+    def _get_hole(cls, tree_id, edge, branch=None):
+        """
+        :returns: The greatest :attr:`lft` or :attr:`rgt` value lower than
+            ``edge`` in a tree, so the nodes added right before ``edge`` (in
+            the order of the tree) must be numbered between both values.
+        :param branch: A node whose branch is ignored, since it's being moved
+            away.
+        """
+        qset = get_result_class(cls).objects.filter(tree_id=tree_id,
+                                                    lft__lt=edge)
+        if branch is not None and branch.tree_id == tree_id:
+            qset = qset.exclude(lft__range=(branch.lft, branch.rgt))
+        values = qset.aggregate(
+            max_lft=Max('lft'),
+            max_rgt=Max(Case(When(rgt__lt=edge, then=F('rgt')))))
+        return max(values['max_lft'], values['max_rgt'] or 0)
+
+    @classmethod
+    def _get_room(cls, tree_id, edge, numnodes, branch=None):
+        """
+        Finds room for the :attr:`lft` and :attr:`rgt` values of
+        ``numnodes`` new nodes right before ``edge`` (in the order of the
+        tree), when the nodes are numbered with a :attr:`gap`.
+
+        If the hole before ``edge`` is too small, the numbering of the
+        smallest branch around ``edge`` that can be spread with at least half
+        the :attr:`gap` between its values (or the whole tree, with the full
+        :attr:`gap`) is spread again, with room for the new nodes.
+
+        :param branch: A node whose branch is ignored, since it's being moved
+            away.
+        :returns: A tuple with the first value for the new nodes, the spacing
+            between their values, and ``True`` if other nodes were
+            renumbered.
+        """
+        hole = edge - cls._get_hole(tree_id, edge, branch)
+        spacing = min(cls.gap, hole // (numnodes * 2 + 1))
+        if spacing:
+            return edge - hole + spacing, spacing, False
+
+        cls = get_result_class(cls)
+        branch_range = None
+        if branch is not None and branch.tree_id == tree_id:
+            branch_range = (branch.lft, branch.rgt)
+
+        def get_descendants(lft, rgt):
+            qset = cls.objects.filter(tree_id=tree_id, lft__gt=lft,
+                                      lft__lt=rgt)
+            if branch_range:
+                qset = qset.exclude(lft__range=branch_range)
+            return qset
+
+        # the nodes around edge, starting by the innermost one
+        for pk, lft, rgt in cls.objects.filter(
+                tree_id=tree_id, lft__lt=edge, rgt__gte=edge
+        ).order_by('-lft').values_list('pk', 'lft', 'rgt'):
+            numslots = (get_descendants(lft, rgt).count() + numnodes) * 2
+            if lft == 1:
+                # the root node can grow as needed
+                spacing = cls.gap
+                newrgt = lft + (numslots + 1) * spacing
+                break
+            spacing = (rgt - lft) // (numslots + 1)
+            if spacing >= max(cls.gap // 2, 3):
+                newrgt = rgt
+                break
+
+        edges = []
+        values = {}
+        for nodepk, nodelft, nodergt in get_descendants(
+                lft, rgt).values_list('pk', 'lft', 'rgt'):
+            edges.extend([(nodelft, nodepk, 0), (nodergt, nodepk, 1)])
+            values[nodepk] = [nodelft, nodergt]
+        edges.sort()
+        start = None
+        pos = 1
+        for value, nodepk, side in edges:
+            if start is None and value >= edge:
+                # the slots of the new nodes
+                start = lft + pos * spacing
+                pos += numnodes * 2
+            values[nodepk][side] = lft + pos * spacing
+            pos += 1
+        if start is None:
+            start = lft + pos * spacing
+        if newrgt != rgt:
+            values[pk] = [lft, newrgt]
+        cls._update_nodes(list(values.items()), ['lft', 'rgt'])
+        return start, spacing, True
+
+    @classmethod
+    def _update_nodes(cls, updates, fields):
+        """
+        Updates the values of some fields of many nodes, with an ``UPDATE``
+        statement per batch of :attr:`bulk_batch_size` nodes.
+
+        :param updates: A list of tuples with the primary key of a node and
+            the list of new values of ``fields``.
+        :param fields: A list of field names.
+        """
+        if not updates:
+            return
+        connection = cls._get_database_connection('write')
+        # every node uses two query parameters per field and its primary key
+        batch_size = cls._get_batch_size(connection, len(fields) * 2 + 1,
+                                         updates)
+        for start in range(0, len(updates), batch_size):
+            batch = updates[start:start + batch_size]
+            values = {}
+            for pos, name in enumerate(fields):
+                values[name] = Case(
+                    *[When(pk=pk, then=Value(newvalues[pos]))
+                      for pk, newvalues in batch],
+                    output_field=cls._meta.get_field(name))
+            cls.objects.filter(
+                pk__in=[pk for pk, _newvalues in batch]).update(**values)
+
+    @instrumented('add_child')
     def add_child(self, **kwargs):
         """Adds a child to the node."""
         if not self.is_leaf():
@@ -203,9 +413,6 @@ class NS_Node(Node):
             return last_child.add_sibling(pos, **kwargs)
 
         # we're adding the first child of this node
-        sql, params = self.__class__._move_right(self.tree_id,
-                                                 self.rgt, False, 2)
-
         if len(kwargs) == 1 and 'instance' in kwargs:
             # adding the passed (unsaved) instance to the tree
             newobj = kwargs['instance']
@@ -218,22 +425,39 @@ class NS_Node(Node):
 
         newobj.tree_id = self.tree_id
         newobj.depth = self.depth + 1
-        newobj.lft = self.lft + 1
-        newobj.rgt = self.lft + 2
+        if self._has_parent():
+            newobj.parent_id = self.pk
+
+        if self.gap > 1:
+            # the child goes in the hole inside the node
+            newobj.lft, spacing, respread = self.__class__._get_room(
+                self.tree_id, self.rgt, 1)
+            newobj.rgt = newobj.lft + spacing
+            if respread:
+                # this is just to update the cache
+                self.lft, self.rgt = get_result_class(
+                    self.__class__).objects.filter(pk=self.pk).values_list(
+                        'lft', 'rgt').get()
+        else:
+            sql, params = self.__class__._move_right(self.tree_id,
+                                                     self.rgt, False, 2)
+            newobj.lft = self.lft + 1
+            newobj.rgt = self.lft + 2
 
-        # this is just to update the cache
-        self.rgt += 2
+            # this is just to update the cache
+            self.rgt += 2
 
-        newobj._cached_parent_obj = self
+            cursor = self._get_database_cursor('write')
+            cursor.execute(sql, params)
 
-        cursor = self._get_database_cursor('write')
-        cursor.execute(sql, params)
+        newobj._cached_parent_obj = self
 
         # saving the instance before returning it
         newobj.save()
 
         return newobj
 
+    @instrumented('add_sibling')
     def add_sibling(self, pos=None, **kwargs):
         """Adds a new node as a sibling to the current node object."""
 
@@ -250,13 +474,16 @@ class NS_Node(Node):
             newobj = get_result_class(self.__class__)(**kwargs)
 
         newobj.depth = self.depth
+        if self._has_parent():
+            # all the siblings share the same parent
+            newobj.parent_id = self.parent_id
 
         sql = None
         target = self
 
         if target.is_root():
             newobj.lft = 1
-            newobj.rgt = 2
+            newobj.rgt = 1 + self.gap
             if pos == 'sorted-sibling':
                 siblings = list(target.get_sorted_pos_queryset(
                     target.get_siblings(), newobj))
@@ -271,14 +498,10 @@ class NS_Node(Node):
                     (pos == 'last-sibling') or
                     (pos == 'right' and target == last_root)
             ):
-                newobj.tree_id = last_root.tree_id + 1
+                newobj.tree_id = last_root.tree_id + self.tree_id_gap
             else:
-                newpos = {'first-sibling': 1,
-                          'left': target.tree_id,
-                          'right': target.tree_id + 1}[pos]
-                sql, params = target.__class__._move_tree_right(newpos)
-
-                newobj.tree_id = newpos
+                newobj.tree_id, sql, params = \
+                    target.__class__._get_new_tree_id(target, pos)
         else:
             newobj.tree_id = target.tree_id
 
@@ -316,16 +539,26 @@ class NS_Node(Node):
 
             if pos == 'last-sibling':
                 newpos = target.get_parent().rgt
-                sql, params = move_right(target.tree_id, newpos, False, 2)
-            elif pos == 'first-sibling':
-                newpos = target.lft
-                sql, params = move_right(target.tree_id, newpos - 1, False, 2)
-            elif pos == 'left':
+            else:
                 newpos = target.lft
-                sql, params = move_right(target.tree_id, newpos, True, 2)
 
-            newobj.lft = newpos
-            newobj.rgt = newpos + 1
+            if self.gap > 1:
+                # the new node goes in the hole before newpos
+                newobj.lft, spacing, _respread = \
+                    target.__class__._get_room(target.tree_id, newpos, 1)
+                newobj.rgt = newobj.lft + spacing
+            else:
+                if pos == 'last-sibling':
+                    sql, params = move_right(target.tree_id, newpos, False,
+                                             2)
+                elif pos == 'first-sibling':
+                    sql, params = move_right(target.tree_id, newpos - 1,
+                                             False, 2)
+                elif pos == 'left':
+                    sql, params = move_right(target.tree_id, newpos, True, 2)
+
+                newobj.lft = newpos
+                newobj.rgt = newpos + 1
 
         # saving the instance before returning it
         if sql:
@@ -336,6 +569,7 @@ class NS_Node(Node):
 
         return newobj
 
+    @instrumented('move')
     def move(self, target, pos=None):
         """
         Moves the current node and all it's descendants to a new position
@@ -406,31 +640,36 @@ class NS_Node(Node):
         gap = self.rgt - self.lft + 1
         sql = None
         target_tree = target.tree_id
+        newtree = False
 
-        # first make a hole
+        # first make a hole (unless the nodes are numbered with a gap)
         if pos == 'last-child':
             newpos = parent.rgt
-            sql, params = move_right(target.tree_id, newpos, False, gap)
+            if cls.gap == 1:
+                sql, params = move_right(target.tree_id, newpos, False, gap)
         elif target.is_root():
             newpos = 1
+            newtree = True
             if pos == 'last-sibling':
-                target_tree = target.get_siblings().reverse()[0].tree_id + 1
-            elif pos == 'first-sibling':
-                target_tree = 1
-                sql, params = cls._move_tree_right(1)
-            elif pos == 'left':
-                sql, params = cls._move_tree_right(target.tree_id)
+                target_tree = target.get_siblings().reverse()[0].tree_id + \
+                    cls.tree_id_gap
+            else:
+                target_tree, sql, params = cls._get_new_tree_id(target, pos)
         else:
             if pos == 'last-sibling':
                 newpos = target.get_parent().rgt
-                sql, params = move_right(target.tree_id, newpos, False, gap)
-            elif pos == 'first-sibling':
-                newpos = target.lft
-                sql, params = move_right(target.tree_id,
-                                         newpos - 1, False, gap)
-            elif pos == 'left':
+            else:
                 newpos = target.lft
-                sql, params = move_right(target.tree_id, newpos, True, gap)
+            if cls.gap == 1:
+                if pos == 'last-sibling':
+                    sql, params = move_right(target.tree_id, newpos, False,
+                                             gap)
+                elif pos == 'first-sibling':
+                    sql, params = move_right(target.tree_id,
+                                             newpos - 1, False, gap)
+                elif pos == 'left':
+                    sql, params = move_right(target.tree_id, newpos, True,
+                                             gap)
 
         if sql:
             cursor.execute(sql, params)
@@ -443,12 +682,45 @@ class NS_Node(Node):
         if parent:
             depthdiff += 1
 
+        if cls._has_parent():
+            parent_id = parent.pk if parent else target.parent_id
+
+        if cls.gap > 1 and not newtree:
+            # the branch goes in the hole before newpos, keeping its
+            # numbering if it fits
+            hole = newpos - cls._get_hole(target_tree, newpos, fromobj)
+            span = fromobj.rgt - fromobj.lft
+            if hole - span >= 2:
+                newpos += min(cls.gap, (hole - span) // 2) - hole
+            else:
+                cls._move_renumbered(fromobj, target_tree, newpos,
+                                     depthdiff)
+                if cls._has_parent():
+                    # the moved node is the only one in the branch that
+                    # changes its parent
+                    cls.objects.filter(pk=fromobj.pk).update(
+                        parent=parent_id)
+                return
+
+        set_parent = ''
+        params = []
+        if cls._has_parent():
+            # the moved node is the only one in the branch that changes its
+            # parent
+            set_parent = ', %(parent)s = CASE WHEN lft = %(fromlft)d '\
+                         '  THEN %%s ELSE %(parent)s END' % {
+                             'parent': connection.ops.quote_name(
+                                 cls._meta.get_field('parent').column),
+                             'fromlft': fromobj.lft}
+            params.append(parent_id)
+
         # move the tree to the hole
         sql = "UPDATE %(table)s "\
               " SET tree_id = %(target_tree)d, "\
               "     lft = lft + %(jump)d , "\
               "     rgt = rgt + %(jump)d , "\
               "     depth = depth + %(depthdiff)d "\
+              "     %(set_parent)s "\
               " WHERE tree_id = %(from_tree)d AND "\
               "     lft BETWEEN %(fromlft)d AND %(fromrgt)d" % {
                   'table': connection.ops.quote_name(cls._meta.db_table),
@@ -456,43 +728,138 @@ class NS_Node(Node):
                   'target_tree': target_tree,
                   'jump': newpos - fromobj.lft,
                   'depthdiff': depthdiff,
+                  'set_parent': set_parent,
                   'fromlft': fromobj.lft,
                   'fromrgt': fromobj.rgt}
-        cursor.execute(sql, [])
-
-        # close the gap
-        sql, params = cls._get_close_gap_sql(fromobj.lft,
-                                             fromobj.rgt, fromobj.tree_id)
         cursor.execute(sql, params)
 
+        if cls.gap == 1:
+            # close the gap
+            sql, params = cls._get_close_gap_sql(fromobj.lft,
+                                                 fromobj.rgt, fromobj.tree_id)
+            cursor.execute(sql, params)
+
+    @classmethod
+    def _move_renumbered(cls, fromobj, target_tree, edge, depthdiff):
+        """
+        Moves the branch of a node right before ``edge`` (in the order of the
+        tree ``target_tree``), numbering the branch again to fit in the
+        room found by :meth:`_get_room`. Used when the nodes are numbered
+        with a :attr:`gap` and the branch doesn't fit in the hole as it is.
+        """
+        branch = list(cls.objects.filter(
+            tree_id=fromobj.tree_id,
+            lft__range=(fromobj.lft, fromobj.rgt)
+        ).values_list('pk', 'lft', 'rgt', 'depth'))
+        start, spacing, _respread = cls._get_room(target_tree, edge,
+                                                  len(branch), fromobj)
+        edges = []
+        values = {}
+        for pk, lft, rgt, depth in branch:
+            edges.extend([(lft, pk, 1), (rgt, pk, 2)])
+            values[pk] = [target_tree, lft, rgt, depth + depthdiff]
+        edges.sort()
+        for pos, (_value, pk, side) in enumerate(edges):
+            values[pk][side] = start + pos * spacing
+        cls._update_nodes(list(values.items()),
+                          ['tree_id', 'lft', 'rgt', 'depth'])
+
 
     @classmethod
     def _get_close_gap_sql(cls, drop_lft, drop_rgt, tree_id):
+        return cls._get_close_gaps_sql(tree_id, [(drop_lft, drop_rgt)])
+
+    @classmethod
+    def _get_close_gaps_sql(cls, tree_id, drop_ranges):
+        """
+        :returns: The sql needed to close the gaps left in a tree by removed
+            branches.
+
+        :param drop_ranges: A sorted list of the (lft, rgt) tuples of the
+            removed branches, none of them inside another one.
+        """
+        # the nodes at the right of every gap are moved to the left by the
+        # size of all the gaps at their left
+        offsets = []
+        gapsize = 0
+        for drop_lft, drop_rgt in drop_ranges:
+            gapsize += drop_rgt - drop_lft + 1
+            offsets.append((drop_lft, gapsize))
+        offsets.reverse()
+
+        def get_sql_new_value(field):
+            return 'CASE %s ELSE %s END' % (' '.join([
+                'WHEN %(field)s > %(drop_lft)d '
+                'THEN %(field)s - %(gapsize)d' % {
+                    'field': field, 'drop_lft': drop_lft, 'gapsize': gapsize}
+                for drop_lft, gapsize in offsets]), field)
+
         sql = 'UPDATE %(table)s '\
-              ' SET lft = CASE '\
-              '           WHEN lft > %(drop_lft)d '\
-              '           THEN lft - %(gapsize)d '\
-              '           ELSE lft END, '\
-              '     rgt = CASE '\
-              '           WHEN rgt > %(drop_lft)d '\
-              '           THEN rgt - %(gapsize)d '\
-              '           ELSE rgt END '\
+              ' SET lft = %(lft)s, '\
+              '     rgt = %(rgt)s '\
               ' WHERE (lft > %(drop_lft)d '\
               '     OR rgt > %(drop_lft)d) AND '\
               '     tree_id=%(tree_id)d' % {
                   'table': connection.ops.quote_name(
                       get_result_class(cls)._meta.db_table),
-                  'gapsize': drop_rgt - drop_lft + 1,
-                  'drop_lft': drop_lft,
+                  'lft': get_sql_new_value('lft'),
+                  'rgt': get_sql_new_value('rgt'),
+                  'drop_lft': drop_ranges[0][0],
                   'tree_id': tree_id}
         return sql, []
 
     @classmethod
+    def _close_gaps(cls, removed_ranges):
+        """
+        Closes the gaps left in the trees by removed branches, with an
+        ``UPDATE`` per tree and batch of :attr:`bulk_batch_size` branches.
+
+        :param removed_ranges: A list of the (tree_id, lft, rgt) tuples of
+            the removed branches, none of them inside another one.
+        """
+        if cls.gap > 1:
+            # the gaps are reused by the new nodes
+            return
+        trees = {}
+        for tree_id, drop_lft, drop_rgt in sorted(removed_ranges):
+            trees.setdefault(tree_id, []).append((drop_lft, drop_rgt))
+        cursor = cls._get_database_cursor('write')
+        for tree_id in sorted(trees):
+            drop_ranges = trees[tree_id]
+            # the rightmost gaps are closed first, so the branches of the
+            # next batches are still where they were removed from
+            for end in range(len(drop_ranges), 0, -cls.bulk_batch_size):
+                sql, params = cls._get_close_gaps_sql(
+                    tree_id,
+                    drop_ranges[max(0, end - cls.bulk_batch_size):end])
+                cursor.execute(sql, params)
+
+    @classmethod
+    @instrumented('load_bulk')
     def load_bulk(cls, bulk_data, parent=None, keep_ids=False):
-        """Loads a list/dictionary structure to the tree."""
+        """
+        Loads a list/dictionary structure to the tree.
+
+        The :attr:`lft`, :attr:`rgt`, :attr:`depth` and :attr:`tree_id`
+        values of the new nodes are calculated in memory and the nodes are
+        written in batches of :attr:`bulk_batch_size` nodes with
+        ``bulk_create``. When loading under a ``parent``, a single gap of the
+        right size is opened in its tree.
+
+        .. note::
+
+           Since the nodes are written with ``bulk_create``, the ``save()``
+           method of the model isn't called and no ``pre_save``/``post_save``
+           signals are sent. Models with :attr:`node_order_by` or using
+           multi-table inheritance (or proxy models, in Django 1.8) are
+           loaded node by node.
+        """
 
         cls = get_result_class(cls)
 
+        if not cls.node_order_by and cls._can_bulk_create():
+            return cls._load_bulk_numbered(bulk_data, parent, keep_ids)
+
         # tree, iterative preorder
         added = []
         if parent:
@@ -502,11 +869,13 @@ class NS_Node(Node):
         # stack of nodes to analize
         stack = [(parent_id, node) for node in bulk_data[::-1]]
         foreign_keys = cls.get_foreign_keys()
+        foreign_objects = cls._get_foreign_objects(foreign_keys, bulk_data)
         while stack:
             parent_id, node_struct = stack.pop()
             # shallow copy of the data strucure so it doesn't persist...
             node_data = node_struct['data'].copy()
-            cls._process_foreign_keys(foreign_keys, node_data)
+            cls._process_foreign_keys(foreign_keys, node_data,
+                                      foreign_objects)
             if keep_ids:
                 node_data['id'] = node_struct['id']
             if parent_id:
@@ -524,8 +893,144 @@ class NS_Node(Node):
                 ])
         return added
 
+    @classmethod
+    def _load_bulk_numbered(cls, bulk_data, parent, keep_ids):
+        """
+        Numbers the whole structure in a single DFS pass and writes it
+        with ``bulk_create``.
+
+        :returns: A list of the added node ids.
+        """
+        newobjs = []
+        # the new nodes and their new parents
+        newparents = []
+        has_parent = cls._has_parent()
+        foreign_keys = cls.get_foreign_keys()
+        foreign_objects = cls._get_foreign_objects(foreign_keys, bulk_data)
+
+        def number_nodes(structs, tree_id, lft, depth, step):
+            # tree, iterative preorder, the rgt value of a node is set when
+            # leaving it (after all its descendants were numbered)
+            stack = [(False, node_struct, depth, None)
+                     for node_struct in structs[::-1]]
+            while stack:
+                leaving, item, depth, parentobj = stack.pop()
+                if leaving:
+                    item.rgt = lft
+                    lft += step
+                    continue
+                newobj = cls._get_bulk_node_obj(foreign_keys,
+                                                foreign_objects, item,
+                                                keep_ids)
+                newobj.tree_id = tree_id
+                newobj.depth = depth
+                newobj.lft = lft
+                if has_parent:
+                    # the parents of the top nodes already exist, the
+                    # other nodes are linked after writing them
+                    newobj.parent_id = parent.pk if parent else None
+                    if parentobj is not None:
+                        newparents.append((newobj, parentobj))
+                lft += step
+                newobjs.append(newobj)
+                stack.append((True, newobj, depth, parentobj))
+                stack.extend([
+                    (False, node_struct, depth + 1, newobj)
+                    for node_struct in item.get('children', [])[::-1]
+                ])
+            return lft
+
+        if parent:
+            # the new nodes are numbered from the position of the parent, so
+            # it is read again in case the passed node is stale
+            parent.tree_id, parent.lft, parent.rgt, parent.depth = (
+                get_result_class(cls).objects.filter(pk=parent.pk).values_list(
+                    'tree_id', 'lft', 'rgt', 'depth').get())
+
+        if parent and cls.gap > 1:
+            # the new nodes go in the hole at the end of the parent, they are
+            # numbered from 0 and then placed in the room found for them
+            number_nodes(bulk_data, parent.tree_id, 0, parent.depth + 1, 1)
+            if newobjs:
+                start, spacing, respread = cls._get_room(
+                    parent.tree_id, parent.rgt, len(newobjs))
+                for newobj in newobjs:
+                    newobj.lft = start + newobj.lft * spacing
+                    newobj.rgt = start + newobj.rgt * spacing
+                if respread:
+                    # this is just to update the cache
+                    parent.lft, parent.rgt = cls.objects.filter(
+                        pk=parent.pk).values_list('lft', 'rgt').get()
+        elif parent:
+            number_nodes(bulk_data, parent.tree_id, parent.rgt,
+                         parent.depth + 1, 1)
+            if newobjs:
+                # open a single gap for all the new nodes
+                gap = len(newobjs) * 2
+                sql, params = cls._move_right(parent.tree_id, parent.rgt,
+                                              False, gap)
+                cursor = cls._get_database_cursor('write')
+                cursor.execute(sql, params)
+                # this is just to update the cache
+                parent.rgt += gap
+        else:
+            last_root = cls.get_last_root_node()
+            if last_root:
+                tree_id = last_root.tree_id + cls.tree_id_gap
+            else:
+                tree_id = cls.tree_id_gap
+            for node_struct in bulk_data:
+                number_nodes([node_struct], tree_id, 1, 1, cls.gap)
+                tree_id += cls.tree_id_gap
+
+        added = []
+        for start in range(0, len(newobjs), cls.bulk_batch_size):
+            chunk = newobjs[start:start + cls.bulk_batch_size]
+            cls.objects.bulk_create(chunk)
+            if chunk[0].pk is None:
+                # the database backend doesn't return the ids of the
+                # inserted rows, the new (tree_id, lft) pairs will tell us
+                ids = dict(
+                    ((tree_id, lft), pk)
+                    for tree_id, lft, pk in cls.objects.filter(
+                        tree_id__range=(chunk[0].tree_id, chunk[-1].tree_id),
+                        lft__range=(min(obj.lft for obj in chunk),
+                                    max(obj.lft for obj in chunk))
+                    ).values_list('tree_id', 'lft', 'pk'))
+                for obj in chunk:
+                    obj.pk = ids[(obj.tree_id, obj.lft)]
+            added.extend([obj.pk for obj in chunk])
+        if newparents:
+            cls._update_parents(dict(
+                (newobj.pk, parentobj.pk)
+                for newobj, parentobj in newparents))
+        return added
+
+    @classmethod
+    def _update_parents(cls, parents):
+        """
+        Sets the ``parent`` of many nodes, with an ``UPDATE`` statement per
+        batch of :attr:`bulk_batch_size` nodes.
+
+        :param parents: A dictionary with the primary keys of the nodes and
+            the primary keys of their new parents.
+        """
+        connection = cls._get_database_connection('write')
+        pks = sorted(parents)
+        # every node uses two query parameters and its primary key
+        batch_size = cls._get_batch_size(connection, 3, pks)
+        field = cls._meta.get_field('parent')
+        for start in range(0, len(pks), batch_size):
+            batch = pks[start:start + batch_size]
+            cls.objects.filter(pk__in=batch).update(parent=Case(
+                *[When(pk=pk, then=Value(parents[pk])) for pk in batch],
+                output_field=field))
+
     def get_children(self):
         """:returns: A queryset of all the node's children"""
+        if self._has_parent():
+            return get_result_class(self.__class__).objects.filter(
+                parent_id=self.pk)
         return self.get_descendants().filter(depth=self.depth + 1)
 
     def get_depth(self):
@@ -534,7 +1039,12 @@ class NS_Node(Node):
 
     def is_leaf(self):
         """:returns: True if the node is a leaf node (else, returns False)"""
-        return self.rgt - self.lft == 1
+        if self.rgt - self.lft == 1:
+            return True
+        if self.gap == 1:
+            return False
+        # with a gap, a node without children can have room for them
+        return not self.get_descendants().exists()
 
     def get_root(self):
         """:returns: the root node for the current node object."""
@@ -554,6 +1064,9 @@ class NS_Node(Node):
         """
         if self.lft == 1:
             return self.get_root_nodes()
+        if self._has_parent():
+            return get_result_class(self.__class__).objects.filter(
+                parent_id=self.parent_id)
         return self.get_parent(True).get_children()
 
     @classmethod
@@ -561,8 +1074,7 @@ class NS_Node(Node):
         """Dumps a tree branch to a python data structure."""
         qset = cls._get_serializable_model().get_tree(parent)
         ret, lnk = [], {}
-        for pyobj in qset:
-            serobj = serializers.serialize('python', [pyobj])[0]
+        for serobj in cls._serialize_in_batches(qset):
             # django's serializer stores the attributes in 'fields'
             fields = serobj['fields']
             depth = fields['depth']
@@ -571,6 +1083,7 @@ class NS_Node(Node):
             del fields['rgt']
             del fields['depth']
             del fields['tree_id']
+            fields.pop('parent', None)
             if 'id' in fields:
                 # this happens immediately after a load_bulk
                 del fields['id']
@@ -583,14 +1096,34 @@ class NS_Node(Node):
                (parent and depth == parent.depth):
                 ret.append(newobj)
             else:
-                parentobj = pyobj.get_parent()
-                parentser = lnk[parentobj.pk]
+                # the nodes come in DFS order, so the parent of this node is
+                # the last node seen in the previous level
+                parentser = lnk[depth - 1]
                 if 'children' not in parentser:
                     parentser['children'] = []
                 parentser['children'].append(newobj)
-            lnk[pyobj.pk] = newobj
+            lnk[depth] = newobj
         return ret
 
+    @classmethod
+    def _serialize_in_batches(cls, qset):
+        """
+        Serializes the nodes of a queryset, reading them with a single
+        streamed query and serializing them in batches of
+        :attr:`bulk_batch_size` nodes.
+
+        :returns: A generator of serialized nodes.
+        """
+        batch = []
+        for pyobj in qset.iterator():
+            batch.append(pyobj)
+            if len(batch) == cls.bulk_batch_size:
+                for serobj in serializers.serialize('python', batch):
+                    yield serobj
+                batch = []
+        for serobj in serializers.serialize('python', batch):
+            yield serobj
+
     @classmethod
     def get_tree(cls, parent=None):
         """
@@ -604,7 +1137,8 @@ class NS_Node(Node):
         if parent is None:
             # return the entire tree
             return cls.objects.all()
-        if parent.is_leaf():
+        if parent.rgt - parent.lft == 1:
+            # a leaf node
             return cls.objects.filter(pk=parent.pk)
         return cls.objects.filter(
             tree_id=parent.tree_id,
@@ -615,12 +1149,15 @@ class NS_Node(Node):
         :returns: A queryset of all the node's descendants as DFS, doesn't
             include the node itself
         """
-        if self.is_leaf():
+        if self.rgt - self.lft == 1:
+            # a leaf node
             return get_result_class(self.__class__).objects.none()
         return self.__class__.get_tree(self).exclude(pk=self.pk)
 
     def get_descendant_count(self):
         """:returns: the number of descendants of a node."""
+        if self.gap > 1:
+            return self.get_descendants().count()
         return (self.rgt - self.lft - 1) / 2
 
     def get_ancestors(self):
@@ -660,15 +1197,85 @@ class NS_Node(Node):
                 return self._cached_parent_obj
         except AttributeError:
             pass
-        # parent = our most direct ancestor
-        self._cached_parent_obj = self.get_ancestors().reverse()[0]
+        if self._has_parent():
+            self._cached_parent_obj = get_result_class(
+                self.__class__).objects.get(pk=self.parent_id)
+        else:
+            # parent = our most direct ancestor
+            self._cached_parent_obj = self.get_ancestors().reverse()[0]
         return self._cached_parent_obj
 
+    @classmethod
+    def annotate_parents(cls, nodes):
+        """
+        Caches the parents of many nodes at once, so :meth:`get_parent`
+        won't need to query the database for any of them. The parents are
+        the nodes one level up whose ``lft``/``rgt`` range contains the
+        nodes (or the nodes of their ``parent`` field, if the model has
+        one), fetched in batches.
+
+        :param nodes: An iterable of (saved) nodes.
+
+        :returns: A list with the nodes.
+        """
+        nodes = list(nodes)
+        pending = [node for node in nodes if node.lft != 1]
+        result_class = get_result_class(cls)
+        if cls._has_parent():
+            pks = list(set(node.parent_id for node in pending))
+            parents = {}
+            for start in range(0, len(pks), cls.bulk_batch_size):
+                parents.update(result_class.objects.in_bulk(
+                    pks[start:start + cls.bulk_batch_size]))
+            for node in pending:
+                if node.parent_id in parents:
+                    node._cached_parent_obj = parents[node.parent_id]
+            return nodes
+
+        if not pending:
+            return nodes
+        connection = cls._get_database_connection('read')
+        # every node uses four query parameters
+        batch_size = cls._get_batch_size(connection, 4, pending)
+        candidates = {}
+        for start in range(0, len(pending), batch_size):
+            query = reduce(operator.or_, [
+                Q(tree_id=node.tree_id, depth=node.depth - 1,
+                  lft__lt=node.lft, rgt__gt=node.rgt)
+                for node in pending[start:start + batch_size]])
+            for parent in result_class.objects.filter(query):
+                candidates.setdefault(
+                    (parent.tree_id, parent.depth), []).append(parent)
+
+        # the candidates of the same tree and depth don't overlap, so the
+        # parent of a node is the last one starting before the node
+        lfts = {}
+        for key, parents in candidates.items():
+            parents.sort(key=lambda parent: parent.lft)
+            lfts[key] = [parent.lft for parent in parents]
+        for node in pending:
+            key = (node.tree_id, node.depth - 1)
+            if key not in candidates:
+                continue
+            pos = bisect.bisect_left(lfts[key], node.lft) - 1
+            if pos >= 0 and candidates[key][pos].rgt > node.rgt:
+                node._cached_parent_obj = candidates[key][pos]
+        return nodes
+
     @classmethod
     def get_root_nodes(cls):
         """:returns: A queryset containing the root nodes in the tree."""
         return get_result_class(cls).objects.filter(lft=1)
 
+    @classmethod
+    def _has_parent(cls):
+        """:returns: ``True`` if the model has a ``parent`` field."""
+        try:
+            cls._meta.get_field('parent')
+        except FieldDoesNotExist:
+            return False
+        return True
+
     class Meta:
         """Abstract model."""
         abstract = True
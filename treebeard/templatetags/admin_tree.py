@@ -203,13 +203,15 @@ def get_parent_id(node):
 
 
 def results(cl):
+    # fetch the parents of the whole page at once, for get_parent_id
+    result_list = cl.model.annotate_parents(cl.result_list)
     if cl.formset:
-        for res, form in zip(cl.result_list, cl.formset.forms):
+        for res, form in zip(result_list, cl.formset.forms):
             yield (res.pk, get_parent_id(res), res.get_depth(),
                    res.get_children_count(),
                    list(items_for_result(cl, res, form)))
     else:
-        for res in cl.result_list:
+        for res in result_list:
             yield (res.pk, get_parent_id(res), res.get_depth(),
                    res.get_children_count(),
                    list(items_for_result(cl, res, None)))
@@ -0,0 +1,270 @@
+"""
+Benchmarks for the tree implementations.
+
+Builds trees of different shapes and sizes with the test models, and measures
+the time and number of queries needed by the most common tree operations.
+The results are written as JSON, so they can be compared between releases.
+
+Usage::
+
+    $ python -m treebeard.tests.benchmark --sizes 1000 10000 -o results.json
+"""
+
+from __future__ import print_function, unicode_literals
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import sys
+import timeit
+
+from django.test.utils import CaptureQueriesContext
+
+
+# the fanout and depth of the trees of every shape
+SHAPES = {
+    'wide': (1000, 3),
+    'deep': (1, 50),
+    'balanced': (10, 6),
+}
+
+OPERATIONS = (
+    'load_bulk', 'get_tree', 'get_annotated_list', 'dump_bulk', 'add_child',
+    'add_sibling', 'move', 'delete'
+)
+
+
+def get_bulk_data(size, fanout, depth):
+    """
+    :returns: A :meth:`~treebeard.models.Node.load_bulk` structure with
+        ``size`` nodes, made of as many trees with the given fanout and depth
+        as needed (the last one may be incomplete).
+    """
+    data = []
+    count = 0
+    while count < size:
+        root = {'data': {'desc': str(count)}}
+        count += 1
+        data.append(root)
+        stack = [(root, 1)]
+        while stack and count < size:
+            node, node_depth = stack.pop()
+            if node_depth == depth:
+                continue
+            children = []
+            for _ in range(min(fanout, size - count)):
+                children.append({'data': {'desc': str(count)}})
+                count += 1
+            node['children'] = children
+            stack.extend([(child, node_depth + 1)
+                          for child in reversed(children)])
+    return data
+
+
+class Benchmark(object):
+    """
+    Measures the operations of a tree model, on a tree of a given shape and
+    size.
+    """
+
+    def __init__(self, model, shape, size, repeat=10, seed=0):
+        self.model = model
+        self.shape = shape
+        self.size = size
+        self.repeat = repeat
+        self.random = random.Random(seed)
+        self.connection = model._get_database_connection('write')
+        self.results = []
+
+    def run(self):
+        """
+        Runs all the benchmarks, leaving the tables of the model empty.
+
+        :returns: A list of results.
+        """
+        fanout, depth = SHAPES[self.shape]
+        bulk_data = get_bulk_data(self.size, fanout, depth)
+        self.empty_tables()
+        try:
+            self.measure('load_bulk', lambda: self.model.load_bulk(bulk_data))
+            self.pks = list(self.model.objects.values_list('pk', flat=True))
+            self.measure('get_tree', lambda: list(self.model.get_tree()))
+            self.measure('get_annotated_list',
+                         self.model.get_annotated_list)
+            self.measure('dump_bulk', self.model.dump_bulk)
+            self.measure_repeated('add_child', self.add_child)
+            self.measure_repeated('add_sibling', self.add_sibling)
+            self.measure_repeated('move', self.move)
+            self.measure_repeated('delete', self.delete)
+        finally:
+            self.empty_tables()
+        return self.results
+
+    def empty_tables(self):
+        """Removes all the nodes, without using the ORM (that is slower)."""
+        tables = []
+        if hasattr(self.model, '_get_closure_model'):
+            tables.append(self.model._get_closure_model()._meta.db_table)
+        tables.append(self.model._meta.db_table)
+        cursor = self.connection.cursor()
+        for table in tables:
+            cursor.execute(
+                'DELETE FROM %s' % self.connection.ops.quote_name(table))
+
+    def measure(self, operation, func):
+        """Measures a single call of an operation."""
+        seconds, queries = self.timed(func)
+        self.add_result(operation, 1, seconds, queries)
+
+    def measure_repeated(self, operation, func):
+        """
+        Measures :attr:`repeat` calls of an operation. ``func`` must return a
+        function to be measured, so the preparation (usually picking and
+        loading random nodes) isn't measured.
+        """
+        total_seconds, total_queries = 0, 0
+        for _ in range(self.repeat):
+            seconds, queries = self.timed(func())
+            total_seconds += seconds
+            total_queries += queries
+        self.add_result(operation, self.repeat, total_seconds, total_queries)
+
+    def timed(self, func):
+        """:returns: The seconds and number of queries needed by a call."""
+        with CaptureQueriesContext(self.connection) as context:
+            start = timeit.default_timer()
+            func()
+            seconds = timeit.default_timer() - start
+        return seconds, len(context.captured_queries)
+
+    def add_result(self, operation, iterations, seconds, queries):
+        self.results.append({
+            'model': self.model.__name__,
+            'shape': self.shape,
+            'size': self.size,
+            'operation': operation,
+            'iterations': iterations,
+            'seconds': seconds,
+            'queries': queries,
+        })
+
+    def get_random_node(self):
+        """:returns: A random node that is still in the tree."""
+        while True:
+            node = self.model.objects.filter(
+                pk=self.random.choice(self.pks)).first()
+            if node is not None:
+                return node
+
+    def add_child(self):
+        node = self.get_random_node()
+        return lambda: node.add_child(desc='child')
+
+    def add_sibling(self):
+        node = self.get_random_node()
+        return lambda: node.add_sibling('left', desc='sibling')
+
+    def move(self):
+        node = self.get_random_node()
+        target = self.get_random_node()
+        while target == node or target.is_descendant_of(node):
+            target = self.get_random_node()
+        return lambda: node.move(target, 'first-child')
+
+    def delete(self):
+        node = self.get_random_node()
+        return node.delete
+
+
+def get_environment(connection):
+    """:returns: A dictionary describing where the benchmarks ran."""
+    import django
+    import treebeard
+
+    if connection.vendor == 'sqlite':
+        database_version = connection.Database.sqlite_version
+    elif connection.vendor == 'mysql':
+        database_version = '.'.join(str(n) for n in connection.mysql_version)
+    elif connection.vendor == 'postgresql':
+        database_version = str(connection.pg_version)
+    else:
+        database_version = None
+    return {
+        'date': datetime.datetime.utcnow().isoformat(),
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'treebeard': treebeard.__version__,
+        'database': connection.vendor,
+        'database_version': database_version,
+    }
+
+
+def run_benchmarks(models, shapes, sizes, repeat=10, seed=0):
+    """
+    Runs the benchmarks of every model, with trees of every shape and size.
+
+    :returns: A dictionary with the ``environment`` where the benchmarks ran
+        and the list of ``results``.
+    """
+    results = []
+    for size in sizes:
+        for shape in shapes:
+            for model in models:
+                results.extend(
+                    Benchmark(model, shape, size, repeat, seed).run())
+    connection = models[0]._get_database_connection('write')
+    return {'environment': get_environment(connection), 'results': results}
+
+
+def main(argv=None):
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'treebeard.tests.settings')
+
+    import django
+    from django.db import connection
+
+    django.setup()
+    from treebeard.tests import models
+
+    model_names = [model.__name__ for model in models.BASE_MODELS]
+    parser = argparse.ArgumentParser(
+        description='Benchmarks the django-treebeard tree implementations.')
+    parser.add_argument('--models', nargs='+', default=model_names,
+                        choices=model_names,
+                        help='tree models to benchmark (default: all)')
+    parser.add_argument('--shapes', nargs='+', default=sorted(SHAPES),
+                        choices=sorted(SHAPES),
+                        help='shapes of the trees (default: all)')
+    parser.add_argument('--sizes', nargs='+', type=int, default=[1000],
+                        help='number of nodes of the trees (default: 1000)')
+    parser.add_argument('--repeat', type=int, default=10,
+                        help='number of times every write operation is '
+                             'measured (default: 10)')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed used to pick random nodes (default: 0)')
+    parser.add_argument('-o', '--output', default='-',
+                        help='file to write the JSON results to '
+                             '(default: stdout)')
+    args = parser.parse_args(argv)
+
+    old_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    try:
+        report = run_benchmarks(
+            [getattr(models, name) for name in args.models], args.shapes,
+            args.sizes, args.repeat, args.seed)
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    if args.output == '-':
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print()
+    else:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -4,6 +4,7 @@ from django.contrib.auth.models import User
 from treebeard.mp_tree import MP_Node
 from treebeard.al_tree import AL_Node
 from treebeard.ns_tree import NS_Node
+from treebeard.ct_tree import CT_Node, CT_NodeClosure
 
 
 class RelatedModel(models.Model):
@@ -133,6 +134,75 @@ class AL_TestNodeInherited(AL_TestNode):
     extra_desc = models.CharField(max_length=255)
 
 
+class CT_TestNode(CT_Node):
+    parent = models.ForeignKey('self',
+                               related_name='children_set',
+                               null=True,
+                               db_index=True)
+    sib_order = models.PositiveIntegerField()
+    desc = models.CharField(max_length=255)
+
+    def __str__(self):  # pragma: no cover
+        return 'Node %d' % self.pk
+
+
+class CT_TestNodeClosure(CT_NodeClosure):
+    ancestor = models.ForeignKey(CT_TestNode,
+                                 related_name='descendant_closures')
+    descendant = models.ForeignKey(CT_TestNode,
+                                   related_name='ancestor_closures')
+
+
+class CT_UnicodeNode(CT_Node):
+    parent = models.ForeignKey('self',
+                               related_name='children_set',
+                               null=True,
+                               db_index=True)
+    sib_order = models.PositiveIntegerField()
+    desc = models.CharField(max_length=255)
+
+    def __str__(self):  # pragma: no cover
+        return self.desc
+
+
+class CT_UnicodeNodeClosure(CT_NodeClosure):
+    ancestor = models.ForeignKey(CT_UnicodeNode,
+                                 related_name='descendant_closures')
+    descendant = models.ForeignKey(CT_UnicodeNode,
+                                   related_name='ancestor_closures')
+
+
+class CT_TestNodeSomeDep(models.Model):
+    node = models.ForeignKey(CT_TestNode)
+
+    def __str__(self):  # pragma: no cover
+        return 'Node %d' % self.pk
+
+
+class CT_TestNodeRelated(CT_Node):
+    parent = models.ForeignKey('self',
+                               related_name='children_set',
+                               null=True,
+                               db_index=True)
+    sib_order = models.PositiveIntegerField()
+    desc = models.CharField(max_length=255)
+    related = models.ForeignKey(RelatedModel)
+
+    def __str__(self):  # pragma: no cover
+        return 'Node %d' % self.pk
+
+
+class CT_TestNodeRelatedClosure(CT_NodeClosure):
+    ancestor = models.ForeignKey(CT_TestNodeRelated,
+                                 related_name='descendant_closures')
+    descendant = models.ForeignKey(CT_TestNodeRelated,
+                                   related_name='ancestor_closures')
+
+
+class CT_TestNodeInherited(CT_TestNode):
+    extra_desc = models.CharField(max_length=255)
+
+
 class MP_TestNodeSorted(MP_Node):
     steplen = 1
     node_order_by = ['val1', 'val2', 'desc']
@@ -168,6 +238,27 @@ class AL_TestNodeSorted(AL_Node):
         return 'Node %d' % self.pk
 
 
+class CT_TestNodeSorted(CT_Node):
+    parent = models.ForeignKey('self',
+                               related_name='children_set',
+                               null=True,
+                               db_index=True)
+    node_order_by = ['val1', 'val2', 'desc']
+    val1 = models.IntegerField()
+    val2 = models.IntegerField()
+    desc = models.CharField(max_length=255)
+
+    def __str__(self):  # pragma: no cover
+        return 'Node %d' % self.pk
+
+
+class CT_TestNodeSortedClosure(CT_NodeClosure):
+    ancestor = models.ForeignKey(CT_TestNodeSorted,
+                                 related_name='descendant_closures')
+    descendant = models.ForeignKey(CT_TestNodeSorted,
+                                   related_name='ancestor_closures')
+
+
 class MP_TestNodeAlphabet(MP_Node):
     steplen = 2
 
@@ -185,6 +276,55 @@ class MP_TestNodeSmallStep(MP_Node):
         return 'Node %d' % self.pk
 
 
+class MP_TestNodeGap(MP_Node):
+    steplen = 3
+    gap = 10
+
+    desc = models.CharField(max_length=255)
+
+    def __str__(self):  # pragma: no cover
+        return 'Node %d' % self.pk
+
+
+class MP_TestNodeDescendants(MP_Node):
+    steplen = 3
+
+    desc = models.CharField(max_length=255)
+    numdescendants = models.PositiveIntegerField(default=0)
+
+    def __str__(self):  # pragma: no cover
+        return 'Node %d' % self.pk
+
+
+class NS_TestNodeParent(NS_Node):
+    parent = models.ForeignKey('self',
+                               related_name='children_set',
+                               null=True,
+                               db_index=True)
+    desc = models.CharField(max_length=255)
+
+    def __str__(self):  # pragma: no cover
+        return 'Node %d' % self.pk
+
+
+class NS_TestNodeGap(NS_Node):
+    gap = 10
+
+    desc = models.CharField(max_length=255)
+
+    def __str__(self):  # pragma: no cover
+        return 'Node %d' % self.pk
+
+
+class NS_TestNodeTreeIdGap(NS_Node):
+    tree_id_gap = 10
+
+    desc = models.CharField(max_length=255)
+
+    def __str__(self):  # pragma: no cover
+        return 'Node %d' % self.pk
+
+
 class MP_TestNodeSortedAutoNow(MP_Node):
     desc = models.CharField(max_length=255)
     created = models.DateTimeField(auto_now_add=True)
@@ -225,6 +365,11 @@ class AL_TestNode_Proxy(AL_TestNode):
         proxy = True
 
 
+class CT_TestNode_Proxy(CT_TestNode):
+    class Meta:
+        proxy = True
+
+
 class MP_TestSortedNodeShortPath(MP_Node):
     steplen = 1
     alphabet = '01234'
@@ -244,16 +389,31 @@ class MP_TestManyToManyWithUser(MP_Node):
     users = models.ManyToManyField(User)
 
 
-BASE_MODELS = AL_TestNode, MP_TestNode, NS_TestNode
-PROXY_MODELS = AL_TestNode_Proxy, MP_TestNode_Proxy, NS_TestNode_Proxy
-SORTED_MODELS = AL_TestNodeSorted, MP_TestNodeSorted, NS_TestNodeSorted
-DEP_MODELS = AL_TestNodeSomeDep, MP_TestNodeSomeDep, NS_TestNodeSomeDep
+BASE_MODELS = AL_TestNode, MP_TestNode, NS_TestNode, CT_TestNode
+PROXY_MODELS = (
+    AL_TestNode_Proxy, MP_TestNode_Proxy, NS_TestNode_Proxy, CT_TestNode_Proxy
+)
+SORTED_MODELS = (
+    AL_TestNodeSorted, MP_TestNodeSorted, NS_TestNodeSorted, CT_TestNodeSorted
+)
+DEP_MODELS = (
+    AL_TestNodeSomeDep, MP_TestNodeSomeDep, NS_TestNodeSomeDep,
+    CT_TestNodeSomeDep
+)
+BULK_MODELS = BASE_MODELS + PROXY_MODELS
 MP_SHORTPATH_MODELS = MP_TestNodeShortPath, MP_TestSortedNodeShortPath
-RELATED_MODELS = AL_TestNodeRelated, MP_TestNodeRelated, NS_TestNodeRelated
-UNICODE_MODELS = AL_UnicodeNode, MP_UnicodeNode, NS_UnicodetNode
+RELATED_MODELS = (
+    AL_TestNodeRelated, MP_TestNodeRelated, NS_TestNodeRelated,
+    CT_TestNodeRelated
+)
+UNICODE_MODELS = (
+    AL_UnicodeNode, MP_UnicodeNode, NS_UnicodetNode, CT_UnicodeNode
+)
 INHERITED_MODELS = (
-    AL_TestNodeInherited, MP_TestNodeInherited, NS_TestNodeInherited
+    AL_TestNodeInherited, MP_TestNodeInherited, NS_TestNodeInherited,
+    CT_TestNodeInherited
 )
+CT_MODELS = CT_TestNode, CT_TestNode_Proxy
 
 
 def empty_models_tables(models):
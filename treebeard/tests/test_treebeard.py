@@ -3,16 +3,20 @@
 
 from __future__ import with_statement, unicode_literals
 import datetime
+import json
 import os
 
 from django.contrib.admin.sites import AdminSite
 from django.contrib.admin.views.main import ChangeList
 from django.contrib.auth.models import User
 from django.contrib.messages.storage.fallback import FallbackStorage
-from django.db.models import Q
+from django.core.exceptions import ObjectDoesNotExist
+from django.db import connection
+from django.db.models import F, Q
 from django.template import Template, Context
 from django.test import TestCase
 from django.test.client import RequestFactory
+from django.test.utils import CaptureQueriesContext
 import pytest
 
 from treebeard import numconv
@@ -20,8 +24,9 @@ from treebeard.admin import admin_factory, TO_FIELD_VAR
 from treebeard.exceptions import InvalidPosition, InvalidMoveToDescendant,\
     PathOverflow, MissingNodeOrderBy, NodeAlreadySaved
 from treebeard.forms import movenodeform_factory
-from treebeard.templatetags.admin_tree import get_static_url
-from treebeard.tests import models
+from treebeard.instrumentation import tree_operation
+from treebeard.templatetags.admin_tree import get_static_url, results
+from treebeard.tests import benchmark, models
 from treebeard.tests.admin import register_all as admin_register_all
 
 
@@ -65,6 +70,13 @@ def _prepare_db_test(request):
 def idfn(fixture_value):
     return fixture_value.__name__
 
+
+def get_updates(context):
+    """:returns: The UPDATE statements captured by a CaptureQueriesContext"""
+    # the sqlite backend of Django 1.8 captures "QUERY = '<sql>' - PARAMS..."
+    return [query['sql'] for query in context.captured_queries
+            if query['sql'].startswith(('UPDATE', "QUERY = 'UPDATE"))]
+
 @pytest.fixture(scope='function',
                 params=models.BASE_MODELS + models.PROXY_MODELS,
                 ids=idfn)
@@ -97,6 +109,11 @@ def inherited_model(request):
     return _prepare_db_test(request)
 
 
+@pytest.fixture(scope='function', params=models.BULK_MODELS, ids=idfn)
+def bulk_model(request):
+    return _prepare_db_test(request)
+
+
 @pytest.fixture(scope='function', params=models.MP_SHORTPATH_MODELS, ids=idfn)
 def mpshort_model(request):
     return _prepare_db_test(request)
@@ -122,11 +139,70 @@ def mpsmallstep_model(request):
     return _prepare_db_test(request)
 
 
+@pytest.fixture(scope='function', params=[models.MP_TestNodeGap], ids=idfn)
+def mpgap_model(request):
+    return _prepare_db_test(request)
+
+
+@pytest.fixture(scope='function', params=[models.MP_TestNodeDescendants],
+                ids=idfn)
+def mpdescendants_model(request):
+    return _prepare_db_test(request)
+
+
 @pytest.fixture(scope='function', params=[models.MP_TestManyToManyWithUser])
 def mpm2muser_model(request):
     return _prepare_db_test(request)
 
 
+@pytest.fixture(scope='function',
+                params=[models.NS_TestNode, models.NS_TestNode_Proxy],
+                ids=idfn)
+def ns_model(request):
+    return _prepare_db_test(request)
+
+
+@pytest.fixture(scope='function', params=[models.NS_TestNodeParent],
+                ids=idfn)
+def nsparent_model(request):
+    return _prepare_db_test(request)
+
+
+@pytest.fixture(scope='function', params=[models.NS_TestNodeGap], ids=idfn)
+def nsgap_model(request):
+    return _prepare_db_test(request)
+
+
+@pytest.fixture(scope='function', params=[models.NS_TestNodeTreeIdGap],
+                ids=idfn)
+def nstreeidgap_model(request):
+    return _prepare_db_test(request)
+
+
+@pytest.fixture(scope='function',
+                params=[models.AL_TestNode, models.AL_TestNode_Proxy],
+                ids=idfn)
+def al_model(request):
+    return _prepare_db_test(request)
+
+
+@pytest.fixture(scope='function', params=[models.AL_TestNodeSorted], ids=idfn)
+def alsorted_model(request):
+    return _prepare_db_test(request)
+
+
+@pytest.fixture(scope='function', params=models.CT_MODELS, ids=idfn)
+def ct_model(request):
+    return _prepare_db_test(request)
+
+
+@pytest.fixture(scope='function',
+                params=[models.MP_TestNode, models.MP_TestNode_Proxy],
+                ids=idfn)
+def mp_model(request):
+    return _prepare_db_test(request)
+
+
 class TestTreeBase(object):
     def got(self, model):
         if model in [models.NS_TestNode, models.NS_TestNode_Proxy]:
@@ -141,6 +217,18 @@ class TestTreeBase(object):
                 assert len(got_edges) == max(got_edges)
                 good_edges = list(range(1, len(got_edges) + 1))
                 assert sorted(got_edges) == good_edges
+        elif model in models.CT_MODELS:
+            # check that the closure table agrees with the node parents
+            parents = dict(model.objects.values_list('pk', 'parent_id'))
+            expected = []
+            for pk in parents:
+                ancestor_id, depth = pk, 0
+                while ancestor_id is not None:
+                    expected.append((ancestor_id, pk, depth))
+                    ancestor_id, depth = parents[ancestor_id], depth + 1
+            got_closures = model._get_closure_model().objects.values_list(
+                'ancestor', 'descendant', 'depth')
+            assert sorted(got_closures) == sorted(expected)
 
         return [(o.desc, o.get_depth(), o.get_children_count())
                 for o in model.get_tree()]
@@ -239,6 +327,29 @@ class TestClassMethods(TestNonEmptyTree):
         assert sorted(got_descs) == sorted(expected_descs)
         assert self.got(model) == expected
 
+    def test_load_bulk_stale_parent(self, model):
+        node = model.objects.get(desc='2')
+        model.objects.get(desc='2').add_child(desc='25')
+        model.load_bulk([{'data': {'desc': '26'}, 'children': [
+            {'data': {'desc': '261'}}]}], node)
+        expected = [('1', 1, 0),
+                    ('2', 1, 6),
+                    ('21', 2, 0),
+                    ('22', 2, 0),
+                    ('23', 2, 1),
+                    ('231', 3, 0),
+                    ('24', 2, 0),
+                    ('25', 2, 0),
+                    ('26', 2, 1),
+                    ('261', 3, 0),
+                    ('3', 1, 0),
+                    ('4', 1, 1),
+                    ('41', 2, 0)]
+        assert self.got(model) == expected
+        assert [obj.desc for obj in model.objects.get(
+            desc='2').get_descendants()] == [
+                '21', '22', '23', '231', '24', '25', '26', '261']
+
     def test_get_tree_all(self, model):
         nodes = model.get_tree()
         got = [(o.desc, o.get_depth(), o.get_children_count())
@@ -387,6 +498,288 @@ class TestClassMethods(TestNonEmptyTree):
             model.add_root(instance=obj)
 
 
+class TestLoadBulkQueries(TestTreeBase):
+
+    def _get_bulk_data(self):
+        return [
+            {'data': {'desc': '%d' % i}, 'children': [
+                {'data': {'desc': '%d%d' % (i, j)}, 'children': [
+                    {'data': {'desc': '%d%d%d' % (i, j, k)}}
+                    for k in range(3)]}
+                for j in range(4)]}
+            for i in range(10)]
+
+    def test_load_bulk_query_count(self, bulk_model, monkeypatch):
+        if not bulk_model._can_bulk_create():
+            pytest.skip('proxy models are loaded node by node in Django 1.8')
+        data = self._get_bulk_data()
+        monkeypatch.setattr(bulk_model, 'bulk_batch_size', 50)
+        with CaptureQueriesContext(connection) as context:
+            ids = bulk_model.load_bulk(data)
+        assert len(ids) == 170
+        assert len(context.captured_queries) < 30
+        assert bulk_model.dump_bulk(keep_ids=False) == data
+        got_descs = [obj.desc
+                     for obj in bulk_model.objects.filter(pk__in=ids)]
+        assert sorted(got_descs) == sorted(
+            obj.desc for obj in bulk_model.get_tree())
+
+    def test_load_bulk_returns_ids_in_dfs_order(self, bulk_model):
+        ids = bulk_model.load_bulk(self._get_bulk_data())
+        assert ids == [obj.pk for obj in bulk_model.get_tree()]
+
+    def test_ns_dump_bulk_query_count(self, ns_model, monkeypatch):
+        data = self._get_bulk_data()
+        ns_model.load_bulk(data)
+        monkeypatch.setattr(ns_model, 'bulk_batch_size', 50)
+        with CaptureQueriesContext(connection) as context:
+            got = ns_model.dump_bulk(keep_ids=False)
+        assert len(context.captured_queries) == 1
+        assert got == data
+
+        parent = ns_model.objects.get(desc='3')
+        with CaptureQueriesContext(connection) as context:
+            got = ns_model.dump_bulk(parent, keep_ids=False)
+        assert len(context.captured_queries) == 1
+        assert got == [data[3]]
+
+    def test_load_bulk_with_fk_query_count(self, related_model):
+        related_objs = [models.RelatedModel.objects.create(desc=str(i))
+                        for i in range(5)]
+        data = self._get_bulk_data()
+        stack = list(data)
+        while stack:
+            node_struct = stack.pop()
+            node_struct['data']['related'] = related_objs[
+                len(stack) % len(related_objs)].pk
+            stack.extend(node_struct.get('children', []))
+        related_table = models.RelatedModel._meta.db_table
+        with CaptureQueriesContext(connection) as context:
+            related_model.load_bulk(data)
+        related_queries = [query for query in context.captured_queries
+                           if related_table in query['sql']]
+        assert len(related_queries) == 1
+        assert related_model.dump_bulk(keep_ids=False) == data
+
+    def test_load_bulk_with_missing_fk(self, related_model):
+        related = models.RelatedModel.objects.create(desc='1')
+        data = [{'data': {'desc': '1', 'related': related.pk}},
+                {'data': {'desc': '2', 'related': related.pk + 1000}}]
+        with pytest.raises(models.RelatedModel.DoesNotExist):
+            related_model.load_bulk(data)
+        assert related_model.objects.count() == 0
+
+
+class TestAL_TreeQueries(TestNonEmptyTree):
+
+    def test_get_tree_query_count(self, al_model):
+        with CaptureQueriesContext(connection) as context:
+            got = [(o.desc, o.get_depth(), type(o))
+                   for o in al_model.get_tree()]
+        assert len(context.captured_queries) == 1
+        assert got == [(desc, depth, al_model)
+                       for desc, depth, numchild in UNCHANGED]
+
+    def test_get_tree_branch_query_count(self, al_model):
+        node = al_model.objects.get(desc='2')
+        with CaptureQueriesContext(connection) as context:
+            got = [(o.desc, o.get_depth()) for o in al_model.get_tree(node)]
+        assert len(context.captured_queries) == 1
+        assert got == [('2', 1), ('21', 2), ('22', 2), ('23', 2),
+                       ('231', 3), ('24', 2)]
+
+    def test_get_tree_without_recursive_queries(self, al_model,
+                                                monkeypatch):
+        expected = [(o.pk, o.get_depth()) for o in al_model.get_tree()]
+        monkeypatch.setattr(al_model, '_can_use_recursive_queries',
+                            classmethod(lambda cls: False))
+        got = [(o.pk, o.get_depth()) for o in al_model.get_tree()]
+        assert got == expected
+
+    def test_get_ancestors_query_count(self, al_model):
+        node = al_model.objects.get(desc='231')
+        with CaptureQueriesContext(connection) as context:
+            ancestors = node.get_ancestors()
+            got = [(o.desc, o.get_depth(), type(o)) for o in ancestors]
+            assert node.get_depth() == 3
+            assert node.get_root().desc == '2'
+        assert len(context.captured_queries) == 2
+        assert got == [('2', 1, al_model), ('23', 2, al_model)]
+
+    def test_get_depth_query_count(self, al_model):
+        node = al_model.objects.get(desc='231')
+        with CaptureQueriesContext(connection) as context:
+            assert node.get_depth() == 3
+        assert len(context.captured_queries) == 1
+
+    @pytest.mark.parametrize('recursive', [True, False])
+    def test_annotate_depth(self, al_model, monkeypatch, recursive):
+        monkeypatch.setattr(al_model, '_can_use_recursive_queries',
+                            classmethod(lambda cls: recursive))
+        nodes = al_model.annotate_depth(al_model.objects.all())
+        with CaptureQueriesContext(connection) as context:
+            got = sorted((o.desc, o.get_depth()) for o in nodes)
+        assert len(context.captured_queries) == 0
+        assert got == sorted((desc, depth)
+                             for desc, depth, numchild in UNCHANGED)
+
+    @pytest.mark.parametrize('recursive', [True, False])
+    def test_is_descendant_of(self, al_model, monkeypatch, recursive):
+        monkeypatch.setattr(al_model, '_can_use_recursive_queries',
+                            classmethod(lambda cls: recursive))
+        node2 = al_model.objects.get(desc='2')
+        node23 = al_model.objects.get(desc='23')
+        node231 = al_model.objects.get(desc='231')
+        node4 = al_model.objects.get(desc='4')
+        assert node231.is_descendant_of(node2)
+        assert node231.is_descendant_of(node23)
+        assert node23.is_descendant_of(node2)
+        assert not node231.is_descendant_of(node231)
+        assert not node231.is_descendant_of(node4)
+        assert not node2.is_descendant_of(node231)
+        assert not node2.is_descendant_of(node4)
+
+    @pytest.mark.parametrize('recursive', [True, False])
+    def test_get_descendant_count(self, al_model, monkeypatch, recursive):
+        monkeypatch.setattr(al_model, '_can_use_recursive_queries',
+                            classmethod(lambda cls: recursive))
+        got = [(o.desc, o.get_descendant_count())
+               for o in al_model.objects.filter(desc__in=['1', '2', '23'])]
+        assert sorted(got) == [('1', 0), ('2', 5), ('23', 1)]
+
+    def test_descendants_query_count(self, al_model):
+        node2 = al_model.objects.get(desc='2')
+        node231 = al_model.objects.get(desc='231')
+        with CaptureQueriesContext(connection) as context:
+            assert node231.is_descendant_of(node2)
+            assert node2.get_descendant_count() == 5
+        assert len(context.captured_queries) == 2
+
+    def test_get_tree_sorted(self, alsorted_model):
+        root = alsorted_model.add_root(val1=3, val2=3, desc='z')
+        root.add_child(val1=2, val2=1, desc='b')
+        root.add_child(val1=1, val2=4, desc='a')
+        alsorted_model.add_root(val1=1, val2=1, desc='y')
+        got = [(o.desc, o.get_depth()) for o in alsorted_model.get_tree()]
+        assert got == [('y', 1), ('z', 1), ('a', 2), ('b', 2)]
+
+
+class TestCT_Tree(TestNonEmptyTree):
+
+    def test_queries(self, ct_model):
+        node2 = ct_model.objects.get(desc='2')
+        node231 = ct_model.objects.get(desc='231')
+        with CaptureQueriesContext(connection) as context:
+            assert [o.desc for o in node231.get_ancestors()] == ['2', '23']
+            assert node231.get_depth() == 3
+            assert node231.get_root().desc == '2'
+            assert node231.is_descendant_of(node2)
+            assert not node2.is_descendant_of(node231)
+            assert node2.get_descendant_count() == 5
+        assert len(context.captured_queries) == 5
+
+    def test_get_tree_query_count(self, ct_model):
+        with CaptureQueriesContext(connection) as context:
+            got = [(o.desc, o.get_depth(), type(o))
+                   for o in ct_model.get_tree()]
+        assert len(context.captured_queries) == 1
+        assert got == [(desc, depth, ct_model)
+                       for desc, depth, numchild in UNCHANGED]
+
+    def test_fix_tree(self, ct_model):
+        closure_model = ct_model._get_closure_model()
+        closure_model.objects.filter(depth__gt=1).delete()
+        closure_model.objects.filter(depth=0).update(depth=5)
+        ct_model.fix_tree()
+        assert self.got(ct_model) == UNCHANGED
+
+    def test_annotate_depth(self, ct_model):
+        nodes = ct_model.annotate_depth(ct_model.objects.all())
+        with CaptureQueriesContext(connection) as context:
+            got = sorted((o.desc, o.get_depth()) for o in nodes)
+        assert len(context.captured_queries) == 0
+        assert got == sorted((desc, depth)
+                             for desc, depth, numchild in UNCHANGED)
+
+
+class TestBenchmark(TestTreeBase):
+
+    @pytest.mark.parametrize('shape', sorted(benchmark.SHAPES))
+    def test_get_bulk_data(self, shape):
+        fanout, depth = benchmark.SHAPES[shape]
+        data = benchmark.get_bulk_data(100, fanout, depth)
+        descs, got_depth = [], 0
+        stack = [(node, 1) for node in data]
+        while stack:
+            node, node_depth = stack.pop()
+            descs.append(node['data']['desc'])
+            got_depth = max(got_depth, node_depth)
+            assert len(node.get('children', [])) <= fanout
+            stack.extend([(child, node_depth + 1)
+                          for child in node.get('children', [])])
+        assert sorted(descs) == sorted(str(i) for i in range(100))
+        assert got_depth <= depth
+
+    def test_benchmark(self, model_without_proxy):
+        results = benchmark.Benchmark(model_without_proxy, 'balanced', 30,
+                                      repeat=2).run()
+        assert [result['operation'] for result in results] == list(
+            benchmark.OPERATIONS)
+        for result in results:
+            assert result['model'] == model_without_proxy.__name__
+            assert result['queries'] > 0
+            assert result['seconds'] >= 0
+        assert model_without_proxy.objects.count() == 0
+        json.dumps(results)
+
+
+class TestInstrumentation(TestNonEmptyTree):
+
+    @pytest.fixture
+    def events(self, request):
+        events = []
+
+        def receiver(sender, **kwargs):
+            kwargs['sender'] = sender
+            events.append(kwargs)
+
+        tree_operation.connect(receiver, weak=False)
+        request.addfinalizer(lambda: tree_operation.disconnect(receiver))
+        return events
+
+    def test_move(self, model, events):
+        node = model.objects.get(desc='231')
+        target = model.objects.get(desc='1')
+        with CaptureQueriesContext(connection) as context:
+            node.move(target, 'first-child')
+        assert len(events) == 1
+        event = events[0]
+        assert event['sender'] == model
+        assert event['operation'] == 'move'
+        assert event['duration'] >= 0
+        assert len(event['statements']) == len(context.captured_queries)
+        assert all(isinstance(statement['rowcount'], int) and
+                   statement['duration'] >= 0
+                   for statement in event['statements'])
+
+    def test_nested_operations(self, model, events):
+        node = model.objects.get(desc='2')
+        node.add_child(desc='25')
+        model.load_bulk([{'data': {'desc': '5'}, 'children': [
+            {'data': {'desc': '51'}}]}])
+        node.delete()
+        assert [(event['sender'], event['operation']) for event in events] \
+            == [(model, 'add_child'), (model, 'load_bulk'), (model, 'delete')]
+        assert all(event['statements'] for event in events)
+
+    def test_without_receivers(self, model):
+        node = model.objects.get(desc='2')
+        debug_cursor = connection.force_debug_cursor
+        node.add_child(desc='25')
+        assert connection.force_debug_cursor == debug_cursor
+        assert 'make_debug_cursor' not in connection.__dict__
+
+
 class TestSimpleNodeMethods(TestNonEmptyTree):
     def test_is_root(self, model):
         data = [
@@ -462,6 +855,51 @@ class TestSimpleNodeMethods(TestNonEmptyTree):
             else:
                 assert parent is None
 
+    @pytest.mark.parametrize('batch_size', [500, 2])
+    def test_with_parents(self, model, monkeypatch, batch_size):
+        monkeypatch.setattr(model, 'bulk_batch_size', batch_size)
+        expected = dict(
+            (node.desc, node.get_parent() and node.get_parent().desc)
+            for node in model.objects.all())
+        with CaptureQueriesContext(connection) as context:
+            nodes = list(model.objects.all().with_parents())
+        # the nodes, and their parents in one or more batches
+        if batch_size == 500:
+            assert len(context.captured_queries) == 2
+        else:
+            assert len(context.captured_queries) > 2
+        with CaptureQueriesContext(connection) as context:
+            got = dict((node.desc, node.get_parent()) for node in nodes)
+        assert len(context.captured_queries) == 0
+        for desc, parent in got.items():
+            if expected[desc]:
+                assert parent.desc == expected[desc]
+                assert type(parent) is model
+            else:
+                assert parent is None
+
+    def test_with_parents_values(self, model):
+        descs = model.objects.filter(
+            desc__in=['1', '231']).with_parents().values_list('desc',
+                                                              flat=True)
+        assert sorted(descs) == ['1', '231']
+
+    def test_annotate_parents_without_parents(self, model, monkeypatch):
+        # postgresql and mysql handle as many objects per query as given
+        monkeypatch.setattr(connection.ops, 'bulk_batch_size',
+                            lambda fields, objs: len(objs))
+        roots = list(model.get_root_nodes())
+        assert model.annotate_parents(roots) == roots
+        assert model.annotate_parents([]) == []
+        assert list(model.get_root_nodes().with_parents()) == roots
+
+    def test_annotate_parents(self, model):
+        node = model.objects.get(desc='231')
+        assert model.annotate_parents([node]) == [node]
+        with CaptureQueriesContext(connection) as context:
+            assert node.get_parent().desc == '23'
+        assert len(context.captured_queries) == 0
+
     def test_get_children(self, model):
         data = [
             ('2', ['21', '22', '23', '24']),
@@ -996,6 +1434,18 @@ class TestDelete(TestNonEmptyTree):
         model.objects.filter(desc__in=('ZZZ', 'XXX')).delete()
         assert self.got(model) == UNCHANGED
 
+    def test_delete_nonexistant_nodes_unlimited_batch(self, model,
+                                                      monkeypatch):
+        # postgresql and mysql handle as many objects per query as given
+        monkeypatch.setattr(connection.ops, 'bulk_batch_size',
+                            lambda fields, objs: len(objs))
+        model.objects.filter(desc__in=('ZZZ', 'XXX')).delete()
+        assert self.got(model) == UNCHANGED
+        model.objects.filter(desc__in=('2', '4')).delete()
+        expected = [('1', 1, 0),
+                    ('3', 1, 0)]
+        assert self.got(model) == expected
+
     def test_delete_same_node_twice(self, model):
         model.objects.filter(desc__in=('2', '2')).delete()
         expected = [('1', 1, 0),
@@ -1914,6 +2364,618 @@ class TestMP_TreeStepOverflow(TestTreeBase):
                     newroot.move(target, pos)
 
 
+class TestMP_TreeShiftSiblings(TestTreeBase):
+
+    def _load_siblings(self, model, num):
+        model.load_bulk([{'data': {'desc': 'root'}, 'children': [
+            {'data': {'desc': 'c%d' % i}, 'children': [
+                {'data': {'desc': 'c%d-1' % i}}]}
+            for i in range(num)]}])
+        return model.get_first_root_node()
+
+    def _assert_siblings(self, model, root, expected):
+        got = [(o.desc, [c.desc for c in o.get_children()])
+               for o in root.get_children()]
+        assert got == [(desc, [desc + '-1'] if desc.startswith('c') else [])
+                       for desc in expected]
+        assert all(not problems for problems in model.find_problems())
+
+    def test_add_first_sibling(self, mp_model):
+        root = self._load_siblings(mp_model, 40)
+        node = root.get_first_child()
+        with CaptureQueriesContext(connection) as context:
+            node.add_sibling('first-sibling', desc='new')
+        assert len(context.captured_queries) < 10
+        self._assert_siblings(mp_model, root,
+                              ['new'] + ['c%d' % i for i in range(40)])
+
+    def test_add_left_sibling(self, mp_model):
+        root = self._load_siblings(mp_model, 40)
+        node = mp_model.objects.get(desc='c10')
+        node.add_sibling('left', desc='new')
+        self._assert_siblings(
+            mp_model, root,
+            ['c%d' % i for i in range(10)] + ['new'] +
+            ['c%d' % i for i in range(10, 40)])
+
+    def test_move_left(self, mp_model):
+        root = self._load_siblings(mp_model, 40)
+        node = mp_model.objects.get(desc='c30')
+        target = mp_model.objects.get(desc='c5')
+        with CaptureQueriesContext(connection) as context:
+            node.move(target, 'left')
+        assert len(context.captured_queries) < 15
+        self._assert_siblings(
+            mp_model, root,
+            ['c%d' % i for i in range(5)] + ['c30'] +
+            ['c%d' % i for i in range(5, 30)] +
+            ['c%d' % i for i in range(31, 40)])
+
+    def test_move_from_other_parent(self, mp_model):
+        root = self._load_siblings(mp_model, 40)
+        node = mp_model.objects.get(desc='c30-1')
+        target = mp_model.objects.get(desc='c0')
+        node.move(target, 'first-sibling')
+        expected = ['c30-1'] + ['c%d' % i for i in range(40)]
+        got = [o.desc for o in root.get_children()]
+        assert got == expected
+        assert all(not problems for problems in mp_model.find_problems())
+        assert mp_model.objects.get(desc='c30').get_children_count() == 0
+
+    def test_no_room_for_shift(self, mpsmallstep_model):
+        root = mpsmallstep_model.add_root()
+        for i in range(1, 8):
+            root.add_child()
+        paths = [o.path for o in root.get_children()]
+        root.get_first_child().add_sibling('first-sibling')
+        got = [o.path for o in root.get_children()]
+        assert got == paths + ['18']
+
+
+class TestMP_TreeDelete(TestTreeBase):
+
+    def test_delete_many(self, mp_model, monkeypatch):
+        monkeypatch.setattr(mp_model, 'bulk_batch_size', 7)
+        mp_model.load_bulk([{'data': {'desc': 'root'}, 'children': [
+            {'data': {'desc': 'c%d' % i}, 'children': [
+                {'data': {'desc': 'c%d-1' % i}},
+                {'data': {'desc': 'c%d-2' % i}}]}
+            for i in range(30)]}])
+        with CaptureQueriesContext(connection) as context:
+            mp_model.objects.filter(
+                Q(desc__endswith='-1') | Q(desc__in=['c0', 'c1'])).delete()
+        # the 31 parents are updated in batches, and never loaded
+        assert len(get_updates(context)) == 5
+        root = mp_model.get_first_root_node()
+        assert root.numchild == 28
+        assert [(node.desc, node.numchild) for node in root.get_children()
+                ] == [('c%d' % i, 1) for i in range(2, 30)]
+        assert all(not problems for problems in mp_model.find_problems())
+
+
+class TestNS_TreeDelete(TestTreeBase):
+
+    def test_delete_many_ranges(self, ns_model):
+        # more ranges than query parameters allowed by sqlite
+        ns_model.load_bulk([{'data': {'desc': 'root'}, 'children': [
+            {'data': {'desc': 'c%d' % i}} for i in range(700)]}])
+        ns_model.objects.filter(
+            desc__in=['c%d' % i for i in range(700) if i % 7]).delete()
+        root = ns_model.get_first_root_node()
+        assert (root.lft, root.rgt) == (1, 202)
+        assert [(node.desc, node.lft, node.rgt)
+                for node in root.get_children()] == [
+            ('c%d' % i, 2 + 2 * pos, 3 + 2 * pos)
+            for pos, i in enumerate(range(0, 700, 7))]
+
+    def test_delete_many(self, ns_model, monkeypatch):
+        monkeypatch.setattr(ns_model, 'bulk_batch_size', 7)
+        ns_model.load_bulk([
+            {'data': {'desc': 'r%d' % r}, 'children': [
+                {'data': {'desc': 'r%dc%d' % (r, i)}, 'children': [
+                    {'data': {'desc': 'r%dc%d-1' % (r, i)}}]}
+                for i in range(10)]}
+            for r in range(3)])
+        with CaptureQueriesContext(connection) as context:
+            ns_model.objects.filter(
+                Q(desc__endswith='-1', desc__startswith='r0') |
+                Q(desc__in=['r1c0', 'r1c0-1', 'r1c5', 'r1c9'])).delete()
+        # the gaps are closed with an update per tree and batch of ranges
+        assert len(get_updates(context)) == 3
+        expected = []
+        for r in range(3):
+            children = [i for i in range(10) if r != 1 or i not in (0, 5, 9)]
+            expected.append(('r%d' % r, 1, len(children)))
+            for i in children:
+                expected.append(('r%dc%d' % (r, i), 2, int(r != 0)))
+                if r != 0:
+                    expected.append(('r%dc%d-1' % (r, i), 3, 0))
+        assert self.got(ns_model) == expected
+
+
+class TestNS_TreeParent(TestTreeBase):
+
+    def assert_parents(self, model):
+        # the stored parent of every node is its most direct ancestor
+        for node in model.objects.all():
+            ancestors = list(node.get_ancestors())
+            expected = ancestors[-1].pk if ancestors else None
+            assert (node.desc, node.parent_id) == (node.desc, expected)
+
+    def test_load_bulk(self, nsparent_model, monkeypatch):
+        monkeypatch.setattr(nsparent_model, 'bulk_batch_size', 3)
+        nsparent_model.load_bulk(BASE_DATA)
+        parent = nsparent_model.objects.get(desc='23')
+        nsparent_model.load_bulk(BASE_DATA, parent)
+        self.assert_parents(nsparent_model)
+        assert self.got(nsparent_model)[:6] == [
+            ('1', 1, 0), ('2', 1, 4), ('21', 2, 0), ('22', 2, 0),
+            ('23', 2, 5), ('231', 3, 0)]
+
+    def test_add(self, nsparent_model):
+        nsparent_model.load_bulk(BASE_DATA)
+        node = nsparent_model.objects.get(desc='231')
+        assert node.add_child(desc='2311').parent_id == node.pk
+        for pos in ('first-sibling', 'left', 'right', 'last-sibling'):
+            node.add_sibling(pos, desc=pos)
+            node = nsparent_model.objects.get(pk=node.pk)
+        nsparent_model.objects.get(desc='1').add_sibling('left', desc='0')
+        nsparent_model.add_root(desc='5')
+        self.assert_parents(nsparent_model)
+
+    @pytest.mark.parametrize('desc, target, pos', [
+        ('231', '1', 'first-child'),
+        ('23', '4', 'last-child'),
+        ('23', '41', 'left'),
+        ('23', '21', 'left'),
+        ('2', '41', 'first-child'),
+        ('41', '2', 'first-sibling'),
+        ('231', '2', 'right'),
+        ('231', '3', 'last-sibling'),
+    ])
+    def test_move(self, nsparent_model, desc, target, pos):
+        nsparent_model.load_bulk(BASE_DATA)
+        node = nsparent_model.objects.get(desc=desc)
+        node.move(nsparent_model.objects.get(desc=target), pos)
+        self.assert_parents(nsparent_model)
+
+    def test_get_children_and_siblings(self, nsparent_model):
+        nsparent_model.load_bulk(BASE_DATA)
+        node = nsparent_model.objects.get(desc='2')
+        with CaptureQueriesContext(connection) as context:
+            children = list(node.get_children())
+        assert [child.desc for child in children] == ['21', '22', '23', '24']
+        # a lookup by parent instead of a range scan of the descendants
+        assert '"parent_id" =' in context.captured_queries[0]['sql']
+        assert [sibling.desc for sibling in children[2].get_siblings()] == [
+            '21', '22', '23', '24']
+        with CaptureQueriesContext(connection) as context:
+            assert children[2].get_parent() == node
+        assert len(context.captured_queries) == 1
+
+    def test_delete(self, nsparent_model):
+        nsparent_model.load_bulk(BASE_DATA)
+        nsparent_model.objects.filter(desc__in=['23', '4']).delete()
+        self.assert_parents(nsparent_model)
+        assert [node.desc for node in nsparent_model.objects.get(
+            desc='2').get_children()] == ['21', '22', '24']
+
+
+class TestNS_TreeGap(TestTreeBase):
+
+    def got(self, model):
+        # the intervals of the nodes are nested like the tree
+        stack = []
+        for node in model.objects.all():
+            while stack and (stack[-1].tree_id != node.tree_id or
+                             stack[-1].rgt < node.lft):
+                stack.pop()
+            assert node.lft < node.rgt
+            assert node.depth == len(stack) + 1
+            if stack:
+                assert node.rgt < stack[-1].rgt
+            stack.append(node)
+        return [(node.desc, node.get_depth(), node.get_children_count(),
+                 node.get_descendant_count(), node.is_leaf())
+                for node in model.get_tree()]
+
+    def get_data(self, prefix, times=1):
+        # BASE_DATA with unique descs
+        def copy(structs, prefix):
+            return [
+                {'data': {'desc': prefix + struct['data']['desc']},
+                 'children': copy(struct.get('children', []), prefix)}
+                for struct in structs]
+        return sum([copy(BASE_DATA, '%s%d-' % (prefix, i))
+                    for i in range(times)], [])
+
+    def run_operations(self, model, operations):
+        model.load_bulk(BASE_DATA)
+        for desc, method, args in operations:
+            node = model.objects.get(desc=desc)
+            if method == 'move':
+                node.move(model.objects.get(desc=args[0]), args[1])
+            elif method == 'load_bulk':
+                model.load_bulk(args, node)
+            else:
+                getattr(node, method)(*args[:-1], desc=args[-1])
+        return self.got(model)
+
+    def assert_operations(self, model, operations):
+        expected = self.run_operations(models.NS_TestNode, operations)
+        assert self.run_operations(model, operations) == expected
+
+    def test_load_bulk_stale_parent(self, nsgap_model):
+        nsgap_model.load_bulk(BASE_DATA)
+        node = nsgap_model.objects.get(desc='2')
+        # fill the hole at the end of 2, so the load needs more room
+        for i in range(10):
+            nsgap_model.objects.get(desc='2').add_child(desc='2-%d' % i)
+        nsgap_model.load_bulk(BASE_DATA, node)
+        got = self.got(nsgap_model)
+        assert got[1] == ('2', 1, 18, 25, False)
+        assert [child.desc for child in nsgap_model.objects.get(
+            pk=node.pk).get_children()] == (
+                ['21', '22', '23', '24'] + ['2-%d' % i for i in range(10)] +
+                ['1', '2', '3', '4'])
+
+    def test_numbering(self, nsgap_model):
+        nsgap_model.load_bulk(BASE_DATA)
+        root = nsgap_model.objects.get(desc='2')
+        assert (root.lft, root.rgt) == (1, 111)
+        assert [(node.lft, node.rgt) for node in root.get_children()] == [
+            (11, 21), (31, 41), (51, 81), (91, 101)]
+
+        def get_values():
+            return dict((row[0], row[1:]) for row in
+                        nsgap_model.objects.values_list(
+                            'desc', 'tree_id', 'lft', 'rgt'))
+
+        values = get_values()
+        nsgap_model.objects.get(desc='231').add_child(desc='2311')
+        nsgap_model.objects.get(desc='22').add_sibling('left', desc='x')
+        nsgap_model.objects.get(desc='22').move(
+            nsgap_model.objects.get(desc='24'), 'last-child')
+        nsgap_model.objects.filter(desc='21').delete()
+        # the nodes used the holes, only the moved node was renumbered
+        newvalues = get_values()
+        assert [desc for desc in sorted(newvalues)
+                if newvalues[desc] != values.get(desc)] == ['22', '2311', 'x']
+        assert self.got(nsgap_model)[:6] == [
+            ('1', 1, 0, 0, True), ('2', 1, 3, 6, False),
+            ('x', 2, 0, 0, True), ('23', 2, 1, 2, False),
+            ('231', 3, 1, 1, False), ('2311', 4, 0, 0, True)]
+
+    def test_add(self, nsgap_model):
+        self.assert_operations(nsgap_model, [
+            ('231', 'add_child', ['2311']),
+            ('23', 'add_child', ['232']),
+            ('1', 'add_child', ['11']),
+            ('22', 'add_sibling', ['left', 'l']),
+            ('22', 'add_sibling', ['right', 'r']),
+            ('22', 'add_sibling', ['first-sibling', 'f']),
+            ('22', 'add_sibling', ['last-sibling', 'ls']),
+            ('3', 'add_sibling', ['left', '2b']),
+            ('41', 'load_bulk', self.get_data('a')),
+        ])
+
+    @pytest.mark.parametrize('pos', ['left', 'first-child', 'last-child'])
+    def test_respread(self, nsgap_model, pos):
+        # the holes around a node run out, so its branch (and then its
+        # ancestors) are numbered again
+        operations = []
+        for i in range(40):
+            if pos == 'left':
+                operations.append(('22', 'add_sibling', ['left', 'n%d' % i]))
+            else:
+                operations.append(('22', 'move', ['231', pos]))
+                operations.append(('231', 'add_child', ['n%d' % i]))
+        self.assert_operations(nsgap_model, operations)
+        assert nsgap_model.objects.get(desc='1').rgt == 11
+
+    def test_load_bulk_respread(self, nsgap_model):
+        self.assert_operations(nsgap_model, [
+            ('231', 'load_bulk', self.get_data('a')),
+            ('231', 'load_bulk', self.get_data('b', 4)),
+            ('21', 'load_bulk', self.get_data('c')),
+        ])
+
+    @pytest.mark.parametrize('desc, target, pos', [
+        ('231', '1', 'first-child'),
+        ('23', '4', 'last-child'),
+        ('23', '41', 'left'),
+        ('23', '21', 'left'),
+        ('22', '24', 'left'),
+        ('2', '41', 'first-child'),
+        ('41', '2', 'first-sibling'),
+        ('21', '1', 'left'),
+        ('231', '2', 'right'),
+        ('231', '3', 'last-sibling'),
+    ])
+    def test_move(self, nsgap_model, desc, target, pos):
+        self.assert_operations(nsgap_model, [
+            (desc, 'move', [target, pos]),
+            # and again, now with the holes taken
+            ('2', 'load_bulk', self.get_data('a', 3)),
+            (desc, 'move', [target, pos]),
+            ('3', 'add_child', ['31']),
+        ])
+
+    def test_move_renumbered(self, nsgap_model):
+        nsgap_model.load_bulk(BASE_DATA)
+        # a branch bigger than the hole where it goes
+        nsgap_model.load_bulk(self.get_data('a', 2),
+                              nsgap_model.objects.get(desc='1'))
+        node = nsgap_model.objects.get(desc='41')
+        node.move(nsgap_model.objects.get(desc='1'), 'first-child')
+        node = nsgap_model.objects.get(desc='21')
+        node.move(nsgap_model.objects.get(desc='41'), 'last-child')
+        self.got(nsgap_model)
+        assert [
+            child.desc for child in nsgap_model.objects.get(
+                desc='41').get_children()
+        ] == ['21']
+
+    def test_delete(self, nsgap_model):
+        nsgap_model.load_bulk(BASE_DATA)
+        with CaptureQueriesContext(connection) as context:
+            nsgap_model.objects.filter(desc__in=['23', '4']).delete()
+        assert not get_updates(context)
+        assert [node.desc for node in nsgap_model.objects.get(
+            desc='2').get_children()] == ['21', '22', '24']
+        self.got(nsgap_model)
+
+
+class TestNS_TreeIdGap(TestTreeBase):
+
+    def got_tree_ids(self, model):
+        return [(node.desc, node.tree_id) for node in model.get_root_nodes()]
+
+    def load_roots(self, model, num):
+        model.load_bulk([{'data': {'desc': 'r%d' % i}} for i in range(num)])
+
+    def test_add_root_and_load_bulk(self, nstreeidgap_model):
+        nstreeidgap_model.add_root(desc='r0')
+        nstreeidgap_model.load_bulk([{'data': {'desc': 'r1'}},
+                                     {'data': {'desc': 'r2'}}])
+        nstreeidgap_model.add_root(desc='r3')
+        assert self.got_tree_ids(nstreeidgap_model) == [
+            ('r0', 10), ('r1', 20), ('r2', 30), ('r3', 40)]
+
+    def test_add_sibling(self, nstreeidgap_model):
+        self.load_roots(nstreeidgap_model, 3)
+        root = nstreeidgap_model.objects.get(desc='r1')
+        with CaptureQueriesContext(connection) as context:
+            root.add_sibling('left', desc='left')
+            root.add_sibling('right', desc='right')
+            root.add_sibling('first-sibling', desc='first')
+            root.add_sibling('last-sibling', desc='last')
+        # the new trees are added in the holes, other trees aren't moved
+        assert not get_updates(context)
+        assert self.got_tree_ids(nstreeidgap_model) == [
+            ('first', 5), ('r0', 10), ('left', 15), ('r1', 20),
+            ('right', 25), ('r2', 30), ('last', 40)]
+
+    def test_add_sibling_without_hole(self, nstreeidgap_model):
+        self.load_roots(nstreeidgap_model, 3)
+        root = nstreeidgap_model.objects.get(desc='r1')
+        for i in range(5):
+            root.add_sibling('left', desc='n%d' % i)
+        # only the trees up to the next hole were moved
+        assert self.got_tree_ids(nstreeidgap_model) == [
+            ('r0', 10), ('n0', 15), ('n1', 17), ('n2', 18), ('n3', 19),
+            ('n4', 20), ('r1', 21), ('r2', 30)]
+
+    @pytest.mark.parametrize('desc, target, pos', [
+        ('21', '1', 'left'),
+        ('2', '1', 'first-sibling'),
+        ('4', '2', 'left'),
+        ('1', '3', 'right'),
+        ('231', '4', 'last-sibling'),
+        ('41', '3', 'left'),
+    ])
+    def test_move(self, nstreeidgap_model, desc, target, pos):
+        # the same trees as in a model with consecutive tree ids
+        for model in (models.NS_TestNode, nstreeidgap_model):
+            model.load_bulk(BASE_DATA)
+            model.objects.get(desc=desc).move(
+                model.objects.get(desc=target), pos)
+            model.objects.get(desc='3').add_sibling('left', desc='new')
+        assert self.got(nstreeidgap_model) == self.got(models.NS_TestNode)
+        assert [
+            node.get_descendant_count()
+            for node in nstreeidgap_model.get_root_nodes()
+        ] == [
+            node.get_descendant_count()
+            for node in models.NS_TestNode.get_root_nodes()
+        ]
+
+    def test_renumber_tree_ids(self, nstreeidgap_model):
+        nstreeidgap_model.load_bulk(BASE_DATA)
+        root = nstreeidgap_model.objects.get(desc='3')
+        for i in range(12):
+            root.add_sibling('left', desc='n%d' % i)
+        expected = [(node.desc, node.lft, node.rgt, node.depth)
+                    for node in nstreeidgap_model.objects.all()]
+        nstreeidgap_model.renumber_tree_ids()
+        assert [
+            (node.desc, node.lft, node.rgt, node.depth)
+            for node in nstreeidgap_model.objects.all()
+        ] == expected
+        assert [tree_id for _desc, tree_id in self.got_tree_ids(
+            nstreeidgap_model)] == [10 * (i + 1) for i in range(16)]
+
+    def test_renumber_tree_ids_batches(self, nstreeidgap_model, monkeypatch):
+        monkeypatch.setattr(nstreeidgap_model, 'bulk_batch_size', 2)
+        self.load_roots(nstreeidgap_model, 5)
+        nstreeidgap_model.objects.update(tree_id=F('tree_id') / 10)
+        nstreeidgap_model.renumber_tree_ids()
+        assert self.got_tree_ids(nstreeidgap_model) == [
+            ('r%d' % i, 10 * (i + 1)) for i in range(5)]
+
+
+class TestMP_TreeGap(TestTreeBase):
+
+    def _get_steps(self, nodes):
+        return [node._get_lastpos_in_path() for node in nodes]
+
+    def _load_children(self, model, num):
+        model.load_bulk([{'data': {'desc': 'root'}, 'children': [
+            {'data': {'desc': 'c%d' % i}} for i in range(num)]}])
+        return model.get_first_root_node()
+
+    def test_add_root_and_child(self, mpgap_model):
+        root = mpgap_model.add_root(desc='1')
+        mpgap_model.add_root(desc='2')
+        root.add_child(desc='11')
+        root.add_child(desc='12')
+        assert self._get_steps(mpgap_model.get_root_nodes()) == [10, 20]
+        assert self._get_steps(root.get_children()) == [10, 20]
+
+    def test_load_bulk(self, mpgap_model):
+        root = self._load_children(mpgap_model, 3)
+        assert root._get_lastpos_in_path() == 10
+        assert self._get_steps(root.get_children()) == [10, 20, 30]
+        self._load_children(mpgap_model, 1)
+        assert self._get_steps(mpgap_model.get_root_nodes()) == [10, 20]
+
+    @pytest.mark.parametrize('pos, desc, expected', [
+        ('first-sibling', 'c0', [5, 10, 20, 30]),
+        ('left', 'c0', [5, 10, 20, 30]),
+        ('left', 'c2', [10, 20, 25, 30]),
+        ('right', 'c0', [10, 15, 20, 30]),
+        ('right', 'c2', [10, 20, 30, 40]),
+    ])
+    def test_add_sibling_in_hole(self, mpgap_model, pos, desc, expected):
+        root = self._load_children(mpgap_model, 3)
+        paths = [node.path for node in root.get_children()]
+        mpgap_model.objects.get(desc=desc).add_sibling(pos, desc='new')
+        children = root.get_children()
+        assert self._get_steps(children) == expected
+        assert [node.path for node in children if node.desc != 'new'] == paths
+        assert all(not problems for problems in mpgap_model.find_problems())
+
+    def test_move_to_hole(self, mpgap_model):
+        root = self._load_children(mpgap_model, 3)
+        node = mpgap_model.objects.get(desc='c2')
+        node.move(mpgap_model.objects.get(desc='c0'), 'right')
+        assert [node.desc for node in root.get_children()] == [
+            'c0', 'c2', 'c1']
+        assert self._get_steps(root.get_children()) == [10, 15, 20]
+
+    def test_fix_tree_destructive(self, mpgap_model):
+        root = self._load_children(mpgap_model, 3)
+        mpgap_model.objects.get(desc='c1').add_sibling('left', desc='new')
+        mpgap_model.objects.get(desc='c0').delete()
+        mpgap_model.fix_tree(destructive=True)
+        assert [node.desc for node in root.get_children()] == [
+            'new', 'c1', 'c2']
+        assert self._get_steps(root.get_children()) == [10, 20, 30]
+
+    def test_no_hole(self, mpgap_model):
+        root = self._load_children(mpgap_model, 2)
+        for i in range(10):
+            target = mpgap_model.objects.get(desc='c1')
+            target.add_sibling('left', desc='new%d' % i)
+        assert [node.desc for node in root.get_children()] == (
+            ['c0'] + ['new%d' % i for i in range(10)] + ['c1'])
+        # the hole is filled first, and then the siblings are moved
+        assert self._get_steps(root.get_children()) == (
+            [10, 15, 17, 18, 19] + list(range(20, 27)))
+        assert all(not problems for problems in mpgap_model.find_problems())
+
+
+class TestMP_TreeNumDescendants(TestTreeBase):
+
+    def got(self, model):
+        # the stored value and the real number of descendants of every node
+        paths = list(model.objects.values_list('path', 'numdescendants'))
+        return [(path, numdescendants,
+                 len([p for p, _ in paths if p.startswith(path)]) - 1)
+                for path, numdescendants in paths]
+
+    def assert_numdescendants(self, model):
+        got = self.got(model)
+        assert [(path, real) for path, _, real in got] == [
+            (path, numdescendants) for path, numdescendants, _ in got]
+
+    def test_load_bulk(self, mpdescendants_model):
+        mpdescendants_model.load_bulk(BASE_DATA)
+        parent = mpdescendants_model.objects.get(desc='23')
+        mpdescendants_model.load_bulk(BASE_DATA, parent)
+        assert parent.numdescendants == 11
+        self.assert_numdescendants(mpdescendants_model)
+
+    def test_add(self, mpdescendants_model):
+        mpdescendants_model.load_bulk(BASE_DATA)
+        node = mpdescendants_model.objects.get(desc='231')
+        node.add_child(desc='2311')
+        assert node.numdescendants == 1
+        for pos in ('first-sibling', 'left', 'right', 'last-sibling'):
+            node.add_sibling(pos, desc=pos)
+            node = mpdescendants_model.objects.get(pk=node.pk)
+        mpdescendants_model.add_root(desc='5')
+        self.assert_numdescendants(mpdescendants_model)
+
+    @pytest.mark.parametrize('desc, target, pos', [
+        ('231', '1', 'first-child'),
+        ('23', '4', 'last-child'),
+        ('23', '41', 'left'),
+        ('23', '21', 'left'),
+        ('2', '41', 'first-child'),
+        ('41', '2', 'first-sibling'),
+        ('231', '2', 'right'),
+    ])
+    def test_move(self, mpdescendants_model, desc, target, pos):
+        mpdescendants_model.load_bulk(BASE_DATA)
+        node = mpdescendants_model.objects.get(desc=desc)
+        node.move(mpdescendants_model.objects.get(desc=target), pos)
+        self.assert_numdescendants(mpdescendants_model)
+
+    def test_move_stale_node(self, mpdescendants_model):
+        mpdescendants_model.load_bulk(BASE_DATA)
+        node = mpdescendants_model.objects.get(desc='23')
+        # the branch grows after the node was fetched
+        mpdescendants_model.objects.get(desc='231').add_child(desc='2311')
+        node.move(mpdescendants_model.objects.get(desc='4'), 'last-child')
+        self.assert_numdescendants(mpdescendants_model)
+
+    def test_delete(self, mpdescendants_model):
+        mpdescendants_model.load_bulk(BASE_DATA)
+        mpdescendants_model.load_bulk(
+            BASE_DATA, mpdescendants_model.objects.get(desc='231'))
+        mpdescendants_model.objects.get(desc='41', depth=2).delete()
+        mpdescendants_model.objects.filter(
+            desc__in=['1', '22', '23', '24']).delete()
+        self.assert_numdescendants(mpdescendants_model)
+        root = mpdescendants_model.objects.get(desc='2', depth=1)
+        assert root.numdescendants == 1
+
+    def test_get_descendant_count(self, mpdescendants_model):
+        mpdescendants_model.load_bulk(BASE_DATA)
+        node = mpdescendants_model.objects.get(desc='2', depth=1)
+        with CaptureQueriesContext(connection) as context:
+            assert node.get_descendant_count() == 5
+        assert not context.captured_queries
+
+    @pytest.mark.parametrize('destructive', [False, True])
+    def test_fix_tree(self, mpdescendants_model, destructive):
+        mpdescendants_model.load_bulk(BASE_DATA)
+        mpdescendants_model.objects.filter(
+            desc__in=['2', '23', '41']).update(numdescendants=7)
+        mpdescendants_model.fix_tree(destructive=destructive)
+        self.assert_numdescendants(mpdescendants_model)
+
+    def test_fix_tree_parent(self, mpdescendants_model):
+        mpdescendants_model.load_bulk(BASE_DATA)
+        node = mpdescendants_model.objects.get(desc='23')
+        # a child saved without updating its ancestors
+        mpdescendants_model(path=node.path + '005', depth=3,
+                            desc='new').save()
+        mpdescendants_model.fix_tree(destructive=True, parent=node)
+        self.assert_numdescendants(mpdescendants_model)
+
+
 class TestMP_TreeShortPath(TestTreeBase):
     """Test a tree with a very small path field (max_length=4) and a
     steplen of 1
@@ -1926,8 +2988,75 @@ class TestMP_TreeShortPath(TestTreeBase):
             obj.add_child()
 
 
+class TestMP_TreeBranchFilter(TestTreeBase):
+
+    @pytest.mark.parametrize('path, expected', [
+        ('0', ('0', '1')),
+        ('13', ('13', '14')),
+        ('14', ('14', '2')),
+        ('344', ('344', '4')),
+        ('4', ('4', None)),
+        ('444', ('444', None)),
+    ])
+    def test_get_branch_path_interval(self, mpshortnotsorted_model, path,
+                                      expected):
+        assert mpshortnotsorted_model._get_branch_path_interval(
+            path) == expected
+
+    def load_tree(self, model):
+        # three roots with four children (the steps start at 1), and the
+        # last child of every node has four children too
+        def get_children(depth):
+            children = [{'data': {}} for _ in range(4)]
+            if depth < 3:
+                children[-1]['children'] = get_children(depth + 1)
+            return children
+        model.load_bulk([{'data': {}, 'children': get_children(2)}
+                         for _ in range(3)])
+        return dict(model.objects.values_list('path', 'pk'))
+
+    def test_get_descendants(self, mpshortnotsorted_model):
+        paths = self.load_tree(mpshortnotsorted_model)
+        for node in mpshortnotsorted_model.objects.all():
+            with CaptureQueriesContext(connection) as context:
+                got = [obj.path for obj in node.get_descendants()]
+            assert got == sorted(path for path in paths
+                                 if path.startswith(node.path) and
+                                 path != node.path)
+            if got:
+                assert ' LIKE ' not in context.captured_queries[0]['sql']
+        parent = mpshortnotsorted_model.objects.get(path='34')
+        assert [data['id'] for data in mpshortnotsorted_model.dump_bulk(
+            parent)[0]['children']] == [paths['34' + char]
+                                        for char in '1234']
+
+    def test_delete(self, mpshortnotsorted_model):
+        paths = self.load_tree(mpshortnotsorted_model)
+        mpshortnotsorted_model.objects.filter(
+            path__in=['14', '2', '344']).delete()
+        assert sorted(mpshortnotsorted_model.objects.values_list(
+            'path', flat=True)) == sorted(
+                path for path in paths
+                if not path.startswith(('14', '2', '344')))
+
+    def test_move(self, mpshortnotsorted_model):
+        paths = self.load_tree(mpshortnotsorted_model)
+        node = mpshortnotsorted_model.objects.get(path='14')
+        node.move(mpshortnotsorted_model.objects.get(path='2'), 'left')
+        got = dict(mpshortnotsorted_model.objects.values_list('pk', 'path'))
+        # the branch of 14 is the new second root, the other roots move
+        for path, pk in paths.items():
+            if path.startswith('14'):
+                assert got[pk] == '2' + path[2:]
+            elif path[0] in '23':
+                assert got[pk] == str(int(path[0]) + 1) + path[1:]
+
+
 class TestMP_TreeFindProblems(TestTreeBase):
-    def test_find_problems(self, mpalphabet_model):
+    @pytest.mark.parametrize('method', [
+        'find_problems', '_find_problems_with_sql',
+        '_find_problems_streaming'])
+    def test_find_problems(self, mpalphabet_model, method):
         mpalphabet_model.alphabet = '01234'
         mpalphabet_model(path='01', depth=1, numchild=0, numval=0).save()
         mpalphabet_model(path='1', depth=1, numchild=0, numval=0).save()
@@ -1947,13 +3076,72 @@ class TestMP_TreeFindProblems(TestTreeBase):
                     mpalphabet_model.objects.filter(id__in=ids)]
 
         (evil_chars, bad_steplen, orphans, wrong_depth, wrong_numchild) = (
-            mpalphabet_model.find_problems())
+            getattr(mpalphabet_model, method)())
         assert ['abcd', 'qa#$%!'] == got(evil_chars)
         assert ['1', '111'] == got(bad_steplen)
         assert ['0201', '020201'] == got(orphans)
         assert ['03', '0301', '030102'] == got(wrong_numchild)
         assert ['04', '0401'] == got(wrong_depth)
 
+    @staticmethod
+    def find_problems_per_node(model):
+        """The checks of find_problems, with queries for every node."""
+        evil_chars, bad_steplen, orphans = [], [], []
+        wrong_depth, wrong_numchild = [], []
+        for node in model.objects.all():
+            if not set(model.alphabet).issuperset(node.path):
+                evil_chars.append(node.pk)
+                continue
+            if len(node.path) % model.steplen:
+                bad_steplen.append(node.pk)
+                continue
+            try:
+                node.get_parent(True)
+            except ObjectDoesNotExist:
+                orphans.append(node.pk)
+                continue
+            if node.depth != int(len(node.path) / model.steplen):
+                wrong_depth.append(node.pk)
+                continue
+            real_numchild = model.objects.filter(
+                path__range=model._get_children_path_interval(node.path)
+            ).extra(
+                where=['LENGTH(path)/%d=%d' % (model.steplen, node.depth + 1)]
+            ).count()
+            if real_numchild != node.numchild:
+                wrong_numchild.append(node.pk)
+        return evil_chars, bad_steplen, orphans, wrong_depth, wrong_numchild
+
+    @pytest.mark.parametrize('method', [
+        'find_problems', '_find_problems_with_sql',
+        '_find_problems_streaming'])
+    def test_find_problems_per_node(self, mp_model, method):
+        mp_model.load_bulk(BASE_DATA)
+        # the children of 2 are orphans, but 231 still has a parent
+        mp_model.objects.filter(desc='2').update(path='009')
+        mp_model.objects.filter(desc='231').update(numchild=2)
+        mp_model.objects.filter(desc='1').update(path='0a1')
+        mp_model.objects.filter(desc='3').update(path='03')
+        mp_model.objects.filter(desc='41').update(depth=5)
+
+        def got(ids):
+            return sorted(mp_model.objects.filter(
+                pk__in=ids).values_list('desc', flat=True))
+
+        expected = self.find_problems_per_node(mp_model)
+        problems = getattr(mp_model, method)()
+        assert [got(ids) for ids in problems] == [
+            got(ids) for ids in expected]
+        assert [got(ids) for ids in problems] == [
+            ['1'], ['3'], ['21', '22', '23', '24'], ['41'], ['2', '231']]
+
+    def test_find_problems_queries(self, mp_model):
+        mp_model.load_bulk(BASE_DATA)
+        with CaptureQueriesContext(connection) as context:
+            problems = mp_model.find_problems()
+        assert problems == ([], [], [], [], [])
+        assert len(context.captured_queries) == 1
+
 
 class TestMP_TreeFix(TestTreeBase):
 
@@ -2048,6 +3236,16 @@ class TestMP_TreeFix(TestTreeBase):
         assert got == expected
         mpshort_model.find_problems()
 
+    def test_fix_tree_non_destructive_queries(self, mpshort_model):
+        self.add_broken_test_data(mpshort_model)
+        with CaptureQueriesContext(connection) as context:
+            mpshort_model.fix_tree()
+        # one update for the depth and one for the numchild values (sqlite
+        # counts the children in a temporary table first)
+        assert len(get_updates(context)) == 2
+        assert self.got(mpshort_model) == self.expected_with_holes[
+            mpshort_model]
+
     def test_fix_tree_destructive(self, mpshort_model):
         self.add_broken_test_data(mpshort_model)
         mpshort_model.fix_tree(destructive=True)
@@ -2056,6 +3254,40 @@ class TestMP_TreeFix(TestTreeBase):
         assert got == expected
         mpshort_model.find_problems()
 
+    def test_fix_tree_destructive_keeps_pks(self, mpshort_model,
+                                            monkeypatch):
+        self.add_broken_test_data(mpshort_model)
+        monkeypatch.setattr(mpshort_model, 'bulk_batch_size', 3)
+        descs = dict(mpshort_model.objects.values_list('pk', 'desc'))
+        mpshort_model.fix_tree(destructive=True)
+        assert dict(mpshort_model.objects.values_list('pk', 'desc')) == descs
+        assert self.got(mpshort_model) == self.expected_no_holes[
+            mpshort_model]
+
+    def test_fix_tree_destructive_parent(self, mpshort_model):
+        self.add_broken_test_data(mpshort_model)
+        outside = list(mpshort_model.objects.exclude(
+            path__startswith='4').values_list('pk', 'path', 'depth',
+                                              'numchild'))
+        parent = mpshort_model.objects.get(path='4')
+        mpshort_model.fix_tree(destructive=True, parent=parent)
+        assert parent.numchild == 4
+        # the branch is fixed like in the whole tree
+        rootpath = [path for path, desc, depth, _ in self.expected_no_holes[
+            mpshort_model] if desc == 'a' and depth == 1][0]
+        expected = [('4' + path[1:], desc, depth, numchild)
+                    for path, desc, depth, numchild in self.expected_no_holes[
+                        mpshort_model] if path.startswith(rootpath)]
+        got = [(o.path, o.desc, o.depth, o.numchild)
+               for o in mpshort_model.objects.filter(
+                   path__startswith='4').exclude(pk=parent.pk).order_by(
+                       'path')]
+        assert got == expected[1:]
+        # and the rest of the tree isn't changed
+        assert list(mpshort_model.objects.exclude(
+            path__startswith='4').values_list('pk', 'path', 'depth',
+                                              'numchild')) == outside
+
 
 class TestIssues(TestTreeBase):
     # test for http://code.google.com/p/django-treebeard/issues/detail?id=14
@@ -2392,6 +3624,23 @@ class TestAdminTree(TestNonEmptyTree):
         assert '<input type="hidden" id="has-filters" value="0"/>' in \
                table_output
 
+    def test_result_tree_parent_ids(self, model_without_proxy):
+        model = model_without_proxy
+        request = RequestFactory().get('/admin/tree/')
+        m = admin_factory(movenodeform_factory(model))(model, AdminSite())
+        list_display = m.get_list_display(request)
+        list_display_links = m.get_list_display_links(request, list_display)
+        cl = ChangeList(request, model, list_display, list_display_links,
+                        m.list_filter, m.date_hierarchy, m.search_fields,
+                        m.list_select_related, m.list_per_page,
+                        m.list_max_show_all, m.list_editable, m)
+        cl.formset = None
+        rows = list(results(cl))
+        assert len(rows) == model.objects.count()
+        for pk, parent_id, depth, children_count, items in rows:
+            parent = model.objects.get(pk=pk).get_parent()
+            assert parent_id == (parent.pk if parent else 0)
+
     def test_unicode_result_tree(self, model_with_unicode):
         """
         Verifies that inclusion tag result_list generates a table when with